@@ -19,13 +19,79 @@ class Settings(BaseModel):
     xray_config_path: str = os.getenv("XRAY_CONFIG_PATH", "/usr/local/etc/xray/config.json")
     xray_restart_cmd: str = os.getenv("XRAY_RESTART_CMD", "")
     xray_bin: str = os.getenv("XRAY_BIN", "/usr/local/bin/xray")
+    subprocess_timeout_sec: float = float(os.getenv("XRAY_SUBPROCESS_TIMEOUT_SEC", "15"))
+    subprocess_max_concurrency: int = int(os.getenv("XRAY_SUBPROCESS_MAX_CONCURRENCY", "8"))
     xray_online_activity_window_sec: int = int(os.getenv("XRAY_ONLINE_ACTIVITY_WINDOW_SEC", "120"))
 
+    # "grpc" - in-process pooled channel, "grpcurl" - spawn grpcurl per call (legacy).
+    xray_api_backend: str = os.getenv("XRAY_API_BACKEND", "grpc").lower()
+    xray_grpc_pool_size: int = int(os.getenv("XRAY_GRPC_POOL_SIZE", "4"))
+    xray_grpc_timeout_sec: float = float(os.getenv("XRAY_GRPC_TIMEOUT_SEC", "10"))
+    xray_batch_workers: int = int(os.getenv("XRAY_BATCH_WORKERS", "16"))
+
     agent_token: str = os.getenv("XRAY_AGENT_TOKEN", "b54faaef41dfea320e52e25823a8999be3719003a0842910d160a3cd490f6954")
 
     sync_server_id: int = int(os.getenv("XRAY_SYNC_SERVER_ID", "1"))
-
+    # "push" - add every active key, "reconcile" (opt-in) - diff active keys against inbound users
+    # and also remove stale / changed ones.
+    sync_mode: str = os.getenv("XRAY_SYNC_MODE", "push").lower()
+    sync_workers: int = int(os.getenv("XRAY_SYNC_WORKERS", "16"))
+    sync_call_timeout_sec: float = float(os.getenv("XRAY_SYNC_CALL_TIMEOUT_SEC", "5"))
+    sync_retry_attempts: int = int(os.getenv("XRAY_SYNC_RETRY_ATTEMPTS", "3"))
+    sync_retry_backoff_sec: float = float(os.getenv("XRAY_SYNC_RETRY_BACKOFF_SEC", "0.5"))
+
+    # Periodic reconcile of vpn_keys vs Xray; 0 disables the scheduler.
+    reconcile_interval_sec: float = float(os.getenv("XRAY_RECONCILE_INTERVAL_SEC", "300"))
+    reconcile_jitter_sec: float = float(os.getenv("XRAY_RECONCILE_JITTER_SEC", "30"))
+
+    key_listener_enabled: bool = os.getenv("XRAY_KEY_LISTENER_ENABLED", "0").lower() in {"1", "true", "yes"}
+    key_listener_channel: str = os.getenv("XRAY_KEY_LISTENER_CHANNEL", "xray_agent_vpn_keys")
+    key_listener_install_trigger: bool = os.getenv("XRAY_KEY_LISTENER_INSTALL_TRIGGER", "1").lower() in {"1", "true", "yes"}
+
+    # How often the background collector polls Xray stats and refreshes the traffic snapshot.
+    traffic_collector_interval_sec: float = float(os.getenv("XRAY_TRAFFIC_COLLECTOR_INTERVAL_SEC", "5"))
+    # "absolute": diff absolute Xray counters against the last seen value;
+    # "reset": pull user counters with reset=true and add them to the totals as-is.
+    traffic_accounting_mode: str = os.getenv("XRAY_TRAFFIC_ACCOUNTING_MODE", "absolute").lower()
+    # How many users per rate window the collector keeps ranked for /top_talkers.
+    top_talkers_max_k: int = int(os.getenv("XRAY_TOP_TALKERS_MAX_K", "100"))
+
+    # Optional tail of the Xray access log (path from XRAY_ACCESS_LOG_PATH or log.access in config.json)
+    # for connection-based online status and distinct source IPs per user.
+    access_log_enabled: bool = os.getenv("XRAY_ACCESS_LOG_ENABLED", "0").lower() in {"1", "true", "yes"}
+    access_log_path: str = os.getenv("XRAY_ACCESS_LOG_PATH", "")
+    access_log_online_window_sec: float = float(os.getenv("XRAY_ACCESS_LOG_ONLINE_WINDOW_SEC", "60"))
+    access_log_ip_window_sec: float = float(os.getenv("XRAY_ACCESS_LOG_IP_WINDOW_SEC", "300"))
+    access_log_backfill_bytes: int = int(os.getenv("XRAY_ACCESS_LOG_BACKFILL_BYTES", str(4 * 1024 * 1024)))
+
+    # Per-user traffic history in the snapshot store: 1-minute buckets rolled up into hours and days.
+    traffic_history_enabled: bool = os.getenv("XRAY_TRAFFIC_HISTORY_ENABLED", "1").lower() in {"1", "true", "yes"}
+    traffic_history_retention_1m_days: float = float(os.getenv("XRAY_TRAFFIC_HISTORY_RETENTION_1M_DAYS", "2"))
+    traffic_history_retention_1h_days: float = float(os.getenv("XRAY_TRAFFIC_HISTORY_RETENTION_1H_DAYS", "31"))
+    traffic_history_retention_1d_days: float = float(os.getenv("XRAY_TRAFFIC_HISTORY_RETENTION_1D_DAYS", "400"))
+
+    # Where per-user totals live: "sqlite" (local file below) or "postgres" (vpn_user_traffic_snapshot in XRAY_DB_DSN).
+    traffic_store_backend: str = os.getenv("XRAY_TRAFFIC_STORE_BACKEND", "sqlite").lower()
     traffic_sqlite_path: str = os.getenv("XRAY_TRAFFIC_SQLITE_PATH", "./data/traffic_snapshot.sqlite3")
+    # Write-behind for the snapshot store: totals live in memory and reach SQLite every N seconds
+    # (or once this many rows are dirty); 0 writes every update through synchronously.
+    traffic_flush_interval_sec: float = float(os.getenv("XRAY_TRAFFIC_FLUSH_INTERVAL_SEC", "30"))
+    traffic_flush_max_rows: int = int(os.getenv("XRAY_TRAFFIC_FLUSH_MAX_ROWS", "50000"))
+    # Append-only journal of buffered rows, replayed on startup; default: next to the SQLite file.
+    traffic_journal_path: str = os.getenv("XRAY_TRAFFIC_JOURNAL_PATH", "")
+    traffic_sqlite_mmap_bytes: int = int(os.getenv("XRAY_TRAFFIC_SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))
+    traffic_sqlite_readers: int = int(os.getenv("XRAY_TRAFFIC_SQLITE_READERS", "4"))
+    # Per-user traffic limits (set via POST /user_quota) checked on every collector pass;
+    # users over their limit are removed from Xray until their total drops below it.
+    traffic_quota_enabled: bool = os.getenv("XRAY_TRAFFIC_QUOTA_ENABLED", "1").lower() in {"1", "true", "yes"}
+    # Scheduled per-user resets (set via POST /user_reset_schedule): totals are archived and zeroed
+    # from the collector pass once a user's period ends. Archived periods are kept this many days (0 - forever).
+    traffic_resets_enabled: bool = os.getenv("XRAY_TRAFFIC_RESETS_ENABLED", "1").lower() in {"1", "true", "yes"}
+    traffic_period_retention_days: float = float(os.getenv("XRAY_TRAFFIC_PERIOD_RETENTION_DAYS", "400"))
+    # Housekeeping of the snapshot store every N seconds (0 disables): drop totals of users without an
+    # active key once they have not changed for the grace period (0 keeps them), then compact the SQLite file.
+    traffic_maintenance_interval_sec: float = float(os.getenv("XRAY_TRAFFIC_MAINTENANCE_INTERVAL_SEC", "3600"))
+    traffic_prune_grace_days: float = float(os.getenv("XRAY_TRAFFIC_PRUNE_GRACE_DAYS", "30"))
 
     db_dsn: str = (
         os.getenv("XRAY_DB_DSN")
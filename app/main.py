@@ -1,5 +1,6 @@
 import logging
 from pathlib import Path
+from threading import Thread
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 
@@ -11,11 +12,21 @@ from app.middleware.prom import PromMiddleware
 
 from app.deps import SessionLocal, engine
 from app.services.xray_service import XrayService
+from app.services.xray_grpc_client import close_grpc_client
 from app.services.sync_service import SyncService
+from app.services.key_listener import KeyChangeListener
+from app.services.reconcile_scheduler import ReconcileScheduler
+from app.services.access_log_tailer import access_log_tailer
+from app.services.traffic_collector import traffic_collector
+from app.services.traffic_maintenance import TrafficStoreMaintenance
+from app.services.xray_capabilities import xray_capabilities
 
 
 setup_logging()
 logger = logging.getLogger("xray-agent")
+key_listener = KeyChangeListener() if settings.key_listener_enabled else None
+reconcile_scheduler = ReconcileScheduler() if settings.reconcile_interval_sec > 0 else None
+traffic_maintenance = TrafficStoreMaintenance() if settings.traffic_maintenance_interval_sec > 0 else None
 
 app = FastAPI(
     title=settings.service_name,
@@ -40,16 +51,48 @@ app.include_router(metrics)
 app.include_router(web)
 
 
-@app.on_event("startup")
-def startup_sync():
+def _run_startup_sync() -> None:
+    try:
+        xray_capabilities.probe()
+    except Exception as exc:
+        logger.warning("[xray-caps] startup probe failed, will retry on use: %s", exc)
+
     db = SessionLocal()
     try:
-        sync = SyncService(xray=XrayService())
+        sync = SyncService(xray=XrayService(), disabled_user_ids=traffic_collector.quota.disabled_user_ids)
         sync.startup_sync(db)
+    except Exception:
+        logger.exception("[startup-sync] crashed")
     finally:
         db.close()
 
 
+@app.on_event("startup")
+def startup_sync():
+    # Sync in the background so the API is served right away; /ready reports completion.
+    Thread(target=_run_startup_sync, name="startup-sync", daemon=True).start()
+    if key_listener is not None:
+        key_listener.start()
+    if reconcile_scheduler is not None:
+        reconcile_scheduler.start()
+    if settings.access_log_enabled:
+        access_log_tailer.start()
+    traffic_collector.start()
+    if traffic_maintenance is not None:
+        traffic_maintenance.start()
+
+
 @app.on_event("shutdown")
 def shutdown_db():
+    traffic_collector.stop()
+    if traffic_maintenance is not None:
+        traffic_maintenance.stop()
+    access_log_tailer.stop()
+    traffic_collector.persistent.close()
+    traffic_collector.history.store.close()
+    if reconcile_scheduler is not None:
+        reconcile_scheduler.stop()
+    if key_listener is not None:
+        key_listener.stop()
+    close_grpc_client()
     engine.dispose()
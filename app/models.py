@@ -1,7 +1,7 @@
 import enum
 from datetime import datetime
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, Enum, ForeignKey, BigInteger, DateTime, UniqueConstraint
+from sqlalchemy import String, Enum, ForeignKey, BigInteger, DateTime, Index, UniqueConstraint
 
 
 class Base(DeclarativeBase):
@@ -46,3 +46,33 @@ class UserTrafficSnapshot(Base):
         default=datetime.utcnow,
         onupdate=datetime.utcnow,
     )
+
+    # Traffic limit in bytes (NULL - unlimited) and when the agent took the user out of Xray for exceeding it.
+    quota_bytes: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    quota_disabled_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    # Scheduled counter resets: periods of `reset_every_months` months plus `reset_every_days` days
+    # counted from `reset_anchor_at`; the collector archives and zeroes the totals once `reset_next_at` passes.
+    reset_anchor_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    reset_every_months: Mapped[int | None] = mapped_column(nullable=True)
+    reset_every_days: Mapped[int | None] = mapped_column(nullable=True)
+    period_started_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    reset_next_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+
+class UserTrafficPeriod(Base):
+    """Totals of a finished reset period, archived when the collector zeroes them."""
+
+    __tablename__ = "vpn_user_traffic_period"
+    __table_args__ = (
+        Index("ix_vpn_user_traffic_period_server_user_end", "server_id", "user_id", "period_end"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    server_id: Mapped[int] = mapped_column()
+    user_id: Mapped[int] = mapped_column()
+    period_start: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    period_end: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    uplink: Mapped[int] = mapped_column(BigInteger, default=0)
+    downlink: Mapped[int] = mapped_column(BigInteger, default=0)
+    archived_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
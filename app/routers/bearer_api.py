@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import time
+from typing import Literal
+
 from fastapi import APIRouter, Depends, Query
 from sqlalchemy import select
 from sqlalchemy.orm import Session
@@ -7,16 +10,22 @@ from sqlalchemy.orm import Session
 from app.config import settings
 from app.deps import auth_dep, get_db
 from app.models import Key, KeyStatus
-from app.services.persistent_traffic_service import PersistentTrafficService
+from app.schemas.traffic import SetUserQuotasReq, SetUserResetSchedulesReq
 from app.services.stats_service import StatsService
-from app.services.traffic_service import TrafficService
+from app.services.traffic_collector import traffic_collector
+from app.services.traffic_rates import DEFAULT_RATE_WINDOW
 from app.utils.email import email_for_key, email_for_user_id
+from app.utils.http_errors import http_unprocessable
 
 router = APIRouter(tags=["bearer-api"], dependencies=[Depends(auth_dep)])
 
-traffic_service = TrafficService()
+traffic_service = traffic_collector.traffic
 stats_service = StatsService()
-persistent_traffic_service = PersistentTrafficService()
+persistent_traffic_service = traffic_collector.persistent
+
+
+_HISTORY_AUTO_POINTS = 1440
+_HISTORY_MAX_POINTS = 10000
 
 
 def _active_keys(db: Session) -> list[Key]:
@@ -55,13 +64,37 @@ def user_traffic(
     if not resolved_email:
         return {"ok": False, "detail": "Could not resolve user email"}
 
+    resolved_user_id = int(active_key.user_id) if active_key else (int(user_id) if user_id else None)
+
+    collected = traffic_collector.snapshot().by_email.get(resolved_email)
+    if collected is not None and collected["user_id"] == resolved_user_id:
+        return {
+            "ok": True,
+            "server_id": settings.sync_server_id,
+            "user_id": resolved_user_id,
+            "email": resolved_email,
+            "current": {
+                "available": bool(collected["stats_available"]),
+                "uplink": int(collected["current_uplink"]),
+                "downlink": int(collected["current_downlink"]),
+                "total": int(collected["current_total"]),
+            },
+            "persisted": {
+                "uplink": int(collected["uplink"]),
+                "downlink": int(collected["downlink"]),
+                "total": int(collected["total"]),
+            },
+        }
+
+    # Not an active key on this server: not covered by the collector, read it directly.
     current = traffic_service.get_users_traffic([resolved_email]).get(
         resolved_email,
         {"available": False, "uplink": 0, "downlink": 0, "total": 0},
     )
 
-    resolved_user_id = int(active_key.user_id) if active_key else (int(user_id) if user_id else None)
-    if resolved_user_id is not None and bool(current.get("available")):
+    # In reset accounting mode counters are deltas owned by the collector; never diff them here.
+    absolute = settings.traffic_accounting_mode != "reset"
+    if absolute and resolved_user_id is not None and bool(current.get("available")):
         persisted = persistent_traffic_service.apply_snapshot(
             db,
             server_id=settings.sync_server_id,
@@ -95,6 +128,98 @@ def user_traffic(
     }
 
 
+@router.get("/user_traffic/history")
+def user_traffic_history(
+    user_id: int = Query(gt=0),
+    from_ts: int | None = Query(default=None, alias="from", ge=0),
+    to_ts: int | None = Query(default=None, alias="to", ge=0),
+    step: int | None = Query(default=None, ge=60),
+):
+    if not settings.traffic_history_enabled:
+        return {"ok": False, "detail": "Traffic history is disabled (XRAY_TRAFFIC_HISTORY_ENABLED=0)"}
+
+    end = int(to_ts if to_ts is not None else time.time())
+    start = int(from_ts if from_ts is not None else end - 86400)
+    if start >= end:
+        return {"ok": False, "detail": "from must be before to"}
+    if step is None:
+        # Finest resolution that keeps a chart readable.
+        step = next((size for size in (60, 3600) if (end - start) / size <= _HISTORY_AUTO_POINTS), 86400)
+    if step % 60:
+        return {"ok": False, "detail": "step must be a multiple of 60 seconds"}
+    if (end - start) / step > _HISTORY_MAX_POINTS:
+        return {"ok": False, "detail": f"Range too large for step {step}: more than {_HISTORY_MAX_POINTS} points"}
+
+    history = traffic_collector.history.query(
+        server_id=settings.sync_server_id,
+        user_id=user_id,
+        start=start,
+        end=end,
+        step=step,
+    )
+    return {
+        "ok": True,
+        "server_id": settings.sync_server_id,
+        "user_id": user_id,
+        **history,
+    }
+
+
+def _quota_view(user_id: int, used: int) -> dict:
+    quota = traffic_collector.quota.get(user_id)
+    limit = quota["limit_bytes"]
+    return {
+        "user_id": user_id,
+        "limit_bytes": limit,
+        "used_bytes": used,
+        "remaining_bytes": None if limit is None else max(0, limit - used),
+        "disabled": quota["disabled"],
+    }
+
+
+@router.get("/user_quota")
+def user_quota(user_id: int = Query(gt=0), db: Session = Depends(get_db)):
+    collected = traffic_collector.snapshot().by_user_id.get(user_id)
+    if collected is not None:
+        used = int(collected["total"])
+    else:
+        used = int(persistent_traffic_service.get_totals(db, server_id=settings.sync_server_id, user_id=user_id)["total"])
+    return {"ok": True, "server_id": settings.sync_server_id, **_quota_view(user_id, used)}
+
+
+@router.post("/user_quota")
+def set_user_quota(req: SetUserQuotasReq):
+    """Set traffic limits for many users at once; enforced from the next collector pass."""
+    limits = {item.user_id: item.limit_bytes for item in req.quotas}
+    traffic_collector.quota.set_limits(limits)
+    traffic_collector.refresh_soon()
+    return {"ok": True, "server_id": settings.sync_server_id, "updated": len(limits)}
+
+
+@router.get("/user_reset_schedule")
+def user_reset_schedule(user_id: int = Query(gt=0), periods: int = Query(default=12, ge=0, le=1000)):
+    """Scheduled reset of a user's totals and its archived periods, newest first."""
+    return {
+        "ok": True,
+        "server_id": settings.sync_server_id,
+        "user_id": user_id,
+        **traffic_collector.resets.get(user_id, periods=periods),
+    }
+
+
+@router.post("/user_reset_schedule")
+def set_user_reset_schedule(req: SetUserResetSchedulesReq):
+    """Set periodic reset schedules for many users at once; rolled over from the collector pass."""
+    schedules = {}
+    for idx, item in enumerate(req.schedules):
+        if item.anchor_at is not None and not (item.every_months or item.every_days):
+            raise http_unprocessable(f"schedules[{idx}]: every_months or every_days must be positive")
+        schedules[item.user_id] = None if item.anchor_at is None else (item.anchor_at, item.every_months, item.every_days)
+    traffic_collector.resets.set_schedules(schedules)
+    traffic_collector.refresh_soon()
+    return {"ok": True, "server_id": settings.sync_server_id, "updated": len(schedules)}
+
+
 @router.get("/server_load")
 def server_load():
     return {
@@ -104,30 +229,46 @@ def server_load():
 
 
 @router.get("/xray_stats")
-def xray_stats(db: Session = Depends(get_db)):
-    keys = _active_keys(db)
-    emails = [email_for_key(k) for k in keys]
-    inbound = traffic_service.get_inbound_traffic()
-    users_map = traffic_service.get_users_traffic(emails)
-    users_total = sum(int(v.get("total", 0)) for v in users_map.values())
-    users_online_map = traffic_service.get_users_online(emails, users_map)
-    online_now = sum(1 for v in users_online_map.values() if bool(v.get("online")))
+def xray_stats():
+    snap = traffic_collector.snapshot()
+    users_total = sum(int(u["current_total"]) for u in snap.users)
 
     return {
         "ok": True,
-        "server_id": settings.sync_server_id,
-        "stats_available": bool(inbound["available"]),
+        "server_id": snap.server_id,
+        "stats_available": bool(snap.inbound["available"]),
         "summary": {
-            "active_keys": len(keys),
-            "online_now": int(online_now),
-            "inbound_uplink": int(inbound["uplink"]),
-            "inbound_downlink": int(inbound["downlink"]),
-            "inbound_total": int(inbound["total"]),
+            "active_keys": int(snap.summary["active_keys"]),
+            "online_now": int(snap.summary["online_now"]),
+            "inbound_uplink": int(snap.inbound["uplink"]),
+            "inbound_downlink": int(snap.inbound["downlink"]),
+            "inbound_total": int(snap.inbound["total"]),
             "users_total": int(users_total),
         },
     }
 
 
+@router.get("/top_talkers")
+def top_talkers(
+    k: int = Query(default=10, ge=1),
+    window: Literal["instant", "1m", "5m", "15m"] = Query(default=DEFAULT_RATE_WINDOW),
+):
+    # The collector ranks only top_talkers_max_k users per window; a larger k could not be honoured.
+    if k > settings.top_talkers_max_k:
+        raise http_unprocessable(f"k must be at most {settings.top_talkers_max_k} (XRAY_TOP_TALKERS_MAX_K)")
+    snap = traffic_collector.snapshot()
+    users = snap.top_talkers.get(window, [])[:k]
+    return {
+        "ok": True,
+        "server_id": snap.server_id,
+        "ts": int(snap.ts),
+        "window": window,
+        "k": k,
+        "max_k": settings.top_talkers_max_k,
+        "users": users,
+    }
+
+
 @router.post("/reset_user_traffic")
 def reset_user_traffic(
     user_id: int | None = Query(default=None, gt=0),
@@ -156,15 +297,11 @@ def reset_user_traffic(
         return {"ok": False, "detail": "Could not resolve user email"}
 
     resolved_user_id = int(active_key.user_id) if active_key else (int(user_id) if user_id else None)
-    users_reset = traffic_service.reset_users_traffic([resolved_email])
-
-    snapshots_reset = 0
-    if resolved_user_id is not None:
-        snapshots_reset = persistent_traffic_service.reset_users(
-            db,
-            server_id=settings.sync_server_id,
-            user_ids=[resolved_user_id],
-        )
+    users_reset, snapshots_reset = traffic_collector.reset_users(
+        db,
+        emails=[resolved_email],
+        user_ids=[resolved_user_id] if resolved_user_id is not None else [],
+    )
 
     return {
         "ok": True,
@@ -1,8 +1,10 @@
 import os
 from fastapi import APIRouter
+from fastapi.responses import JSONResponse
 
 from app.config import settings
-from app.schemas.health import PingResponse, HealthResponse
+from app.schemas.health import PingResponse, HealthResponse, ReadyResponse
+from app.services.readiness import readiness
 from app.utils.mask import mask_dsn
 
 router = APIRouter(tags=["health"])
@@ -13,6 +15,18 @@ def ping():
     return {"ok": True}
 
 
+@router.get(
+    "/ready",
+    response_model=ReadyResponse,
+    responses={503: {"model": ReadyResponse, "description": "Sync to Xray not finished or some users failed"}},
+)
+def ready():
+    state = readiness.snapshot()
+    if not state["ready"]:
+        return JSONResponse(status_code=503, content=state)
+    return state
+
+
 @router.get("/health", response_model=HealthResponse)
 def health():
     missing: list[str] = []
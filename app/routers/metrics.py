@@ -17,6 +17,48 @@ LATENCY = Histogram("xray_agent_request_latency_seconds", "Request latency", ["p
 UP = Gauge("xray_agent_up", "Agent is up")
 START_TIME = Gauge("xray_agent_start_time", "Agent start time (unix seconds)")
 
+RECONCILE_RUNS = Counter("xray_agent_reconcile_runs_total", "Scheduled reconcile runs", ["result"])
+RECONCILE_LAST_DURATION = Gauge("xray_agent_reconcile_last_duration_seconds", "Duration of the last reconcile run")
+RECONCILE_DRIFT = Gauge("xray_agent_reconcile_drift", "Drift found by the last reconcile run", ["kind"])
+RECONCILE_LAST_SUCCESS = Gauge("xray_agent_reconcile_last_success_time", "Last successful reconcile (unix seconds)")
+RECONCILE_SYNC_LAG = Gauge("xray_agent_reconcile_sync_lag_seconds", "Seconds since the last successful reconcile")
+
+SUBPROCESS_LATENCY = Histogram(
+    "xray_agent_subprocess_latency_seconds",
+    "Child process (grpcurl/xray/protoc) call latency",
+    ["binary", "method"],
+)
+SUBPROCESS_FAILURES = Counter(
+    "xray_agent_subprocess_failures_total",
+    "Failed child process calls",
+    ["binary", "method", "reason"],
+)
+
+TRAFFIC_MAINTENANCE_RUNS = Counter(
+    "xray_agent_traffic_maintenance_runs_total", "Snapshot store maintenance runs", ["result"]
+)
+TRAFFIC_MAINTENANCE_LAST_DURATION = Gauge(
+    "xray_agent_traffic_maintenance_last_duration_seconds", "Duration of the last snapshot store maintenance run"
+)
+TRAFFIC_STORE_PRUNED = Counter(
+    "xray_agent_traffic_store_pruned_rows_total", "Snapshot rows removed for users without an active key"
+)
+TRAFFIC_STORE_VACUUMED_PAGES = Counter(
+    "xray_agent_traffic_store_vacuumed_pages_total", "SQLite pages returned to the filesystem"
+)
+TRAFFIC_QUOTA_ACTIONS = Counter(
+    "xray_agent_traffic_quota_actions_total", "Users removed from / re-added to Xray by quota enforcement", ["action", "result"]
+)
+TRAFFIC_QUOTA_DISABLED = Gauge("xray_agent_traffic_quota_disabled_users", "Users currently disabled for exceeding their quota")
+TRAFFIC_PERIOD_RESETS = Counter(
+    "xray_agent_traffic_period_resets_total", "User totals archived and zeroed by scheduled resets"
+)
+TRAFFIC_NEXT_RESET = Gauge(
+    "xray_agent_traffic_next_reset_timestamp_seconds", "Unix time of the earliest scheduled traffic reset (0 - none)"
+)
+TRAFFIC_STORE_BYTES = Gauge("xray_agent_traffic_store_bytes", "Size of the traffic SQLite files", ["file"])
+TRAFFIC_STORE_PAGES = Gauge("xray_agent_traffic_store_pages", "Pages of the traffic SQLite database", ["kind"])
+
 UP.set(1)
 START_TIME.set(int(time.time()))
 
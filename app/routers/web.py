@@ -14,11 +14,9 @@ from app.config import settings
 from app.deps import get_db
 from app.models import Key, KeyStatus
 from app.schemas.web import WebCreateKeyReq, WebLoginReq, WebResetTrafficReq, WebUpdateXrayConfigReq
-from app.services.stats_service import StatsService
 from app.services.xray_config_service import XrayConfigService
 from app.services.sync_service import SyncService
-from app.services.traffic_service import TrafficService
-from app.services.persistent_traffic_service import PersistentTrafficService
+from app.services.traffic_collector import traffic_collector
 from app.services.xray_service import XrayService
 from app.utils.email import email_for_key, email_for_user_id
 from app.utils.web_auth import create_session_token, get_nick_from_session, verify_credentials
@@ -27,12 +25,11 @@ from app.utils.xray_uri import build_vless_uri
 router = APIRouter(tags=["web"])
 
 SESSION_COOKIE = "xray_web_session"
-stats_service = StatsService()
-traffic_service = TrafficService()
+traffic_service = traffic_collector.traffic
 xray_service = XrayService()
-sync_service = SyncService(xray=xray_service)
+sync_service = SyncService(xray=xray_service, disabled_user_ids=traffic_collector.quota.disabled_user_ids)
 xray_cfg_service = XrayConfigService()
-persistent_traffic_service = PersistentTrafficService()
+persistent_traffic_service = traffic_collector.persistent
 
 WEB_DIR = Path(__file__).resolve().parents[1] / "web"
 PAGES_DIR = WEB_DIR / "pages"
@@ -65,11 +62,20 @@ def _management_endpoints() -> list[dict]:
     return [
         {"method": "POST", "path": "/add_user", "auth": "Bearer", "description": "Add user to Xray inbound"},
         {"method": "POST", "path": "/remove_user", "auth": "Bearer", "description": "Remove user by email"},
+        {"method": "POST", "path": "/add_users", "auth": "Bearer", "description": "Add many users in one call (per-user results)"},
+        {"method": "POST", "path": "/remove_users", "auth": "Bearer", "description": "Remove many users by email in one call"},
         {"method": "POST", "path": "/resync", "auth": "Bearer", "description": "Resync active keys from DB to Xray"},
+        {"method": "POST", "path": "/reconcile", "auth": "Bearer", "description": "Diff keys vs inbound users, apply adds/removes, drift report (?dry_run=true)"},
         {"method": "GET", "path": "/user_traffic", "auth": "Bearer", "description": "Current and persisted traffic by user_id/email"},
         {"method": "POST", "path": "/reset_user_traffic", "auth": "Bearer", "description": "Reset traffic counters for one user"},
         {"method": "GET", "path": "/server_load", "auth": "Bearer", "description": "Server load and resource usage"},
         {"method": "GET", "path": "/xray_stats", "auth": "Bearer", "description": "Xray summary: traffic, users, online"},
+        {"method": "GET", "path": "/user_traffic/history", "auth": "Bearer", "description": "Per-user traffic over time (?user_id=&from=&to=&step=)"},
+        {"method": "GET", "path": "/user_quota", "auth": "Bearer", "description": "Traffic limit, usage and disabled state of one user"},
+        {"method": "POST", "path": "/user_quota", "auth": "Bearer", "description": "Set traffic limits in bulk (null removes a limit)"},
+        {"method": "GET", "path": "/user_reset_schedule", "auth": "Bearer", "description": "Reset schedule and archived periods of one user (?user_id=&periods=12)"},
+        {"method": "POST", "path": "/user_reset_schedule", "auth": "Bearer", "description": "Set periodic traffic reset schedules in bulk (null anchor removes one)"},
+        {"method": "GET", "path": "/top_talkers", "auth": "Bearer", "description": "Top users by throughput (?k=10&window=instant|1m|5m|15m)"},
         {"method": "GET", "path": "/web/api/dashboard", "auth": "Cookie", "description": "Dashboard data including online users"},
         {"method": "POST", "path": "/web/api/keys", "auth": "Cookie", "description": "Create user key + add user in Xray"},
         {"method": "GET", "path": "/web/api/xray/settings", "auth": "Cookie", "description": "Xray and dependency status"},
@@ -176,105 +182,19 @@ def web_panel_settings_page(request: Request):
 
 
 @router.get("/web/api/dashboard", include_in_schema=False)
-def web_dashboard_api(
-    request: Request,
-    db: Session = Depends(get_db),
-):
+def web_dashboard_api(request: Request):
     nick = _api_auth_nick(request)
-    persistent_traffic_service.ensure_table(db)
-    keys = _active_keys(db)
-
-    emails = [email_for_key(k) for k in keys]
-    user_traffic = traffic_service.get_users_traffic(emails)
-    user_online = traffic_service.get_users_online(emails, user_traffic)
-    inbound = traffic_service.get_inbound_traffic()
-    traffic_by_user_id = {
-        int(k.user_id): user_traffic.get(
-            email_for_key(k), {"available": False, "uplink": 0, "downlink": 0, "total": 0}
-        )
-        for k in keys
-    }
-    persisted_by_user_id = persistent_traffic_service.apply_snapshots_bulk(
-        db,
-        server_id=settings.sync_server_id,
-        snapshots=[
-            {
-                "user_id": int(k.user_id),
-                "email": email_for_key(k),
-                "available": bool(traffic_by_user_id[int(k.user_id)]["available"]),
-                "current_uplink": int(traffic_by_user_id[int(k.user_id)]["uplink"]),
-                "current_downlink": int(traffic_by_user_id[int(k.user_id)]["downlink"]),
-            }
-            for k in keys
-        ],
-    )
-
-    users = []
-    total_user_up = 0
-    total_user_down = 0
-    online_now = 0
-    online_supported_users = 0
-    stats_available = inbound["available"]
-
-    for k in keys:
-        email = email_for_key(k)
-        traffic = traffic_by_user_id.get(int(k.user_id), {"available": False, "uplink": 0, "downlink": 0, "total": 0})
-        stats_available = stats_available or traffic["available"]
-        persisted = persisted_by_user_id.get(int(k.user_id), {"uplink": 0, "downlink": 0, "total": 0})
-
-        total_user_up += int(persisted["uplink"])
-        total_user_down += int(persisted["downlink"])
-        online_data = user_online.get(email, {"supported": False, "online": False, "value": 0})
-        if bool(online_data["supported"]):
-            online_supported_users += 1
-        if bool(online_data["online"]):
-            online_now += 1
-        users.append(
-            {
-                "user_id": int(k.user_id),
-                "uuid": k.uuid,
-                "email": email,
-                "uri": k.uri,
-                "uplink": int(persisted["uplink"]),
-                "downlink": int(persisted["downlink"]),
-                "total": int(persisted["total"]),
-                "current_uplink": int(traffic["uplink"]),
-                "current_downlink": int(traffic["downlink"]),
-                "current_total": int(traffic["total"]),
-                "stats_available": bool(traffic["available"]),
-                "online": bool(online_data["online"]),
-                "online_supported": bool(online_data["supported"]),
-                "online_value": int(online_data["value"]),
-            }
-        )
-
-    db.commit()
-
-    users_sorted = sorted(users, key=lambda u: (not u["online"], -u["total"], u["user_id"]))
-    top_users = sorted(users, key=lambda u: u["total"], reverse=True)[:5]
+    snap = traffic_collector.snapshot()
 
     return {
         "ok": True,
         "nick": nick,
-        "server_id": settings.sync_server_id,
-        "stats_available": stats_available,
-        "server": stats_service.get_stats().__dict__,
-        "summary": {
-            "active_keys": len(keys),
-            "online_now": online_now,
-            "offline_now": max(len(keys) - online_now, 0),
-            "online_supported_users": online_supported_users,
-            "online_ratio_percent": round((online_now / len(keys) * 100.0), 1) if keys else 0.0,
-            "inbound_uplink": int(inbound["uplink"]),
-            "inbound_downlink": int(inbound["downlink"]),
-            "inbound_total": int(inbound["total"]),
-            "users_uplink": total_user_up,
-            "users_downlink": total_user_down,
-            "users_total": total_user_up + total_user_down,
-            "avg_user_total": int((total_user_up + total_user_down) / len(keys)) if keys else 0,
-        },
-        "users": users_sorted,
-        "top_users": top_users,
+        "server_id": snap.server_id,
+        "stats_available": snap.stats_available,
+        "server": snap.server,
+        "summary": snap.summary,
+        "users": snap.users_sorted,
+        "top_users": snap.top_users,
     }
 
 
@@ -291,10 +211,7 @@ def web_dashboard_reset_users_traffic(request: Request, db: Session = Depends(ge
     keys = _active_keys(db)
     emails = [email_for_key(k) for k in keys]
     user_ids = [int(k.user_id) for k in keys]
-    users_reset = traffic_service.reset_users_traffic(emails)
-    snapshots_reset = persistent_traffic_service.reset_users(
-        db, server_id=settings.sync_server_id, user_ids=user_ids
-    )
+    users_reset, snapshots_reset = traffic_collector.reset_users(db, emails=emails, user_ids=user_ids)
     return {
         "ok": True,
         "users": users_reset,
@@ -342,6 +259,7 @@ def web_create_key(
     db.add(key)
     db.commit()
     db.refresh(key)
+    traffic_collector.refresh_soon()
 
     return {
         "ok": True,
@@ -374,7 +292,7 @@ def web_xray_settings_api(request: Request, db: Session = Depends(get_db)):
         db_ok = False
         db_error = str(exc)
 
-    inbound = traffic_service.get_inbound_traffic()
+    inbound = traffic_collector.snapshot().inbound
     cfg_error = None
     try:
         cfg = xray_cfg_service.read_config()
@@ -479,10 +397,8 @@ def web_reset_traffic(
     if payload.scope in ("all", "inbound"):
         inbound = traffic_service.reset_inbound_traffic()
     if payload.scope in ("all", "users"):
-        users = traffic_service.reset_users_traffic(emails)
-        persistent_traffic_service.reset_users(
-            db, server_id=settings.sync_server_id, user_ids=user_ids
-        )
+        users, _ = traffic_collector.reset_users(db, emails=emails, user_ids=user_ids)
+    traffic_collector.refresh_soon()
 
     return {
         "ok": True,
@@ -493,51 +409,20 @@ def web_reset_traffic(
 
 
 @router.get("/web/api/graphs/live", include_in_schema=False)
-def web_graphs_live(request: Request, db: Session = Depends(get_db)):
+def web_graphs_live(request: Request):
     _api_auth_nick(request)
-    persistent_traffic_service.ensure_table(db)
-    keys = _active_keys(db)
-    emails = [email_for_key(k) for k in keys]
-
-    server = stats_service.get_stats()
-    inbound = traffic_service.get_inbound_traffic()
-    users_map = traffic_service.get_users_traffic(emails)
-    traffic_by_user_id = {
-        int(k.user_id): users_map.get(
-            email_for_key(k), {"available": False, "uplink": 0, "downlink": 0, "total": 0}
-        )
-        for k in keys
-    }
-    persisted_by_user_id = persistent_traffic_service.apply_snapshots_bulk(
-        db,
-        server_id=settings.sync_server_id,
-        snapshots=[
-            {
-                "user_id": int(k.user_id),
-                "email": email_for_key(k),
-                "available": bool(traffic_by_user_id[int(k.user_id)]["available"]),
-                "current_uplink": int(traffic_by_user_id[int(k.user_id)]["uplink"]),
-                "current_downlink": int(traffic_by_user_id[int(k.user_id)]["downlink"]),
-            }
-            for k in keys
-        ],
-    )
-    users_total = sum(int(v["total"]) for v in persisted_by_user_id.values())
-    users_stats_available = any(bool(v["available"]) for v in traffic_by_user_id.values()) if keys else False
-    users_online_map = traffic_service.get_users_online(emails, users_map)
-    online_now = sum(1 for v in users_online_map.values() if bool(v.get("online")))
-    db.commit()
+    snap = traffic_collector.snapshot()
 
     return {
         "ok": True,
-        "ts": int(time.time()),
-        "cpu_percent": float(server.cpu_percent),
-        "mem_percent": float(server.mem_percent),
-        "inbound_total": int(inbound["total"]),
-        "users_total": int(users_total),
-        "active_keys": len(keys),
-        "online_now": int(online_now),
-        "inbound_stats_available": bool(inbound["available"]),
-        "stats_available": bool(inbound["available"] or users_stats_available),
-        "users_stats_available": bool(users_stats_available),
+        "ts": int(snap.ts),
+        "cpu_percent": float(snap.server["cpu_percent"]),
+        "mem_percent": float(snap.server["mem_percent"]),
+        "inbound_total": int(snap.inbound["total"]),
+        "users_total": int(snap.summary["users_total"]),
+        "active_keys": int(snap.summary["active_keys"]),
+        "online_now": int(snap.summary["online_now"]),
+        "inbound_stats_available": bool(snap.inbound["available"]),
+        "stats_available": bool(snap.inbound["available"] or snap.users_stats_available),
+        "users_stats_available": bool(snap.users_stats_available),
     }
@@ -1,16 +1,20 @@
 import uuid
 import logging
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 
 from app.deps import get_db, auth_dep
+from app.config import settings
 from app.services.xray_service import XrayService
+from app.services.resync_executor import ResyncExecutor
 from app.services.sync_service import SyncService
+from app.services.traffic_collector import traffic_collector
 from app.schemas.xray import (
     AddUserReq, AddUserOK,
     RemoveUserReq, RemoveUserOK,
-    ResyncOK,
+    AddUsersReq, RemoveUsersReq, BulkUsersOK,
+    ResyncOK, ReconcileOK,
 )
 from app.utils.email import email_for_user_id
 from app.utils.http_errors import http_unprocessable
@@ -19,7 +23,7 @@ logger = logging.getLogger("xray-agent")
 router = APIRouter(tags=["xray"])
 
 xray = XrayService()
-sync = SyncService(xray=xray)
+sync = SyncService(xray=xray, disabled_user_ids=traffic_collector.quota.disabled_user_ids)
 
 
 @router.post(
@@ -35,6 +39,19 @@ def resync(db: Session = Depends(get_db)):
     return sync.resync(db)
 
 
+@router.post(
+    "/reconcile",
+    response_model=ReconcileOK,
+    dependencies=[Depends(auth_dep)],
+    responses={
+        401: {"description": "Unauthorized"},
+        500: {"description": "Xray grpc/proto error"},
+    },
+)
+def reconcile(dry_run: bool = Query(default=False), db: Session = Depends(get_db)):
+    return sync.reconcile(db, dry_run=dry_run)
+
+
 @router.post(
     "/add_user",
     response_model=AddUserOK,
@@ -78,3 +95,54 @@ def remove_user(req: RemoveUserReq):
     out = xray.remove_user(email=req.email)
     logger.info("[remove_user] OK email=%s", req.email)
     return {"ok": True, "grpc": out}
+
+
+def _bulk_response(results: list[dict]) -> dict:
+    failed = sum(1 for r in results if r["result"] == "error")
+    return {
+        "ok": failed == 0,
+        "total": len(results),
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "results": results,
+    }
+
+
+@router.post(
+    "/add_users",
+    response_model=BulkUsersOK,
+    dependencies=[Depends(auth_dep)],
+    responses={
+        401: {"description": "Unauthorized"},
+        422: {"description": "Validation error"},
+    },
+)
+def add_users(req: AddUsersReq):
+    items: list[dict] = []
+    for idx, u in enumerate(req.users):
+        email = u.email
+        if not email:
+            if u.db_user_id is None:
+                raise http_unprocessable(f"users[{idx}]: email or db_user_id is required")
+            email = email_for_user_id(u.db_user_id)
+        items.append({"email": email, "uuid": u.user_id or str(uuid.uuid4()), "level": u.level})
+
+    results = ResyncExecutor(xray, workers=settings.xray_batch_workers).add_users(items, label="add_users")
+    resp = _bulk_response(results)
+    logger.info("[add_users] total=%s failed=%s", resp["total"], resp["failed"])
+    return resp
+
+
+@router.post(
+    "/remove_users",
+    response_model=BulkUsersOK,
+    dependencies=[Depends(auth_dep)],
+    responses={
+        401: {"description": "Unauthorized"},
+    },
+)
+def remove_users(req: RemoveUsersReq):
+    results = ResyncExecutor(xray, workers=settings.xray_batch_workers).remove_users(req.emails, label="remove_users")
+    resp = _bulk_response(results)
+    logger.info("[remove_users] total=%s failed=%s", resp["total"], resp["failed"])
+    return resp
@@ -17,3 +17,14 @@ class HealthResponse(BaseModel):
     protoset: str
     service: str
     version: str
+
+
+class ReadyResponse(BaseModel):
+    ready: bool
+    state: str = Field(..., examples=["pending", "syncing", "ready", "degraded", "failed"])
+    started_at: float | None = None
+    finished_at: float | None = None
+    synced: int
+    failed: int
+    error: str | None = None
+    progress: dict | None = None
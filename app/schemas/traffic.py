@@ -0,0 +1,27 @@
+from __future__ import annotations
+
+from datetime import datetime
+
+from pydantic import BaseModel, Field
+
+
+class UserQuotaItem(BaseModel):
+    user_id: int = Field(..., gt=0, examples=[5])
+    limit_bytes: int | None = Field(default=None, ge=0, examples=[107374182400], description="null - без лимита")
+
+
+class SetUserQuotasReq(BaseModel):
+    quotas: list[UserQuotaItem] = Field(..., min_length=1, max_length=50000)
+
+
+class UserResetScheduleItem(BaseModel):
+    user_id: int = Field(..., gt=0, examples=[5])
+    anchor_at: datetime | None = Field(
+        default=None, examples=["2026-01-15T00:00:00Z"], description="начало отсчёта периодов; null - снять расписание"
+    )
+    every_months: int = Field(default=1, ge=0, le=120, examples=[1])
+    every_days: int = Field(default=0, ge=0, le=3660, examples=[0])
+
+
+class SetUserResetSchedulesReq(BaseModel):
+    schedules: list[UserResetScheduleItem] = Field(..., min_length=1, max_length=50000)
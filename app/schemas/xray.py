@@ -27,6 +27,29 @@ class RemoveUserOK(BaseModel):
     grpc: str
 
 
+class AddUsersReq(BaseModel):
+    users: list[AddUserReq] = Field(..., min_length=1, max_length=5000)
+
+
+class RemoveUsersReq(BaseModel):
+    emails: list[str] = Field(..., min_length=1, max_length=5000, examples=[["user-5@lunet", "user-6@lunet"]])
+
+
+class BulkUserItem(BaseModel):
+    email: str
+    uuid: str | None = None
+    result: str = Field(..., examples=["ok", "already", "missing", "error"])
+    error: str | None = None
+
+
+class BulkUsersOK(BaseModel):
+    ok: bool
+    total: int
+    succeeded: int
+    failed: int
+    results: list[BulkUserItem]
+
+
 class ResyncItem(BaseModel):
     uuid: str
     email: str
@@ -39,3 +62,20 @@ class ResyncOK(BaseModel):
     synced: int
     failed: list[ResyncItem]
     details: list[ResyncItem]
+
+
+class ReconcileOK(BaseModel):
+    ok: bool
+    mode: str = Field(..., examples=["reconcile", "push"])
+    dry_run: bool
+    active: int
+    live: int | None = Field(default=None, description="Users loaded in the inbound (null in push mode)")
+    in_sync: int
+    missing: list[str]
+    stale: list[str]
+    changed: list[str]
+    unmanaged: int = Field(..., description="Inbound users outside the agent's email scheme (never removed)")
+    added: list[BulkUserItem]
+    removed: list[BulkUserItem]
+    failed: list[BulkUserItem]
+    wall_time_sec: float
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import logging
+import os
+import re
+import time
+from threading import Event, Lock, Thread
+
+from app.config import settings
+from app.services.xray_config_service import XrayConfigService
+
+
+logger = logging.getLogger("xray-agent")
+
+# 2024/05/01 12:00:00.123456 from 1.2.3.4:51234 accepted tcp:example.com:443 [vless-in >> direct] email: user-1@lunet
+# Older builds omit "from " and the fraction; the source may carry a tcp:/udp: prefix or be a [v6] address.
+_LINE_RE = re.compile(
+    r"^(\d{4})/(\d{2})/(\d{2}) (\d{2}):(\d{2}):(\d{2})\S* "
+    r"(?:from )?(?:tcp:|udp:)?(\[[^\]]+\]|[^\s:]+):\d+ accepted .*?email: (\S+)"
+)
+
+_READ_CHUNK = 1 << 20
+
+
+class AccessLogTailer:
+    """Follows the Xray access log and indexes who connected, from where, and when.
+
+    Lines are parsed incrementally as Xray appends them; rotation (new inode
+    or truncation) reopens the file from the start. On start the last
+    `XRAY_ACCESS_LOG_BACKFILL_BYTES` of the log are replayed with their own
+    timestamps, so state survives an agent restart. The index holds, per
+    email, the last-seen time and the last-seen time of each source IP;
+    entries older than the IP window are pruned.
+    """
+
+    def __init__(self, path: str | None = None, *, poll_sec: float = 0.5):
+        self._path = path
+        self.poll_sec = poll_sec
+        self._lock = Lock()
+        # email -> (last_seen, {ip: last_seen})
+        self._seen: dict[str, tuple[float, dict[str, float]]] = {}
+        self._stop = Event()
+        self._thread: Thread | None = None
+        self._ts_cache: tuple[tuple[str, ...], float] | None = None
+        self.lines_parsed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def resolve_path(self) -> str | None:
+        if self._path:
+            return self._path
+        if settings.access_log_path:
+            return settings.access_log_path
+        try:
+            cfg = XrayConfigService().read_config()
+        except Exception as exc:
+            logger.warning("[access-log] cannot read xray config: %s", exc)
+            return None
+        access = ((cfg.get("log") or {}) if isinstance(cfg, dict) else {}).get("access")
+        if not isinstance(access, str) or not access.strip() or access.strip().lower() == "none":
+            return None
+        return access.strip()
+
+    def start(self) -> bool:
+        if self.running:
+            return True
+        path = self.resolve_path()
+        if not path:
+            logger.warning("[access-log] no access log configured in xray config (log.access); tailer disabled")
+            return False
+        self._stop.clear()
+        self._thread = Thread(target=self._run, args=(path,), name="access-log-tailer", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def _timestamp(self, parts: tuple[str, ...]) -> float:
+        cached = self._ts_cache
+        if cached is not None and cached[0] == parts:
+            return cached[1]
+        y, mo, d, h, mi, s = (int(p) for p in parts)
+        ts = time.mktime((y, mo, d, h, mi, s, 0, 0, -1))
+        self._ts_cache = (parts, ts)
+        return ts
+
+    def feed(self, lines: list[str]) -> int:
+        """Index a batch of log lines; returns how many carried a user connection."""
+        parsed = 0
+        with self._lock:
+            seen = self._seen
+            for line in lines:
+                m = _LINE_RE.match(line)
+                if m is None:
+                    continue
+                ts = self._timestamp(m.group(1, 2, 3, 4, 5, 6))
+                ip = m.group(7).strip("[]")
+                email = m.group(8)
+                entry = seen.get(email)
+                if entry is None:
+                    seen[email] = (ts, {ip: ts})
+                else:
+                    ips = entry[1]
+                    if ts >= ips.get(ip, 0.0):
+                        ips[ip] = ts
+                    if ts > entry[0]:
+                        seen[email] = (ts, ips)
+                parsed += 1
+        self.lines_parsed += parsed
+        return parsed
+
+    def prune(self, now: float | None = None) -> None:
+        cutoff = (now or time.time()) - max(settings.access_log_ip_window_sec, settings.access_log_online_window_sec)
+        with self._lock:
+            for email in list(self._seen):
+                last, ips = self._seen[email]
+                if last < cutoff:
+                    del self._seen[email]
+                    continue
+                for ip in [ip for ip, ts in ips.items() if ts < cutoff]:
+                    del ips[ip]
+
+    def presence(self, emails: list[str], now: float | None = None) -> dict[str, dict]:
+        """{email: {last_seen, online, ips}} from the index; no Xray calls."""
+        now = now or time.time()
+        online_cutoff = now - settings.access_log_online_window_sec
+        ip_cutoff = now - settings.access_log_ip_window_sec
+        out: dict[str, dict] = {}
+        with self._lock:
+            for email in emails:
+                entry = self._seen.get(email)
+                if entry is None:
+                    out[email] = {"last_seen": None, "online": False, "ips": 0}
+                    continue
+                last, ips = entry
+                out[email] = {
+                    "last_seen": last,
+                    "online": last >= online_cutoff,
+                    "ips": sum(1 for ts in ips.values() if ts >= ip_cutoff),
+                }
+        return out
+
+    def _run(self, path: str) -> None:
+        fh = None
+        inode = None
+        buf = b""
+        # mtime when we last sat at EOF: a change without growth means truncated and rewritten.
+        idle_mtime: int | None = None
+        last_prune = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                if fh is None:
+                    fh = open(path, "rb")
+                    st = os.fstat(fh.fileno())
+                    if inode is None:
+                        # First open: replay the recent tail to rebuild state after a restart.
+                        fh.seek(max(0, st.st_size - settings.access_log_backfill_bytes))
+                        if fh.tell():
+                            fh.readline()  # drop the partial first line
+                    inode = st.st_ino
+                    buf = b""
+                    idle_mtime = None
+                    logger.info("[access-log] tailing %s", path)
+
+                chunk = fh.read(_READ_CHUNK)
+                if chunk:
+                    idle_mtime = None
+                    buf += chunk
+                    lines = buf.split(b"\n")
+                    buf = lines.pop()
+                    self.feed([line.decode("utf-8", errors="replace") for line in lines])
+                    if len(chunk) == _READ_CHUNK:
+                        continue
+                else:
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        st = None
+                    rewritten = (
+                        st is not None
+                        and st.st_size == fh.tell()
+                        and idle_mtime is not None
+                        and st.st_mtime_ns != idle_mtime
+                    )
+                    if st is not None and (st.st_ino != inode or st.st_size < fh.tell() or rewritten):
+                        # Rotated (moved / recreated) or truncated in place: start over on the new file.
+                        logger.info("[access-log] %s rotated, reopening", path)
+                        fh.close()
+                        fh = None
+                        inode = -1
+                        continue
+                    if st is not None:
+                        idle_mtime = st.st_mtime_ns
+
+                if time.monotonic() - last_prune >= 60:
+                    self.prune()
+                    last_prune = time.monotonic()
+            except OSError as exc:
+                logger.warning("[access-log] %s: %s", path, exc)
+                if fh is not None:
+                    fh.close()
+                    fh = None
+            self._stop.wait(self.poll_sec)
+        if fh is not None:
+            fh.close()
+
+
+access_log_tailer = AccessLogTailer()
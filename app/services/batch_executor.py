@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Sequence, TypeVar
+
+from app.config import settings
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class BatchExecutor:
+    """Runs one call per item on a bounded thread pool, preserving input order.
+
+    `fn` is expected to capture its own errors into the returned result.
+    """
+
+    def __init__(self, workers: int | None = None):
+        self.workers = max(1, int(workers or settings.xray_batch_workers))
+
+    def map(self, fn: Callable[[T], R], items: Sequence[T]) -> list[R]:
+        if not items:
+            return []
+        workers = min(self.workers, len(items))
+        if workers == 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="xray-batch") as pool:
+            return list(pool.map(fn, items))
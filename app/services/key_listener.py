@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import json
+import logging
+import select
+import time
+from threading import Event, Thread
+
+from sqlalchemy import select as sa_select
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.deps import SessionLocal, engine
+from app.models import Key, KeyStatus
+from app.services.sync_service import SyncService
+from app.services.traffic_collector import traffic_collector
+from app.services.xray_service import XrayService
+from app.utils.email import email_for_user_id
+
+
+logger = logging.getLogger("xray-agent")
+
+TRIGGER_FUNCTION = "xray_agent_notify_vpn_keys"
+TRIGGER_NAME = "xray_agent_vpn_keys_notify"
+
+_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION {TRIGGER_FUNCTION}() RETURNS trigger AS $$
+DECLARE
+    rec RECORD;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        rec := OLD;
+    ELSE
+        rec := NEW;
+    END IF;
+    IF TG_OP = 'UPDATE'
+        AND NEW.status IS NOT DISTINCT FROM OLD.status
+        AND NEW.uuid IS NOT DISTINCT FROM OLD.uuid
+        AND NEW.server_id IS NOT DISTINCT FROM OLD.server_id
+        AND NEW.user_id IS NOT DISTINCT FROM OLD.user_id THEN
+        RETURN NULL;
+    END IF;
+    PERFORM pg_notify(TG_ARGV[0], json_build_object(
+        'op', TG_OP,
+        'id', rec.id,
+        'user_id', rec.user_id,
+        'server_id', rec.server_id,
+        'uuid', rec.uuid,
+        'status', rec.status::text,
+        'old_user_id', CASE WHEN TG_OP = 'UPDATE' THEN OLD.user_id END,
+        'old_server_id', CASE WHEN TG_OP = 'UPDATE' THEN OLD.server_id END,
+        'old_uuid', CASE WHEN TG_OP = 'UPDATE' THEN OLD.uuid END
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+class KeyChangeListener:
+    """Applies vpn_keys changes to Xray as soon as Postgres NOTIFYs them.
+
+    Optionally installs an AFTER INSERT/UPDATE/DELETE trigger on vpn_keys that
+    publishes changed rows on `settings.key_listener_channel`. Events are
+    filtered to `settings.sync_server_id`, grouped per user and resolved
+    against the current DB state, so duplicates and reordering are harmless.
+    After every (re)connect a reconcile pass covers events missed while down.
+    """
+
+    def __init__(self, xray: XrayService | None = None, *, channel: str | None = None):
+        self.xray = xray or XrayService()
+        self.sync = SyncService(xray=self.xray, disabled_user_ids=traffic_collector.quota.disabled_user_ids)
+        self.channel = channel or settings.key_listener_channel
+        self._stop = Event()
+        self._thread: Thread | None = None
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name="key-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def install_trigger(self, cur) -> None:
+        cur.execute(_FUNCTION_SQL)
+        cur.execute("SELECT 1 FROM pg_trigger WHERE tgname = %s AND NOT tgisinternal", (TRIGGER_NAME,))
+        if cur.fetchone() is None:
+            cur.execute(
+                f"CREATE TRIGGER {TRIGGER_NAME} AFTER INSERT OR UPDATE OR DELETE ON vpn_keys "
+                f"FOR EACH ROW EXECUTE FUNCTION {TRIGGER_FUNCTION}(%s)",
+                (self.channel,),
+            )
+            logger.info("[key-listener] installed trigger %s on vpn_keys", TRIGGER_NAME)
+
+    def _connect(self):
+        """A dedicated psycopg2 connection with the engine's connect args.
+
+        LISTEN state and autocommit belong to the session, so the listener
+        never borrows a pooled connection that would later go back to the
+        pool still listening.
+        """
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        return engine.dialect.connect(*cargs, **cparams)
+
+    def _run(self) -> None:
+        backoff = 1.0
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    if settings.key_listener_install_trigger:
+                        self.install_trigger(cur)
+                    cur.execute(f'LISTEN "{self.channel}"')
+                logger.info("[key-listener] listening on channel=%s server_id=%s", self.channel, settings.sync_server_id)
+
+                self._catch_up()
+                backoff = 1.0
+
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    events = []
+                    while conn.notifies:
+                        events.append(conn.notifies.pop(0))
+                    if events:
+                        self.handle_payloads([e.payload for e in events])
+            except Exception as exc:
+                logger.error("[key-listener] connection error: %s; retry in %.0fs", exc, backoff)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _catch_up(self) -> None:
+        db = SessionLocal()
+        try:
+            # Same rule as the reconcile scheduler: stale users are only removed in reconcile mode.
+            self.sync.reconcile(db, removals=settings.sync_mode == "reconcile")
+        except Exception as exc:
+            logger.error("[key-listener] catch-up reconcile failed: %s", exc)
+        finally:
+            db.close()
+
+    def handle_payloads(self, payloads: list[str]) -> None:
+        sid = int(settings.sync_server_id)
+        user_ids: set[int] = set()
+        for payload in payloads:
+            try:
+                event = json.loads(payload)
+            except ValueError:
+                logger.warning("[key-listener] bad payload: %r", payload)
+                continue
+            for uid_key, sid_key in (("user_id", "server_id"), ("old_user_id", "old_server_id")):
+                if event.get(sid_key) is not None and int(event[sid_key]) == sid and event.get(uid_key) is not None:
+                    user_ids.add(int(event[uid_key]))
+
+        if not user_ids:
+            return
+
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            self.apply_users(db, user_ids)
+        finally:
+            db.close()
+        logger.info(
+            "[key-listener] applied %s event(s) for %s user(s) in %.3fs",
+            len(payloads), len(user_ids), time.perf_counter() - started,
+        )
+
+    def apply_users(self, db: Session, user_ids: set[int]) -> None:
+        """Make Xray match the DB for the given users: remove them, then re-add the active key.
+
+        Every event may change which key is current without touching a uuid
+        (a rotation inserts the new key and then revokes the old one), and
+        Xray answers "already exists" to an add whatever uuid it holds, so
+        each user is re-added from scratch. A user with several active keys
+        gets the newest one, as in SyncService.get_active_keys. Users
+        disabled by their traffic quota count as having no active key.
+        """
+        active = {
+            int(k.user_id): k
+            for k in db.execute(
+                sa_select(Key).where(
+                    Key.user_id.in_(list(user_ids)),
+                    Key.status == KeyStatus.active,
+                    Key.server_id == settings.sync_server_id,
+                ).order_by(Key.id)
+            ).scalars().all()
+        }
+        for uid in self.sync.disabled_user_ids() & set(active):
+            del active[uid]
+
+        to_remove = [email_for_user_id(uid) for uid in sorted(user_ids)]
+        to_add = [
+            {"email": email_for_user_id(uid), "uuid": k.uuid, "level": 0}
+            for uid, k in sorted(active.items())
+        ]
+        if to_remove:
+            self.sync.executor.remove_users(to_remove, label="key-listener-remove")
+        if to_add:
+            self.sync.executor.add_users(to_add, label="key-listener-add")
+
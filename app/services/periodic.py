@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import logging
+import random
+from threading import Event, Lock, Thread
+from typing import Callable
+
+
+logger = logging.getLogger("xray-agent")
+
+
+class PeriodicTask:
+    """Runs `fn` every `interval_sec` (+/- `jitter_sec`) on a daemon thread.
+
+    A run is skipped, not queued, while the previous one (or a manual
+    `run_now`) is still in progress.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[], object],
+        *,
+        interval_sec: float,
+        jitter_sec: float = 0.0,
+        initial_delay_sec: float | None = None,
+        on_skip: Callable[[], object] | None = None,
+    ):
+        self.name = name
+        self.fn = fn
+        self.interval_sec = max(0.1, float(interval_sec))
+        self.jitter_sec = max(0.0, float(jitter_sec))
+        self.initial_delay_sec = self.interval_sec if initial_delay_sec is None else max(0.0, float(initial_delay_sec))
+        self.on_skip = on_skip
+        self._busy = Lock()
+        self._stop = Event()
+        self._wake = Event()
+        self._thread: Thread | None = None
+
+    def _next_delay(self) -> float:
+        if not self.jitter_sec:
+            return self.interval_sec
+        return max(0.1, self.interval_sec + random.uniform(-self.jitter_sec, self.jitter_sec))
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+
+    def trigger(self) -> None:
+        """Wake the loop to run as soon as possible instead of waiting out the interval."""
+        self._wake.set()
+
+    @property
+    def running(self) -> bool:
+        return self._busy.locked()
+
+    def run_now(self) -> bool:
+        """Run once in the caller's thread; False if a run is already in progress."""
+        if not self._busy.acquire(blocking=False):
+            logger.info("[%s] previous run still in progress, skipping", self.name)
+            if self.on_skip is not None:
+                self.on_skip()
+            return False
+        try:
+            self.fn()
+        except Exception:
+            logger.exception("[%s] run failed", self.name)
+        finally:
+            self._busy.release()
+        return True
+
+    def _loop(self) -> None:
+        delay = self.initial_delay_sec
+        while not self._stop.is_set():
+            self._wake.wait(delay)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self.run_now()
+            delay = self._next_delay()
@@ -1,26 +1,144 @@
 from __future__ import annotations
 
 import sqlite3
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
+from queue import Empty, LifoQueue
 from threading import RLock
 
 from sqlalchemy.orm import Session
 
 from app.config import settings
+from app.utils.email import email_for_user_id
+from app.utils.periods import period_bounds
+
+
+# Bound parameters per statement when the connection cannot report its limit
+# (Python < 3.11); SQLite builds before 3.32 cap it at 999.
+_MAX_VARIABLES = 999
+
+
+# Columns added after the first release, for files created before them.
+_ADDED_COLUMNS = (
+    ("quota_bytes", "INTEGER"),
+    ("quota_disabled_at", "TEXT"),
+    ("reset_anchor_at", "TEXT"),
+    ("reset_every_months", "INTEGER"),
+    ("reset_every_days", "INTEGER"),
+    ("period_started_at", "TEXT"),
+    ("reset_next_at", "TEXT"),
+)
+
+
+def _ts(value: datetime | None) -> str | None:
+    return None if value is None else value.astimezone(timezone.utc).isoformat()
+
+
+def _dt(value: str | None) -> datetime | None:
+    return None if value is None else datetime.fromisoformat(value)
+
+
+def _max_variables(conn: sqlite3.Connection) -> int:
+    getlimit = getattr(conn, "getlimit", None)
+    if getlimit is None:
+        return _MAX_VARIABLES
+    return int(getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER))
 
 
 class PersistentTrafficService:
+    """Per-user traffic totals in a local SQLite file.
+
+    One long-lived writer connection (serialized by `_lock`) and a small pool
+    of read-only connections. The file runs in WAL mode with
+    synchronous=NORMAL and memory-mapped I/O, so readers never wait for the
+    writer and a commit is a WAL append rather than an fsync of the database.
+    """
+
     def __init__(self):
         self._table_ready = False
         self._lock = RLock()
         self._db_path = Path(settings.traffic_sqlite_path).expanduser()
-
-    def _connect(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(str(self._db_path), timeout=30)
+        self._writer: sqlite3.Connection | None = None
+        self._readers: LifoQueue[sqlite3.Connection] = LifoQueue()
+        self._all_readers: list[sqlite3.Connection] = []
+
+    def _open(self, *, readonly: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            str(self._db_path),
+            timeout=30,
+            check_same_thread=False,
+            cached_statements=256,
+        )
         conn.row_factory = sqlite3.Row
+        if not readonly:
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={int(settings.traffic_sqlite_mmap_bytes)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
         return conn
 
+    def _connect(self) -> sqlite3.Connection:
+        # The shared writer; callers hold self._lock while using it.
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._db_path.parent.mkdir(parents=True, exist_ok=True)
+                    self._writer = self._open()
+        return self._writer
+
+    @contextmanager
+    def _reader(self):
+        try:
+            conn = self._readers.get_nowait()
+        except Empty:
+            conn = self._open(readonly=True)
+            with self._lock:
+                self._all_readers.append(conn)
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._readers.qsize() < max(1, settings.traffic_sqlite_readers):
+                self._readers.put(conn)
+            else:
+                with self._lock:
+                    self._all_readers.remove(conn)
+                conn.close()
+
+    @contextmanager
+    def write(self):
+        """The shared writer under the store lock; commits on success, rolls back on error."""
+        with self._lock:
+            with self._connect() as conn:
+                yield conn
+
+    @contextmanager
+    def read(self):
+        """A pooled read-only connection."""
+        with self._reader() as conn:
+            yield conn
+
+    def start(self) -> None:
+        """Writes go straight to SQLite; nothing runs in the background."""
+
+    def flush(self) -> int:
+        """Writes go straight to SQLite; nothing is buffered."""
+        return 0
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._all_readers:
+                conn.close()
+            self._all_readers = []
+            self._readers = LifoQueue()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
     def ensure_table(self, db: Session | None = None) -> None:
         if self._table_ready:
             return
@@ -29,8 +147,9 @@ class PersistentTrafficService:
             if self._table_ready:
                 return
 
-            self._db_path.parent.mkdir(parents=True, exist_ok=True)
             with self._connect() as conn:
+                # Only takes effect on a new file; compact() converts older ones once.
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
                 conn.execute(
                     """
                     CREATE TABLE IF NOT EXISTS vpn_user_traffic_snapshot (
@@ -43,10 +162,43 @@ class PersistentTrafficService:
                         total_uplink INTEGER NOT NULL DEFAULT 0,
                         total_downlink INTEGER NOT NULL DEFAULT 0,
                         updated_at TEXT NOT NULL,
+                        quota_bytes INTEGER,
+                        quota_disabled_at TEXT,
+                        reset_anchor_at TEXT,
+                        reset_every_months INTEGER,
+                        reset_every_days INTEGER,
+                        period_started_at TEXT,
+                        reset_next_at TEXT,
                         UNIQUE(server_id, user_id)
                     )
                     """
                 )
+                columns = {row["name"] for row in conn.execute("PRAGMA table_info(vpn_user_traffic_snapshot)")}
+                for column, decl in _ADDED_COLUMNS:
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE vpn_user_traffic_snapshot ADD COLUMN {column} {decl}")
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS vpn_user_traffic_period (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        server_id INTEGER NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        period_start TEXT,
+                        period_end TEXT NOT NULL,
+                        uplink INTEGER NOT NULL DEFAULT 0,
+                        downlink INTEGER NOT NULL DEFAULT 0,
+                        archived_at TEXT NOT NULL
+                    )
+                    """
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_vpn_user_traffic_period_server_user_end "
+                    "ON vpn_user_traffic_period(server_id, user_id, period_end)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_vpn_user_traffic_snapshot_reset_next_at "
+                    "ON vpn_user_traffic_snapshot(server_id, reset_next_at) WHERE reset_next_at IS NOT NULL"
+                )
                 conn.execute(
                     "CREATE INDEX IF NOT EXISTS ix_vpn_user_traffic_snapshot_server_id ON vpn_user_traffic_snapshot(server_id)"
                 )
@@ -155,16 +307,15 @@ class PersistentTrafficService:
     def get_totals(self, db: Session, *, server_id: int, user_id: int) -> dict[str, int]:
         self.ensure_table(db)
 
-        with self._lock:
-            with self._connect() as conn:
-                row = conn.execute(
-                    """
-                    SELECT total_uplink, total_downlink
-                    FROM vpn_user_traffic_snapshot
-                    WHERE server_id = ? AND user_id = ?
-                    """,
-                    (int(server_id), int(user_id)),
-                ).fetchone()
+        with self._reader() as conn:
+            row = conn.execute(
+                """
+                SELECT total_uplink, total_downlink
+                FROM vpn_user_traffic_snapshot
+                WHERE server_id = ? AND user_id = ?
+                """,
+                (int(server_id), int(user_id)),
+            ).fetchone()
 
         if row is None:
             return {"uplink": 0, "downlink": 0, "total": 0}
@@ -173,31 +324,417 @@ class PersistentTrafficService:
         downlink = int(row["total_downlink"] or 0)
         return {"uplink": uplink, "downlink": downlink, "total": uplink + downlink}
 
+    def get_totals_bulk(self, db: Session, *, server_id: int, user_ids: list[int]) -> dict[int, dict[str, int]]:
+        self.ensure_table(db)
+        if not user_ids:
+            return {}
+
+        ids = [int(uid) for uid in user_ids]
+        rows = []
+        with self._reader() as conn:
+            size = _max_variables(conn) - 1
+            for i in range(0, len(ids), size):
+                chunk = ids[i:i + size]
+                placeholders = ",".join("?" for _ in chunk)
+                rows += conn.execute(
+                    f"""
+                    SELECT user_id, total_uplink, total_downlink
+                    FROM vpn_user_traffic_snapshot
+                    WHERE server_id = ? AND user_id IN ({placeholders})
+                    """,
+                    [int(server_id), *chunk],
+                ).fetchall()
+
+        result: dict[int, dict[str, int]] = {}
+        for row in rows:
+            uplink = int(row["total_uplink"] or 0)
+            downlink = int(row["total_downlink"] or 0)
+            result[int(row["user_id"])] = {"uplink": uplink, "downlink": downlink, "total": uplink + downlink}
+        return result
+
+    def fetch_rows(self, *, server_id: int, user_ids: list[int] | None = None) -> list[tuple]:
+        """Raw rows (user_id, email, last_uplink, last_downlink, total_uplink, total_downlink, updated_at)."""
+        self.ensure_table()
+        cols = "user_id, email, last_uplink, last_downlink, total_uplink, total_downlink, updated_at"
+        rows = []
+        with self._reader() as conn:
+            if user_ids is None:
+                rows = conn.execute(
+                    f"SELECT {cols} FROM vpn_user_traffic_snapshot WHERE server_id = ?", (int(server_id),)
+                ).fetchall()
+            else:
+                ids = [int(uid) for uid in user_ids]
+                size = _max_variables(conn) - 1
+                for i in range(0, len(ids), size):
+                    chunk = ids[i:i + size]
+                    rows += conn.execute(
+                        f"""
+                        SELECT {cols} FROM vpn_user_traffic_snapshot
+                        WHERE server_id = ? AND user_id IN ({",".join("?" for _ in chunk)})
+                        """,
+                        [int(server_id), *chunk],
+                    ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def write_rows(self, rows: list[tuple]) -> None:
+        """Store absolute rows (server_id, user_id, email, last_uplink, last_downlink,
+        total_uplink, total_downlink, updated_at) in one transaction."""
+        self.ensure_table()
+        with self._lock:
+            with self._connect() as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO vpn_user_traffic_snapshot (
+                        server_id, user_id, email, last_uplink, last_downlink,
+                        total_uplink, total_downlink, updated_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(server_id, user_id) DO UPDATE SET
+                        email = excluded.email,
+                        last_uplink = excluded.last_uplink,
+                        last_downlink = excluded.last_downlink,
+                        total_uplink = excluded.total_uplink,
+                        total_downlink = excluded.total_downlink,
+                        updated_at = excluded.updated_at
+                    """,
+                    rows,
+                )
+                conn.commit()
+
     def reset_users(self, db: Session, *, server_id: int, user_ids: list[int] | None = None) -> int:
         self.ensure_table(db)
+        query = (
+            "UPDATE vpn_user_traffic_snapshot "
+            "SET last_uplink = 0, last_downlink = 0, total_uplink = 0, total_downlink = 0, updated_at = ? "
+            "WHERE server_id = ?"
+        )
+        now = datetime.now(timezone.utc).isoformat()
 
         with self._lock:
             with self._connect() as conn:
                 if user_ids:
-                    placeholders = ",".join("?" for _ in user_ids)
-                    query = (
-                        "UPDATE vpn_user_traffic_snapshot "
-                        "SET last_uplink = 0, last_downlink = 0, total_uplink = 0, total_downlink = 0, updated_at = ? "
-                        f"WHERE server_id = ? AND user_id IN ({placeholders})"
-                    )
-                    params = [datetime.now(timezone.utc).isoformat(), int(server_id), *[int(uid) for uid in user_ids]]
+                    ids = [int(uid) for uid in user_ids]
+                    size = _max_variables(conn) - 2
+                    count = 0
+                    for i in range(0, len(ids), size):
+                        chunk = ids[i:i + size]
+                        cur = conn.execute(
+                            f"{query} AND user_id IN ({','.join('?' for _ in chunk)})", [now, int(server_id), *chunk]
+                        )
+                        count += int(cur.rowcount or 0)
                 else:
-                    query = (
-                        "UPDATE vpn_user_traffic_snapshot "
-                        "SET last_uplink = 0, last_downlink = 0, total_uplink = 0, total_downlink = 0, updated_at = ? "
-                        "WHERE server_id = ?"
+                    count = int(conn.execute(query, [now, int(server_id)]).rowcount or 0)
+                conn.commit()
+                return count
+
+    def fetch_quotas(self, *, server_id: int) -> dict[int, tuple[int | None, bool]]:
+        """{user_id: (quota_bytes, disabled)} for users with a limit or the disabled flag set."""
+        self.ensure_table()
+        with self._reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT user_id, quota_bytes, quota_disabled_at FROM vpn_user_traffic_snapshot
+                WHERE server_id = ? AND (quota_bytes IS NOT NULL OR quota_disabled_at IS NOT NULL)
+                """,
+                (int(server_id),),
+            ).fetchall()
+        return {
+            int(row["user_id"]): (None if row["quota_bytes"] is None else int(row["quota_bytes"]), row["quota_disabled_at"] is not None)
+            for row in rows
+        }
+
+    def set_quotas(self, *, server_id: int, quotas: dict[int, int | None]) -> None:
+        """Set per-user limits (None removes it); users without a row get an empty one."""
+        self.ensure_table()
+        if not quotas:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            with self._connect() as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO vpn_user_traffic_snapshot (server_id, user_id, email, updated_at, quota_bytes)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(server_id, user_id) DO UPDATE SET quota_bytes = excluded.quota_bytes
+                    """,
+                    [
+                        (int(server_id), int(uid), email_for_user_id(uid), now, None if limit is None else int(limit))
+                        for uid, limit in quotas.items()
+                    ],
+                )
+                conn.commit()
+
+    def set_quota_disabled(self, *, server_id: int, user_ids: list[int], disabled: bool) -> None:
+        self.ensure_table()
+        if not user_ids:
+            return
+        stamp = datetime.now(timezone.utc).isoformat() if disabled else None
+        with self._lock:
+            with self._connect() as conn:
+                conn.executemany(
+                    "UPDATE vpn_user_traffic_snapshot SET quota_disabled_at = ? WHERE server_id = ? AND user_id = ?",
+                    [(stamp, int(server_id), int(uid)) for uid in user_ids],
+                )
+                conn.commit()
+
+    def fetch_reset_schedules(self, *, server_id: int, user_ids: list[int] | None = None) -> dict[int, dict]:
+        """{user_id: schedule} for users with a reset schedule (all of them when user_ids is None)."""
+        self.ensure_table()
+        query = (
+            "SELECT user_id, reset_anchor_at, reset_every_months, reset_every_days, period_started_at, reset_next_at "
+            "FROM vpn_user_traffic_snapshot WHERE server_id = ? AND reset_next_at IS NOT NULL"
+        )
+        rows = []
+        with self._reader() as conn:
+            if user_ids is None:
+                rows = conn.execute(query, (int(server_id),)).fetchall()
+            else:
+                ids = [int(uid) for uid in user_ids]
+                size = _max_variables(conn) - 1
+                for i in range(0, len(ids), size):
+                    chunk = ids[i:i + size]
+                    rows += conn.execute(
+                        f"{query} AND user_id IN ({','.join('?' for _ in chunk)})", [int(server_id), *chunk]
+                    ).fetchall()
+        return {
+            int(row["user_id"]): {
+                "anchor_at": _dt(row["reset_anchor_at"]),
+                "every_months": int(row["reset_every_months"] or 0),
+                "every_days": int(row["reset_every_days"] or 0),
+                "period_started_at": _dt(row["period_started_at"]),
+                "next_reset_at": _dt(row["reset_next_at"]),
+            }
+            for row in rows
+        }
+
+    def set_reset_schedules(self, *, server_id: int, schedules: dict[int, dict | None]) -> None:
+        """Store schedules as returned by fetch_reset_schedules (None clears one); users without a row get an empty one."""
+        self.ensure_table()
+        if not schedules:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        rows = []
+        for uid, item in schedules.items():
+            item = item or {}
+            rows.append((
+                int(server_id), int(uid), email_for_user_id(uid), now,
+                _ts(item.get("anchor_at")), item.get("every_months"), item.get("every_days"),
+                _ts(item.get("period_started_at")), _ts(item.get("next_reset_at")),
+            ))
+        with self._lock:
+            with self._connect() as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO vpn_user_traffic_snapshot (
+                        server_id, user_id, email, updated_at, reset_anchor_at, reset_every_months,
+                        reset_every_days, period_started_at, reset_next_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(server_id, user_id) DO UPDATE SET
+                        reset_anchor_at = excluded.reset_anchor_at,
+                        reset_every_months = excluded.reset_every_months,
+                        reset_every_days = excluded.reset_every_days,
+                        period_started_at = excluded.period_started_at,
+                        reset_next_at = excluded.reset_next_at
+                    """,
+                    rows,
+                )
+                conn.commit()
+
+    def next_reset_at(self, *, server_id: int) -> datetime | None:
+        """The earliest scheduled reset on this server, if any."""
+        self.ensure_table()
+        with self._reader() as conn:
+            row = conn.execute(
+                "SELECT MIN(reset_next_at) FROM vpn_user_traffic_snapshot WHERE server_id = ? AND reset_next_at IS NOT NULL",
+                (int(server_id),),
+            ).fetchone()
+        return _dt(row[0])
+
+    def roll_over_due(self, *, server_id: int, now: datetime) -> list[dict]:
+        """Archive and zero the totals of every user whose reset time has passed, in one transaction.
+
+        The due rows are archived with one INSERT ... SELECT and zeroed with one
+        UPDATE over the partial reset_next_at index; last_* keep the counters
+        of the last pass, so traffic after the cut still counts. Returns
+        {user_id, email, uplink, downlink, period_start, period_end, next_reset_at} per user.
+        """
+        self.ensure_table()
+        sid = int(server_id)
+        cutoff = _ts(now)
+        with self._lock:
+            with self._connect() as conn:
+                archived = conn.execute(
+                    """
+                    INSERT INTO vpn_user_traffic_period (
+                        server_id, user_id, period_start, period_end, uplink, downlink, archived_at
+                    )
+                    SELECT server_id, user_id, period_started_at, reset_next_at, total_uplink, total_downlink, ?
+                    FROM vpn_user_traffic_snapshot
+                    WHERE server_id = ? AND reset_next_at IS NOT NULL AND reset_next_at <= ?
+                    RETURNING user_id, period_start, period_end, uplink, downlink
+                    """,
+                    (cutoff, sid, cutoff),
+                ).fetchall()
+                if not archived:
+                    return []
+                zeroed = conn.execute(
+                    """
+                    UPDATE vpn_user_traffic_snapshot
+                    SET total_uplink = 0, total_downlink = 0
+                    WHERE server_id = ? AND reset_next_at IS NOT NULL AND reset_next_at <= ?
+                    RETURNING user_id, email, reset_anchor_at, reset_every_months, reset_every_days
+                    """,
+                    (sid, cutoff),
+                ).fetchall()
+                rolled = {int(row["user_id"]): row for row in zeroed}
+                result = []
+                advance = []
+                for row in archived:
+                    uid = int(row["user_id"])
+                    item = rolled[uid]
+                    # A node that was down for several periods skips straight to the current one.
+                    start, end = period_bounds(
+                        _dt(item["reset_anchor_at"]), int(item["reset_every_months"] or 0),
+                        int(item["reset_every_days"] or 0), now,
                     )
-                    params = [datetime.now(timezone.utc).isoformat(), int(server_id)]
+                    advance.append((_ts(start), _ts(end), sid, uid))
+                    result.append({
+                        "user_id": uid,
+                        "email": str(item["email"] or "") or email_for_user_id(uid),
+                        "uplink": int(row["uplink"]),
+                        "downlink": int(row["downlink"]),
+                        "period_start": _dt(row["period_start"]),
+                        "period_end": _dt(row["period_end"]),
+                        "next_reset_at": end,
+                    })
+                conn.executemany(
+                    "UPDATE vpn_user_traffic_snapshot SET period_started_at = ?, reset_next_at = ? "
+                    "WHERE server_id = ? AND user_id = ?",
+                    advance,
+                )
+                conn.commit()
+        return result
 
-                cur = conn.execute(query, params)
+    def fetch_periods(self, *, server_id: int, user_id: int, limit: int = 12) -> list[dict]:
+        """Archived periods of a user, newest first."""
+        self.ensure_table()
+        with self._reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT period_start, period_end, uplink, downlink FROM vpn_user_traffic_period
+                WHERE server_id = ? AND user_id = ?
+                ORDER BY period_end DESC LIMIT ?
+                """,
+                (int(server_id), int(user_id), int(limit)),
+            ).fetchall()
+        return [
+            {"period_start": _dt(row["period_start"]), "period_end": _dt(row["period_end"]),
+             "uplink": int(row["uplink"]), "downlink": int(row["downlink"])}
+            for row in rows
+        ]
+
+    def prune_periods(self, *, server_id: int, ended_before: datetime) -> int:
+        """Delete archived periods that ended before `ended_before`; returns how many."""
+        self.ensure_table()
+        with self._lock:
+            with self._connect() as conn:
+                cur = conn.execute(
+                    "DELETE FROM vpn_user_traffic_period WHERE server_id = ? AND period_end < ?",
+                    (int(server_id), _ts(ended_before)),
+                )
                 conn.commit()
                 return int(cur.rowcount or 0)
 
+    def prune_users(
+        self,
+        db: Session | None,
+        *,
+        server_id: int,
+        keep_user_ids: set[int],
+        updated_before: datetime,
+    ) -> list[int]:
+        """Delete rows of users outside `keep_user_ids` not updated since `updated_before`; returns their ids.
+
+        Rows holding a quota, a quota-disabled mark or a reset schedule are
+        kept: they are settings, not stale counters.
+        """
+        self.ensure_table(db)
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS traffic_prune_keep (user_id INTEGER PRIMARY KEY)")
+                conn.execute("DELETE FROM temp.traffic_prune_keep")
+                conn.executemany(
+                    "INSERT OR IGNORE INTO temp.traffic_prune_keep (user_id) VALUES (?)",
+                    [(int(uid),) for uid in keep_user_ids],
+                )
+                rows = conn.execute(
+                    """
+                    DELETE FROM vpn_user_traffic_snapshot
+                    WHERE server_id = ? AND updated_at < ?
+                      AND quota_bytes IS NULL AND quota_disabled_at IS NULL AND reset_next_at IS NULL
+                      AND user_id NOT IN (SELECT user_id FROM temp.traffic_prune_keep)
+                    RETURNING user_id
+                    """,
+                    (int(server_id), updated_before.astimezone(timezone.utc).isoformat()),
+                ).fetchall()
+                conn.execute("DELETE FROM temp.traffic_prune_keep")
+                conn.commit()
+        return [int(row[0]) for row in rows]
+
+    def compact(self) -> int:
+        """Return free pages to the filesystem, refresh planner stats and truncate the WAL.
+
+        Files created before auto_vacuum=INCREMENTAL get one full VACUUM to
+        switch them over. Returns the number of pages released.
+        """
+        self.ensure_table()
+        with self._lock:
+            conn = self._connect()
+            free_before = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+            if int(conn.execute("PRAGMA auto_vacuum").fetchone()[0]) != 2:
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            else:
+                # execute() steps the pragma once (one page); executescript() runs it to completion.
+                conn.executescript("PRAGMA incremental_vacuum;")
+            conn.execute("PRAGMA optimize")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            free_after = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+        return max(0, free_before - free_after)
+
+    def storage_stats(self) -> dict[str, int]:
+        """Size of the database file and its WAL, and page counts."""
+        self.ensure_table()
+        with self._reader() as conn:
+            page_size = int(conn.execute("PRAGMA page_size").fetchone()[0])
+            page_count = int(conn.execute("PRAGMA page_count").fetchone()[0])
+            freelist = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+        wal = self._db_path.with_name(self._db_path.name + "-wal")
+        return {
+            "file_bytes": self._db_path.stat().st_size if self._db_path.exists() else 0,
+            "wal_bytes": wal.stat().st_size if wal.exists() else 0,
+            "page_size": page_size,
+            "page_count": page_count,
+            "freelist_count": freelist,
+        }
+
+    @staticmethod
+    def _upsert_returning(conn: sqlite3.Connection, head: str, row: str, tail: str, rows: list[tuple]) -> dict[int, dict[str, int]]:
+        """Run `head VALUES row, row, ... tail` over `rows` in fixed-size chunks.
+
+        Python's executemany() drops RETURNING rows, so each chunk is one
+        multi-row statement instead; full chunks share one cached statement.
+        `tail` must return (user_id, total_uplink, total_downlink).
+        """
+        result: dict[int, dict[str, int]] = {}
+        size = max(1, _max_variables(conn) // max(1, row.count("?")))
+        for i in range(0, len(rows), size):
+            chunk = rows[i:i + size]
+            sql = f"{head} VALUES {','.join([row] * len(chunk))} {tail}"
+            params = [value for r in chunk for value in r]
+            for uid, up, down in conn.execute(sql, params).fetchall():
+                result[int(uid)] = {"uplink": int(up), "downlink": int(down), "total": int(up) + int(down)}
+        return result
+
     def apply_snapshots_bulk(
         self,
         db: Session,
@@ -205,127 +742,132 @@ class PersistentTrafficService:
         server_id: int,
         snapshots: list[dict],
     ) -> dict[int, dict[str, int]]:
+        """Fold absolute Xray counters into the totals with chunked UPSERTs.
+
+        Delta and counter-reset handling live in SQL: a counter below the last
+        seen value means Xray restarted, so the current value is the delta.
+        Unavailable users keep their last_* and totals.
+        """
         self.ensure_table(db)
         if not snapshots:
             return {}
 
-        result: dict[int, dict[str, int]] = {}
         now = datetime.now(timezone.utc).isoformat()
-        snapshots_by_user_id: dict[int, dict] = {}
+        sid = int(server_id)
+        available: dict[int, tuple] = {}
+        unavailable: dict[int, tuple] = {}
         for item in snapshots:
-            snapshots_by_user_id[int(item["user_id"])] = item
-        normalized_snapshots = list(snapshots_by_user_id.values())
-        user_ids = list(snapshots_by_user_id.keys())
+            uid = int(item["user_id"])
+            cur_up = max(0, int(item.get("current_uplink", 0) or 0))
+            cur_down = max(0, int(item.get("current_downlink", 0) or 0))
+            # New rows start with last = total = current counter, like the first snapshot always did.
+            row = (sid, uid, str(item.get("email") or ""), cur_up, cur_down, cur_up, cur_down, now)
+            # Last one wins for duplicate user ids, as one UPSERT cannot touch a row twice.
+            if bool(item.get("available")):
+                available[uid] = row
+                unavailable.pop(uid, None)
+            else:
+                unavailable[uid] = row
+                available.pop(uid, None)
+
+        head = (
+            "INSERT INTO vpn_user_traffic_snapshot ("
+            "server_id, user_id, email, last_uplink, last_downlink, total_uplink, total_downlink, updated_at)"
+        )
+        row_sql = "(?, ?, ?, ?, ?, ?, ?, ?)"
+        returning = "RETURNING user_id, total_uplink, total_downlink"
 
+        result: dict[int, dict[str, int]] = {}
         with self._lock:
             with self._connect() as conn:
-                placeholders = ",".join("?" for _ in user_ids)
-                existing_rows = conn.execute(
-                    f"""
-                    SELECT server_id, user_id, email, last_uplink, last_downlink, total_uplink, total_downlink
-                    FROM vpn_user_traffic_snapshot
-                    WHERE server_id = ? AND user_id IN ({placeholders})
-                    """,
-                    [int(server_id), *user_ids],
-                ).fetchall()
-                by_user_id = {int(row["user_id"]): row for row in existing_rows}
-
-                for item in normalized_snapshots:
-                    uid = int(item["user_id"])
-                    email = str(item.get("email") or "")
-                    cur_up = max(0, int(item.get("current_uplink", 0) or 0))
-                    cur_down = max(0, int(item.get("current_downlink", 0) or 0))
-                    available = bool(item.get("available"))
-                    row = by_user_id.get(uid)
-
-                    if row is None:
-                        try:
-                            conn.execute(
-                                """
-                                INSERT INTO vpn_user_traffic_snapshot (
-                                    server_id, user_id, email, last_uplink, last_downlink,
-                                    total_uplink, total_downlink, updated_at
-                                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                                """,
-                                (
-                                    int(server_id),
-                                    uid,
-                                    email,
-                                    cur_up,
-                                    cur_down,
-                                    cur_up,
-                                    cur_down,
-                                    now,
-                                ),
-                            )
-                            by_user_id[uid] = {
-                                "last_uplink": cur_up,
-                                "last_downlink": cur_down,
-                                "total_uplink": cur_up,
-                                "total_downlink": cur_down,
-                            }
-                            result[uid] = {
-                                "uplink": cur_up,
-                                "downlink": cur_down,
-                                "total": cur_up + cur_down,
-                            }
-                            continue
-                        except sqlite3.IntegrityError:
-                            row = conn.execute(
-                                """
-                                SELECT last_uplink, last_downlink, total_uplink, total_downlink
-                                FROM vpn_user_traffic_snapshot
-                                WHERE server_id = ? AND user_id = ?
-                                """,
-                                (int(server_id), uid),
-                            ).fetchone()
-                            if row is None:
-                                raise
-
-                    last_up = max(0, int(row["last_uplink"] or 0))
-                    last_down = max(0, int(row["last_downlink"] or 0))
-                    total_up = max(0, int(row["total_uplink"] or 0))
-                    total_down = max(0, int(row["total_downlink"] or 0))
-
-                    next_last_up = last_up
-                    next_last_down = last_down
-                    if available:
-                        delta_up = cur_up - last_up if cur_up >= last_up else cur_up
-                        delta_down = cur_down - last_down if cur_down >= last_down else cur_down
-                        total_up += max(0, delta_up)
-                        total_down += max(0, delta_down)
-                        next_last_up = cur_up
-                        next_last_down = cur_down
-
-                    conn.execute(
+                if available:
+                    result.update(self._upsert_returning(
+                        conn,
+                        head,
+                        row_sql,
                         """
-                        UPDATE vpn_user_traffic_snapshot
-                        SET email = ?,
-                            last_uplink = ?,
-                            last_downlink = ?,
-                            total_uplink = ?,
-                            total_downlink = ?,
-                            updated_at = ?
-                        WHERE server_id = ? AND user_id = ?
-                        """,
-                        (
-                            email,
-                            next_last_up,
-                            next_last_down,
-                            total_up,
-                            total_down,
-                            now,
-                            int(server_id),
-                            uid,
-                        ),
-                    )
+                        ON CONFLICT(server_id, user_id) DO UPDATE SET
+                            email = excluded.email,
+                            total_uplink = total_uplink + CASE
+                                WHEN excluded.last_uplink >= last_uplink THEN excluded.last_uplink - last_uplink
+                                ELSE excluded.last_uplink END,
+                            total_downlink = total_downlink + CASE
+                                WHEN excluded.last_downlink >= last_downlink THEN excluded.last_downlink - last_downlink
+                                ELSE excluded.last_downlink END,
+                            last_uplink = excluded.last_uplink,
+                            last_downlink = excluded.last_downlink,
+                            updated_at = excluded.updated_at
+                        """ + returning,
+                        list(available.values()),
+                    ))
+                if unavailable:
+                    result.update(self._upsert_returning(
+                        conn,
+                        head,
+                        row_sql,
+                        """
+                        ON CONFLICT(server_id, user_id) DO UPDATE SET
+                            email = excluded.email,
+                            updated_at = excluded.updated_at
+                        """ + returning,
+                        list(unavailable.values()),
+                    ))
+                conn.commit()
 
-                    result[uid] = {
-                        "uplink": total_up,
-                        "downlink": total_down,
-                        "total": total_up + total_down,
-                    }
+        return result
 
-                conn.commit()
+    def add_deltas_bulk(
+        self,
+        db: Session,
+        *,
+        server_id: int,
+        deltas: list[dict],
+    ) -> dict[int, dict[str, int]]:
+        """Add traffic pulled with reset=true straight onto the persisted totals.
+
+        `deltas` items carry user_id, email, uplink and downlink. Rows still
+        holding `last_*` values from absolute accounting subtract them once
+        (the first reset pull still contains traffic counted before) and
+        are then left at zero.
+        """
+        self.ensure_table(db)
+        if not deltas:
+            return {}
 
+        now = datetime.now(timezone.utc).isoformat()
+        merged: dict[int, list] = {}
+        for item in deltas:
+            uid = int(item["user_id"])
+            up = max(0, int(item.get("uplink", 0) or 0))
+            down = max(0, int(item.get("downlink", 0) or 0))
+            if uid in merged:
+                merged[uid][3] += up
+                merged[uid][4] += down
+            else:
+                merged[uid] = [int(server_id), uid, str(item.get("email") or ""), up, down, now]
+
+        with self._lock:
+            with self._connect() as conn:
+                result = self._upsert_returning(
+                    conn,
+                    "INSERT INTO vpn_user_traffic_snapshot ("
+                    "server_id, user_id, email, last_uplink, last_downlink, total_uplink, total_downlink, updated_at)",
+                    "(?, ?, ?, 0, 0, ?, ?, ?)",
+                    """
+                    ON CONFLICT(server_id, user_id) DO UPDATE SET
+                        email = excluded.email,
+                        total_uplink = total_uplink + CASE
+                            WHEN excluded.total_uplink >= last_uplink THEN excluded.total_uplink - last_uplink
+                            ELSE excluded.total_uplink END,
+                        total_downlink = total_downlink + CASE
+                            WHEN excluded.total_downlink >= last_downlink THEN excluded.total_downlink - last_downlink
+                            ELSE excluded.total_downlink END,
+                        last_uplink = 0,
+                        last_downlink = 0,
+                        updated_at = excluded.updated_at
+                    RETURNING user_id, total_uplink, total_downlink
+                    """,
+                    [tuple(r) for r in merged.values()],
+                )
+                conn.commit()
         return result
@@ -0,0 +1,536 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.deps import engine
+from app.models import UserTrafficPeriod, UserTrafficSnapshot
+from app.utils.email import email_for_user_id
+from app.utils.periods import period_bounds
+
+
+# Rows per INSERT statement; execute_values sends one round trip per page.
+_PAGE_SIZE = 1000
+
+_INSERT = """
+    INSERT INTO vpn_user_traffic_snapshot AS s (
+        server_id, user_id, email, last_uplink, last_downlink, total_uplink, total_downlink, updated_at
+    ) VALUES %s
+"""
+_RETURNING = "RETURNING user_id, total_uplink, total_downlink"
+
+
+class PostgresTrafficService:
+    """Per-user traffic totals in the shared Postgres table (`UserTrafficSnapshot`).
+
+    Same methods and counter rules as the SQLite PersistentTrafficService,
+    but totals survive a node rebuild and can be queried centrally. Bulk
+    writes are `INSERT ... ON CONFLICT DO UPDATE ... RETURNING` batched with
+    psycopg2 `execute_values`, so a collector pass costs one round trip per
+    `_PAGE_SIZE` users and the delta logic runs in the database.
+    """
+
+    def __init__(self, bind: Engine | None = None):
+        self.engine = bind or engine
+        self._table_ready = False
+
+    @contextmanager
+    def _cursor(self):
+        raw = self.engine.raw_connection()
+        try:
+            cur = raw.cursor()
+            try:
+                yield cur
+                raw.commit()
+            except Exception:
+                raw.rollback()
+                raise
+            finally:
+                cur.close()
+        finally:
+            raw.close()
+
+    def ensure_table(self, db: Session | None = None) -> None:
+        if self._table_ready:
+            return
+        UserTrafficSnapshot.__table__.create(bind=self.engine, checkfirst=True)
+        UserTrafficPeriod.__table__.create(bind=self.engine, checkfirst=True)
+        # Tables created before the quota and reset schedule columns existed.
+        with self._cursor() as cur:
+            cur.execute(
+                "ALTER TABLE vpn_user_traffic_snapshot "
+                "ADD COLUMN IF NOT EXISTS quota_bytes BIGINT, "
+                "ADD COLUMN IF NOT EXISTS quota_disabled_at TIMESTAMPTZ, "
+                "ADD COLUMN IF NOT EXISTS reset_anchor_at TIMESTAMPTZ, "
+                "ADD COLUMN IF NOT EXISTS reset_every_months INTEGER, "
+                "ADD COLUMN IF NOT EXISTS reset_every_days INTEGER, "
+                "ADD COLUMN IF NOT EXISTS period_started_at TIMESTAMPTZ, "
+                "ADD COLUMN IF NOT EXISTS reset_next_at TIMESTAMPTZ"
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS ix_vpn_user_traffic_snapshot_reset_next_at "
+                "ON vpn_user_traffic_snapshot (server_id, reset_next_at) WHERE reset_next_at IS NOT NULL"
+            )
+        self._table_ready = True
+
+    def start(self) -> None:
+        """Writes go straight to Postgres; nothing runs in the background."""
+
+    def flush(self) -> int:
+        """Writes go straight to Postgres; nothing is buffered."""
+        return 0
+
+    def close(self) -> None:
+        """Connections come from the shared engine, disposed on shutdown."""
+
+    @staticmethod
+    def _result(rows: list[tuple]) -> dict[int, dict[str, int]]:
+        return {
+            int(uid): {"uplink": int(up), "downlink": int(down), "total": int(up) + int(down)}
+            for uid, up, down in rows
+        }
+
+    def apply_snapshot(
+        self,
+        db: Session,
+        *,
+        server_id: int,
+        user_id: int,
+        email: str,
+        current_uplink: int,
+        current_downlink: int,
+    ) -> dict[str, int]:
+        return self.apply_snapshots_bulk(
+            db,
+            server_id=server_id,
+            snapshots=[
+                {
+                    "user_id": user_id,
+                    "email": email,
+                    "available": True,
+                    "current_uplink": current_uplink,
+                    "current_downlink": current_downlink,
+                }
+            ],
+        )[int(user_id)]
+
+    def apply_snapshots_bulk(
+        self,
+        db: Session,
+        *,
+        server_id: int,
+        snapshots: list[dict],
+    ) -> dict[int, dict[str, int]]:
+        self.ensure_table(db)
+        if not snapshots:
+            return {}
+
+        now = datetime.now(timezone.utc)
+        sid = int(server_id)
+        available: dict[int, tuple] = {}
+        unavailable: dict[int, tuple] = {}
+        for item in snapshots:
+            uid = int(item["user_id"])
+            cur_up = max(0, int(item.get("current_uplink", 0) or 0))
+            cur_down = max(0, int(item.get("current_downlink", 0) or 0))
+            row = (sid, uid, str(item.get("email") or ""), cur_up, cur_down, cur_up, cur_down, now)
+            # Last one wins for duplicate user ids, as one statement cannot touch a row twice.
+            if bool(item.get("available")):
+                available[uid] = row
+                unavailable.pop(uid, None)
+            else:
+                unavailable[uid] = row
+                available.pop(uid, None)
+
+        result: dict[int, dict[str, int]] = {}
+        with self._cursor() as cur:
+            if available:
+                result.update(self._result(execute_values(
+                    cur,
+                    _INSERT + """
+                    ON CONFLICT (server_id, user_id) DO UPDATE SET
+                        email = EXCLUDED.email,
+                        total_uplink = s.total_uplink + CASE
+                            WHEN EXCLUDED.last_uplink >= s.last_uplink THEN EXCLUDED.last_uplink - s.last_uplink
+                            ELSE EXCLUDED.last_uplink END,
+                        total_downlink = s.total_downlink + CASE
+                            WHEN EXCLUDED.last_downlink >= s.last_downlink THEN EXCLUDED.last_downlink - s.last_downlink
+                            ELSE EXCLUDED.last_downlink END,
+                        last_uplink = EXCLUDED.last_uplink,
+                        last_downlink = EXCLUDED.last_downlink,
+                        updated_at = EXCLUDED.updated_at
+                    """ + _RETURNING,
+                    list(available.values()),
+                    page_size=_PAGE_SIZE,
+                    fetch=True,
+                )))
+            if unavailable:
+                result.update(self._result(execute_values(
+                    cur,
+                    _INSERT + """
+                    ON CONFLICT (server_id, user_id) DO UPDATE SET
+                        email = EXCLUDED.email,
+                        updated_at = EXCLUDED.updated_at
+                    """ + _RETURNING,
+                    list(unavailable.values()),
+                    page_size=_PAGE_SIZE,
+                    fetch=True,
+                )))
+        return result
+
+    def add_deltas_bulk(
+        self,
+        db: Session,
+        *,
+        server_id: int,
+        deltas: list[dict],
+    ) -> dict[int, dict[str, int]]:
+        self.ensure_table(db)
+        if not deltas:
+            return {}
+
+        now = datetime.now(timezone.utc)
+        merged: dict[int, list] = {}
+        for item in deltas:
+            uid = int(item["user_id"])
+            up = max(0, int(item.get("uplink", 0) or 0))
+            down = max(0, int(item.get("downlink", 0) or 0))
+            if uid in merged:
+                merged[uid][3] += up
+                merged[uid][4] += down
+            else:
+                merged[uid] = [int(server_id), uid, str(item.get("email") or ""), up, down, now]
+
+        with self._cursor() as cur:
+            return self._result(execute_values(
+                cur,
+                _INSERT + """
+                ON CONFLICT (server_id, user_id) DO UPDATE SET
+                    email = EXCLUDED.email,
+                    total_uplink = s.total_uplink + CASE
+                        WHEN EXCLUDED.total_uplink >= s.last_uplink THEN EXCLUDED.total_uplink - s.last_uplink
+                        ELSE EXCLUDED.total_uplink END,
+                    total_downlink = s.total_downlink + CASE
+                        WHEN EXCLUDED.total_downlink >= s.last_downlink THEN EXCLUDED.total_downlink - s.last_downlink
+                        ELSE EXCLUDED.total_downlink END,
+                    last_uplink = 0,
+                    last_downlink = 0,
+                    updated_at = EXCLUDED.updated_at
+                """ + _RETURNING,
+                [tuple(r) for r in merged.values()],
+                template="(%s, %s, %s, 0, 0, %s, %s, %s)",
+                page_size=_PAGE_SIZE,
+                fetch=True,
+            ))
+
+    def get_totals(self, db: Session, *, server_id: int, user_id: int) -> dict[str, int]:
+        return self.get_totals_bulk(db, server_id=server_id, user_ids=[user_id]).get(
+            int(user_id), {"uplink": 0, "downlink": 0, "total": 0}
+        )
+
+    def get_totals_bulk(self, db: Session, *, server_id: int, user_ids: list[int]) -> dict[int, dict[str, int]]:
+        self.ensure_table(db)
+        if not user_ids:
+            return {}
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                SELECT user_id, total_uplink, total_downlink
+                FROM vpn_user_traffic_snapshot
+                WHERE server_id = %s AND user_id = ANY(%s)
+                """,
+                (int(server_id), [int(uid) for uid in user_ids]),
+            )
+            return self._result(cur.fetchall())
+
+    def reset_users(self, db: Session, *, server_id: int, user_ids: list[int] | None = None) -> int:
+        self.ensure_table(db)
+        query = (
+            "UPDATE vpn_user_traffic_snapshot "
+            "SET last_uplink = 0, last_downlink = 0, total_uplink = 0, total_downlink = 0, updated_at = %s "
+            "WHERE server_id = %s"
+        )
+        params: list = [datetime.now(timezone.utc), int(server_id)]
+        if user_ids:
+            query += " AND user_id = ANY(%s)"
+            params.append([int(uid) for uid in user_ids])
+        with self._cursor() as cur:
+            cur.execute(query, params)
+            return int(cur.rowcount or 0)
+
+    def fetch_quotas(self, *, server_id: int) -> dict[int, tuple[int | None, bool]]:
+        """{user_id: (quota_bytes, disabled)} for users with a limit or the disabled flag set."""
+        self.ensure_table()
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                SELECT user_id, quota_bytes, quota_disabled_at IS NOT NULL FROM vpn_user_traffic_snapshot
+                WHERE server_id = %s AND (quota_bytes IS NOT NULL OR quota_disabled_at IS NOT NULL)
+                """,
+                (int(server_id),),
+            )
+            return {
+                int(uid): (None if quota is None else int(quota), bool(disabled))
+                for uid, quota, disabled in cur.fetchall()
+            }
+
+    def set_quotas(self, *, server_id: int, quotas: dict[int, int | None]) -> None:
+        """Set per-user limits (None removes it); users without a row get an empty one."""
+        self.ensure_table()
+        if not quotas:
+            return
+        now = datetime.now(timezone.utc)
+        with self._cursor() as cur:
+            execute_values(
+                cur,
+                """
+                INSERT INTO vpn_user_traffic_snapshot (server_id, user_id, email, updated_at, quota_bytes,
+                    last_uplink, last_downlink, total_uplink, total_downlink)
+                VALUES %s
+                ON CONFLICT (server_id, user_id) DO UPDATE SET quota_bytes = EXCLUDED.quota_bytes
+                """,
+                [
+                    (int(server_id), int(uid), email_for_user_id(uid), now, None if limit is None else int(limit))
+                    for uid, limit in quotas.items()
+                ],
+                template="(%s, %s, %s, %s, %s, 0, 0, 0, 0)",
+                page_size=_PAGE_SIZE,
+            )
+
+    def set_quota_disabled(self, *, server_id: int, user_ids: list[int], disabled: bool) -> None:
+        self.ensure_table()
+        if not user_ids:
+            return
+        with self._cursor() as cur:
+            cur.execute(
+                "UPDATE vpn_user_traffic_snapshot SET quota_disabled_at = %s WHERE server_id = %s AND user_id = ANY(%s)",
+                (datetime.now(timezone.utc) if disabled else None, int(server_id), [int(uid) for uid in user_ids]),
+            )
+
+    def fetch_reset_schedules(self, *, server_id: int, user_ids: list[int] | None = None) -> dict[int, dict]:
+        """{user_id: schedule} for users with a reset schedule (all of them when user_ids is None)."""
+        self.ensure_table()
+        query = (
+            "SELECT user_id, reset_anchor_at, reset_every_months, reset_every_days, period_started_at, reset_next_at "
+            "FROM vpn_user_traffic_snapshot WHERE server_id = %s AND reset_next_at IS NOT NULL"
+        )
+        params: list = [int(server_id)]
+        if user_ids is not None:
+            query += " AND user_id = ANY(%s)"
+            params.append([int(uid) for uid in user_ids])
+        with self._cursor() as cur:
+            cur.execute(query, params)
+            return {
+                int(uid): {
+                    "anchor_at": anchor,
+                    "every_months": int(months or 0),
+                    "every_days": int(days or 0),
+                    "period_started_at": started,
+                    "next_reset_at": next_at,
+                }
+                for uid, anchor, months, days, started, next_at in cur.fetchall()
+            }
+
+    def set_reset_schedules(self, *, server_id: int, schedules: dict[int, dict | None]) -> None:
+        """Store schedules as returned by fetch_reset_schedules (None clears one); users without a row get an empty one."""
+        self.ensure_table()
+        if not schedules:
+            return
+        now = datetime.now(timezone.utc)
+        rows = []
+        for uid, item in schedules.items():
+            item = item or {}
+            rows.append((
+                int(server_id), int(uid), email_for_user_id(uid), now,
+                item.get("anchor_at"), item.get("every_months"), item.get("every_days"),
+                item.get("period_started_at"), item.get("next_reset_at"),
+            ))
+        with self._cursor() as cur:
+            execute_values(
+                cur,
+                """
+                INSERT INTO vpn_user_traffic_snapshot (server_id, user_id, email, updated_at, reset_anchor_at,
+                    reset_every_months, reset_every_days, period_started_at, reset_next_at,
+                    last_uplink, last_downlink, total_uplink, total_downlink)
+                VALUES %s
+                ON CONFLICT (server_id, user_id) DO UPDATE SET
+                    reset_anchor_at = EXCLUDED.reset_anchor_at,
+                    reset_every_months = EXCLUDED.reset_every_months,
+                    reset_every_days = EXCLUDED.reset_every_days,
+                    period_started_at = EXCLUDED.period_started_at,
+                    reset_next_at = EXCLUDED.reset_next_at
+                """,
+                rows,
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, 0, 0, 0, 0)",
+                page_size=_PAGE_SIZE,
+            )
+
+    def next_reset_at(self, *, server_id: int) -> datetime | None:
+        """The earliest scheduled reset on this server, if any."""
+        self.ensure_table()
+        with self._cursor() as cur:
+            cur.execute(
+                "SELECT MIN(reset_next_at) FROM vpn_user_traffic_snapshot WHERE server_id = %s AND reset_next_at IS NOT NULL",
+                (int(server_id),),
+            )
+            return cur.fetchone()[0]
+
+    def roll_over_due(self, *, server_id: int, now: datetime) -> list[dict]:
+        """Archive and zero the totals of every user whose reset time has passed.
+
+        One statement selects the due rows over the partial reset_next_at
+        index, copies them into vpn_user_traffic_period and zeroes them;
+        last_* keep the counters of the last pass, so traffic after the cut
+        still counts. The next reset times follow in the same transaction.
+        Returns {user_id, email, uplink, downlink, period_start, period_end, next_reset_at} per user.
+        """
+        self.ensure_table()
+        sid = int(server_id)
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                WITH due AS (
+                    SELECT id, user_id, period_started_at, reset_next_at, total_uplink, total_downlink
+                    FROM vpn_user_traffic_snapshot
+                    WHERE server_id = %(sid)s AND reset_next_at IS NOT NULL AND reset_next_at <= %(now)s
+                    FOR UPDATE
+                ), archived AS (
+                    INSERT INTO vpn_user_traffic_period (
+                        server_id, user_id, period_start, period_end, uplink, downlink, archived_at
+                    )
+                    SELECT %(sid)s, user_id, period_started_at, reset_next_at, total_uplink, total_downlink, %(now)s
+                    FROM due
+                )
+                UPDATE vpn_user_traffic_snapshot AS s
+                SET total_uplink = 0, total_downlink = 0
+                FROM due
+                WHERE s.id = due.id
+                RETURNING s.user_id, s.email, due.total_uplink, due.total_downlink, due.period_started_at,
+                    due.reset_next_at, s.reset_anchor_at, s.reset_every_months, s.reset_every_days
+                """,
+                {"sid": sid, "now": now},
+            )
+            result = []
+            advance = []
+            for uid, email, up, down, started, ended, anchor, months, days in cur.fetchall():
+                # A node that was down for several periods skips straight to the current one.
+                start, end = period_bounds(anchor, int(months or 0), int(days or 0), now)
+                advance.append((sid, int(uid), start, end))
+                result.append({
+                    "user_id": int(uid),
+                    "email": str(email or "") or email_for_user_id(uid),
+                    "uplink": int(up),
+                    "downlink": int(down),
+                    "period_start": started,
+                    "period_end": ended,
+                    "next_reset_at": end,
+                })
+            if advance:
+                execute_values(
+                    cur,
+                    """
+                    UPDATE vpn_user_traffic_snapshot AS s
+                    SET period_started_at = v.started, reset_next_at = v.next_at
+                    FROM (VALUES %s) AS v (server_id, user_id, started, next_at)
+                    WHERE s.server_id = v.server_id AND s.user_id = v.user_id
+                    """,
+                    advance,
+                    template="(%s, %s, %s::timestamptz, %s::timestamptz)",
+                    page_size=_PAGE_SIZE,
+                )
+            return result
+
+    def fetch_periods(self, *, server_id: int, user_id: int, limit: int = 12) -> list[dict]:
+        """Archived periods of a user, newest first."""
+        self.ensure_table()
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                SELECT period_start, period_end, uplink, downlink FROM vpn_user_traffic_period
+                WHERE server_id = %s AND user_id = %s
+                ORDER BY period_end DESC LIMIT %s
+                """,
+                (int(server_id), int(user_id), int(limit)),
+            )
+            return [
+                {"period_start": start, "period_end": end, "uplink": int(up), "downlink": int(down)}
+                for start, end, up, down in cur.fetchall()
+            ]
+
+    def prune_periods(self, *, server_id: int, ended_before: datetime) -> int:
+        """Delete archived periods that ended before `ended_before`; returns how many."""
+        self.ensure_table()
+        with self._cursor() as cur:
+            cur.execute(
+                "DELETE FROM vpn_user_traffic_period WHERE server_id = %s AND period_end < %s",
+                (int(server_id), ended_before),
+            )
+            return int(cur.rowcount or 0)
+
+    def prune_users(
+        self,
+        db: Session | None,
+        *,
+        server_id: int,
+        keep_user_ids: set[int],
+        updated_before: datetime,
+    ) -> list[int]:
+        """Delete rows of users outside `keep_user_ids` not updated since `updated_before`; returns their ids.
+
+        Rows holding a quota, a quota-disabled mark or a reset schedule are kept.
+        """
+        self.ensure_table(db)
+        with self._cursor() as cur:
+            # NOT IN over a subquery is planned as a hashed subplan; `<> ALL(array)` would scan the array per row.
+            cur.execute(
+                """
+                DELETE FROM vpn_user_traffic_snapshot
+                WHERE server_id = %s AND updated_at < %s
+                  AND quota_bytes IS NULL AND quota_disabled_at IS NULL AND reset_next_at IS NULL
+                  AND user_id NOT IN (SELECT unnest(%s::integer[]))
+                RETURNING user_id
+                """,
+                (int(server_id), updated_before, [int(uid) for uid in keep_user_ids]),
+            )
+            return [int(row[0]) for row in cur.fetchall()]
+
+    def fetch_rows(self, *, server_id: int, user_ids: list[int] | None = None) -> list[tuple]:
+        """Raw rows (user_id, email, last_uplink, last_downlink, total_uplink, total_downlink, updated_at)."""
+        self.ensure_table()
+        query = (
+            "SELECT user_id, email, last_uplink, last_downlink, total_uplink, total_downlink, updated_at "
+            "FROM vpn_user_traffic_snapshot WHERE server_id = %s"
+        )
+        params: list = [int(server_id)]
+        if user_ids is not None:
+            query += " AND user_id = ANY(%s)"
+            params.append([int(uid) for uid in user_ids])
+        with self._cursor() as cur:
+            cur.execute(query, params)
+            return [tuple(row) for row in cur.fetchall()]
+
+    def write_rows(self, rows: list[tuple]) -> None:
+        """Store absolute rows (server_id, user_id, email, last_uplink, last_downlink,
+        total_uplink, total_downlink, updated_at) in one transaction."""
+        self.ensure_table()
+        if not rows:
+            return
+        with self._cursor() as cur:
+            execute_values(
+                cur,
+                _INSERT + """
+                ON CONFLICT (server_id, user_id) DO UPDATE SET
+                    email = EXCLUDED.email,
+                    last_uplink = EXCLUDED.last_uplink,
+                    last_downlink = EXCLUDED.last_downlink,
+                    total_uplink = EXCLUDED.total_uplink,
+                    total_downlink = EXCLUDED.total_downlink,
+                    updated_at = EXCLUDED.updated_at
+                """,
+                rows,
+                page_size=_PAGE_SIZE,
+            )
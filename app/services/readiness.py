@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import time
+from threading import Lock
+
+from app.services.resync_executor import SyncProgress
+
+
+class Readiness:
+    """Tracks whether the initial Xray sync has completed.
+
+    States: pending -> syncing -> ready | degraded | failed. A sync that
+    finished with failed users is `degraded` and not ready until a later
+    sync (scheduled reconcile or manual /resync) gets every user in.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.state = "pending"
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.error: str | None = None
+        self.synced = 0
+        self.failed = 0
+        self._progress: SyncProgress | None = None
+
+    def mark_syncing(self, progress: SyncProgress) -> None:
+        with self._lock:
+            if self.state != "ready":
+                self.state = "syncing"
+            self.started_at = time.time()
+            self._progress = progress
+
+    def mark_synced(self, *, synced: int, failed: int) -> None:
+        with self._lock:
+            self.state = "degraded" if failed else "ready"
+            self.finished_at = time.time()
+            self.error = f"{int(failed)} user(s) failed to sync" if failed else None
+            self.synced = int(synced)
+            self.failed = int(failed)
+
+    def mark_failed(self, error: str) -> None:
+        with self._lock:
+            if self.state != "ready":
+                self.state = "failed"
+            self.finished_at = time.time()
+            self.error = error
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self.state == "ready",
+                "state": self.state,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "synced": self.synced,
+                "failed": self.failed,
+                "error": self.error,
+                "progress": self._progress.as_dict() if self._progress else None,
+            }
+
+
+readiness = Readiness()
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import logging
+import time
+
+from app.config import settings
+from app.deps import SessionLocal
+from app.routers.metrics import (
+    RECONCILE_DRIFT,
+    RECONCILE_LAST_DURATION,
+    RECONCILE_LAST_SUCCESS,
+    RECONCILE_RUNS,
+    RECONCILE_SYNC_LAG,
+)
+from app.services.periodic import PeriodicTask
+from app.services.readiness import readiness
+from app.services.sync_service import SyncService
+from app.services.traffic_collector import traffic_collector
+from app.services.xray_service import XrayService
+
+
+logger = logging.getLogger("xray-agent")
+
+
+class ReconcileScheduler:
+    """Periodically reconciles vpn_keys against Xray and exports drift / lag gauges.
+
+    Stale and changed users are only removed with XRAY_SYNC_MODE=reconcile;
+    in push mode a run adds missing users and just reports the rest.
+    """
+
+    def __init__(self, xray: XrayService | None = None):
+        self.sync = SyncService(xray=xray or XrayService(), disabled_user_ids=traffic_collector.quota.disabled_user_ids)
+        self.last_success: float | None = None
+        self.last_report: dict | None = None
+        self.task = PeriodicTask(
+            "reconcile-scheduler",
+            self.run_once,
+            interval_sec=settings.reconcile_interval_sec,
+            jitter_sec=settings.reconcile_jitter_sec,
+            on_skip=lambda: RECONCILE_RUNS.labels(result="skipped").inc(),
+        )
+        RECONCILE_SYNC_LAG.set_function(self._sync_lag)
+
+    def _sync_lag(self) -> float:
+        if self.last_success is None:
+            return -1.0
+        return max(0.0, time.time() - self.last_success)
+
+    def start(self) -> None:
+        self.task.start()
+
+    def stop(self) -> None:
+        self.task.stop()
+
+    def run_once(self) -> None:
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            report = self.sync.reconcile(db, removals=settings.sync_mode == "reconcile")
+        except Exception:
+            RECONCILE_RUNS.labels(result="error").inc()
+            raise
+        finally:
+            db.close()
+            RECONCILE_LAST_DURATION.set(time.perf_counter() - started)
+
+        self.last_report = report
+        for kind in ("missing", "stale", "changed"):
+            RECONCILE_DRIFT.labels(kind=kind).set(len(report[kind]))
+
+        synced = int(report["in_sync"]) + sum(1 for d in report["added"] if d["result"] in ("ok", "already"))
+        readiness.mark_synced(synced=synced, failed=len(report["failed"]))
+        if report["failed"]:
+            RECONCILE_RUNS.labels(result="partial").inc()
+            logger.warning("[reconcile-scheduler] %s operation(s) failed", len(report["failed"]))
+            return
+
+        RECONCILE_RUNS.labels(result="ok").inc()
+        self.last_success = time.time()
+        RECONCILE_LAST_SUCCESS.set(self.last_success)
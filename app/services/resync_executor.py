@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import logging
+import random
+import time
+from dataclasses import dataclass, field, fields
+from threading import Lock
+from typing import Callable
+
+from app.config import settings
+from app.services.batch_executor import BatchExecutor
+from app.services.xray_service import XrayService
+
+
+logger = logging.getLogger("xray-agent")
+
+
+@dataclass
+class SyncProgress:
+    total: int = 0
+    done: int = 0
+    ok: int = 0
+    already: int = 0
+    missing: int = 0
+    failed: int = 0
+    retries: int = 0
+    started_at: float = 0.0
+    finished_at: float | None = None
+    _lock: Lock = field(default_factory=Lock, repr=False, compare=False)
+
+    def start(self, total: int) -> None:
+        with self._lock:
+            self.total = int(total)
+            self.done = self.ok = self.already = self.missing = self.failed = self.retries = 0
+            self.started_at = time.time()
+            self.finished_at = None
+
+    def record(self, result: str) -> None:
+        with self._lock:
+            self.done += 1
+            if result == "ok":
+                self.ok += 1
+            elif result == "already":
+                self.already += 1
+            elif result == "missing":
+                self.missing += 1
+            else:
+                self.failed += 1
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def finish(self) -> None:
+        with self._lock:
+            self.finished_at = time.time()
+
+    @property
+    def running(self) -> bool:
+        return self.started_at > 0 and self.finished_at is None
+
+    @property
+    def wall_time_sec(self) -> float:
+        if not self.started_at:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.time()
+        return max(0.0, end - self.started_at)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            data = {f.name: getattr(self, f.name) for f in fields(self) if not f.name.startswith("_")}
+        data["running"] = self.running
+        data["wall_time_sec"] = round(self.wall_time_sec, 3)
+        return data
+
+
+class ResyncExecutor:
+    """Pushes add/remove operations to Xray on a bounded pool.
+
+    Every call gets its own deadline; transient failures (unavailable,
+    deadline exceeded, dial errors) are retried with exponential backoff.
+    Results come back in input order as dicts with `result` in
+    ok / already / missing / error.
+    """
+
+    def __init__(
+        self,
+        xray: XrayService,
+        *,
+        workers: int | None = None,
+        call_timeout: float | None = None,
+        attempts: int | None = None,
+        backoff: float | None = None,
+    ):
+        self.xray = xray
+        self.workers = max(1, int(workers or settings.sync_workers))
+        self.call_timeout = float(call_timeout or settings.sync_call_timeout_sec)
+        self.attempts = max(1, int(attempts or settings.sync_retry_attempts))
+        self.backoff = float(settings.sync_retry_backoff_sec if backoff is None else backoff)
+
+    def _call(self, fn: Callable[[], object], progress: SyncProgress, *, ok_marker: str) -> dict:
+        attempt = 1
+        while True:
+            try:
+                fn()
+                return {"result": "ok"}
+            except Exception as exc:
+                detail = self.xray.error_detail(exc)
+            if ok_marker == "already" and self.xray.is_already_exists_error(detail):
+                return {"result": "already"}
+            if ok_marker == "missing" and self.xray.is_not_found_error(detail):
+                return {"result": "missing"}
+            if attempt >= self.attempts or not self.xray.is_transient_error(detail):
+                return {"result": "error", "error": detail}
+            progress.record_retry()
+            delay = self.backoff * (2 ** (attempt - 1))
+            time.sleep(delay + random.uniform(0, delay / 2))
+            attempt += 1
+
+    def _run(self, items: list, one: Callable[[object], dict], progress: SyncProgress, label: str) -> list[dict]:
+        progress.start(len(items))
+        log_every = max(100, len(items) // 10)
+
+        def _wrapped(item) -> dict:
+            res = one(item)
+            progress.record(res["result"])
+            if progress.done % log_every == 0:
+                logger.info(
+                    "[%s] progress %s/%s failed=%s retries=%s",
+                    label, progress.done, progress.total, progress.failed, progress.retries,
+                )
+            return res
+
+        try:
+            return BatchExecutor(self.workers).map(_wrapped, items)
+        finally:
+            progress.finish()
+            logger.info(
+                "[%s] done total=%s ok=%s already=%s missing=%s failed=%s retries=%s wall=%.2fs",
+                label, progress.total, progress.ok, progress.already, progress.missing,
+                progress.failed, progress.retries, progress.wall_time_sec,
+            )
+
+    def add_users(self, users: list[dict], *, progress: SyncProgress | None = None, label: str = "add") -> list[dict]:
+        """Each item needs email, uuid and optionally level."""
+        progress = progress or SyncProgress()
+
+        def _add(item: dict) -> dict:
+            res = self._call(
+                lambda: self.xray.add_user(
+                    email=item["email"],
+                    level=int(item.get("level", 0)),
+                    uid=item["uuid"],
+                    timeout=self.call_timeout,
+                ),
+                progress,
+                ok_marker="already",
+            )
+            return {"email": item["email"], "uuid": item["uuid"], **res}
+
+        return self._run(users, _add, progress, label)
+
+    def remove_users(self, emails: list[str], *, progress: SyncProgress | None = None, label: str = "remove") -> list[dict]:
+        progress = progress or SyncProgress()
+
+        def _remove(email: str) -> dict:
+            res = self._call(
+                lambda: self.xray.remove_user(email=email, timeout=self.call_timeout),
+                progress,
+                ok_marker="missing",
+            )
+            return {"email": email, **res}
+
+        return self._run(emails, _remove, progress, label)
@@ -1,83 +1,202 @@
 import time
 import logging
-from typing import Any
+from typing import Any, Callable
 
-from fastapi import HTTPException
 from sqlalchemy.orm import Session
 from sqlalchemy import select
 
 from app.config import settings
 from app.models import Key, KeyStatus
+from app.services.readiness import readiness
+from app.services.resync_executor import ResyncExecutor, SyncProgress
+from app.services.xray_capabilities import xray_capabilities
 from app.services.xray_service import XrayService
-from app.utils.email import email_for_key
+from app.utils.email import email_for_key, user_id_from_email
 
 
 logger = logging.getLogger("xray-agent")
 
 
 class SyncService:
-    def __init__(self, xray: XrayService):
+    def __init__(
+        self,
+        xray: XrayService,
+        executor: ResyncExecutor | None = None,
+        *,
+        disabled_user_ids: Callable[[], set[int]] | None = None,
+    ):
+        """`disabled_user_ids` returns the users kept out of Xray (the traffic quota's); none by default."""
         self.xray = xray
+        self.executor = executor or ResyncExecutor(xray)
+        self.disabled_user_ids = disabled_user_ids or set
+        self.progress = SyncProgress()
 
     def get_active_keys(self, db: Session) -> list[Key]:
-        return db.execute(
+        """Active keys of this server that belong in Xray, one per user (users in disabled_user_ids are left out).
+
+        Xray holds one client per user email, so a user with several active
+        keys gets the newest one (highest id), the same on every run.
+        """
+        rows = db.execute(
             select(Key).where(
                 Key.status == KeyStatus.active,
                 Key.server_id == settings.sync_server_id,
-            )
+            ).order_by(Key.id)
         ).scalars().all()
+        keys = list({int(k.user_id): k for k in rows}.values())
+        disabled = self.disabled_user_ids()
+        if disabled:
+            keys = [k for k in keys if int(k.user_id) not in disabled]
+        return keys
 
-    def resync(self, db: Session) -> dict[str, Any]:
-        active = self.get_active_keys(db)
-        details: list[dict[str, Any]] = []
+    def _push_active(self, active: list[Key], *, label: str) -> list[dict[str, Any]]:
+        items = [{"email": email_for_key(k), "uuid": k.uuid, "level": 0} for k in active]
+        return self.executor.add_users(items, progress=self.progress, label=label)
 
-        logger.info("[resync] server_id=%s active=%s", settings.sync_server_id, len(active))
+    def diff(self, active: list[Key], live: dict[str, str]) -> dict[str, Any]:
+        """Compare active keys with users loaded in the inbound.
 
-        for k in active:
-            email = email_for_key(k)
-            logger.info("[resync] CANDIDATE uuid=%s email=%s", k.uuid, email)
+        Only emails in the agent's own `user-<id>@lunet` scheme are ever
+        considered stale, so users defined statically in config.json are left alone.
+        """
+        desired = {email_for_key(k): k for k in active}
+        missing = [email for email in desired if email not in live]
+        changed = [
+            email for email, k in desired.items()
+            if email in live and live[email] and live[email] != k.uuid
+        ]
+        stale = [email for email in live if email not in desired and user_id_from_email(email) is not None]
+        unmanaged = sum(1 for email in live if email not in desired and user_id_from_email(email) is None)
+        return {
+            "desired": desired,
+            "missing": missing,
+            "changed": changed,
+            "stale": stale,
+            "unmanaged": unmanaged,
+            "in_sync": len(desired) - len(missing) - len(changed),
+        }
+
+    def reconcile(self, db: Session, *, dry_run: bool = False, removals: bool = True) -> dict[str, Any]:
+        """Issue only the adds/removes needed to make the inbound match active keys.
+
+        With removals=False only missing users are added; stale and changed
+        users are reported but left in Xray. Falls back to a full push when the Xray build cannot list inbound users
+        (known from the capability probe, or learned from the first failed call).
+        """
+        started = time.time()
+        active = self.get_active_keys(db)
+        live: dict[str, str] | None = None
+        if xray_capabilities.get().inbound_users_listing:
             try:
-                self.xray.add_user(email=email, level=0, uid=k.uuid)
-                details.append({"uuid": k.uuid, "email": email, "result": "ok"})
-            except HTTPException as e:
-                if self.xray.is_already_exists_error(str(e.detail)):
-                    details.append({"uuid": k.uuid, "email": email, "result": "already"})
-                else:
-                    details.append({"uuid": k.uuid, "email": email, "result": "error", "error": str(e.detail)})
+                live = self.xray.list_inbound_users(timeout=self.executor.call_timeout)
+            except Exception as exc:
+                detail = self.xray.error_detail(exc)
+                if not self.xray.is_unsupported_error(detail):
+                    raise
+                logger.warning("[reconcile] inbound user listing unsupported, falling back to push: %s", detail)
+        if live is None:
+            details = [] if dry_run else self._push_active(active, label="reconcile-push")
+            return {
+                "ok": True,
+                "mode": "push",
+                "dry_run": dry_run,
+                "active": len(active),
+                "live": None,
+                "in_sync": sum(1 for d in details if d["result"] == "already"),
+                "missing": [],
+                "stale": [],
+                "changed": [],
+                "unmanaged": 0,
+                "added": [d for d in details if d["result"] != "already"],
+                "removed": [],
+                "failed": [d for d in details if d["result"] == "error"],
+                "wall_time_sec": round(time.time() - started, 3),
+            }
+
+        d = self.diff(active, live)
+        logger.info(
+            "[reconcile] server_id=%s active=%s live=%s missing=%s stale=%s changed=%s",
+            settings.sync_server_id, len(active), len(live), len(d["missing"]), len(d["stale"]), len(d["changed"]),
+        )
+
+        removed: list[dict[str, Any]] = []
+        added: list[dict[str, Any]] = []
+        if not dry_run:
+            # A changed uuid needs a remove before the add, so without removals those users stay as they are.
+            to_remove = d["stale"] + d["changed"] if removals else []
+            if to_remove:
+                removed = self.executor.remove_users(to_remove, label="reconcile-remove")
+                for r in removed:
+                    r["uuid"] = live.get(r["email"], "")
+            to_add = [
+                {"email": email, "uuid": d["desired"][email].uuid, "level": 0}
+                for email in d["missing"] + (d["changed"] if removals else [])
+            ]
+            if to_add:
+                added = self.executor.add_users(to_add, progress=self.progress, label="reconcile-add")
 
         return {
             "ok": True,
-            "synced": sum(1 for d in details if d["result"] in ("ok", "already")),
-            "failed": [d for d in details if d["result"] == "error"],
-            "details": details,
+            "mode": "reconcile" if removals else "push",
+            "dry_run": dry_run,
+            "active": len(active),
+            "live": len(live),
+            "in_sync": d["in_sync"],
+            "missing": d["missing"],
+            "stale": d["stale"],
+            "changed": d["changed"],
+            "unmanaged": d["unmanaged"],
+            "added": added,
+            "removed": removed,
+            "failed": [r for r in removed + added if r["result"] == "error"],
+            "wall_time_sec": round(time.time() - started, 3),
         }
 
-    def startup_sync(self, db: Session, attempts: int = 3) -> None:
-        active = self.get_active_keys(db)
-        total = len(active)
-        logger.info("[startup-sync] begin server_id=%s active=%s", settings.sync_server_id, total)
+    def resync(self, db: Session) -> dict[str, Any]:
+        if settings.sync_mode == "reconcile":
+            report = self.reconcile(db)
+            result = {
+                "ok": True,
+                "synced": report["in_sync"] + sum(1 for d in report["added"] if d["result"] in ("ok", "already")),
+                "failed": report["failed"],
+                "details": report["removed"] + report["added"],
+            }
+        else:
+            active = self.get_active_keys(db)
+
+            logger.info("[resync] server_id=%s active=%s", settings.sync_server_id, len(active))
+
+            details = self._push_active(active, label="resync")
+
+            result = {
+                "ok": True,
+                "synced": sum(1 for d in details if d["result"] in ("ok", "already")),
+                "failed": [d for d in details if d["result"] == "error"],
+                "details": details,
+            }
+
+        readiness.mark_synced(synced=result["synced"], failed=len(result["failed"]))
+        return result
 
+    def startup_sync(self, db: Session, attempts: int = 3) -> bool:
+        readiness.mark_syncing(self.progress)
         for attempt in range(1, attempts + 1):
             try:
-                synced = 0
-                for k in active:
-                    email = email_for_key(k)
-                    logger.info("[startup-sync] CANDIDATE uuid=%s email=%s", k.uuid, email)
-                    try:
-                        self.xray.add_user(email=email, level=0, uid=k.uuid)
-                        logger.info("[startup-sync] OK uuid=%s", k.uuid)
-                        synced += 1
-                    except HTTPException as e:
-                        if self.xray.is_already_exists_error(str(e.detail)):
-                            logger.info("[startup-sync] ALREADY uuid=%s", k.uuid)
-                            synced += 1
-                        else:
-                            logger.error("[startup-sync] ERR uuid=%s err=%s", k.uuid, e.detail)
-                logger.info("[startup-sync] finished attempt %s/%s synced=%s/%s", attempt, attempts, synced, total)
-                return
+                logger.info("[startup-sync] begin server_id=%s mode=%s", settings.sync_server_id, settings.sync_mode)
+                result = self.resync(db)
+                for d in result["failed"]:
+                    logger.error("[startup-sync] ERR email=%s err=%s", d["email"], d.get("error"))
+                logger.info(
+                    "[startup-sync] finished attempt %s/%s synced=%s failed=%s wall=%.2fs",
+                    attempt, attempts, result["synced"], len(result["failed"]), self.progress.wall_time_sec,
+                )
+                return True
             except Exception as e:
                 logger.error("[startup-sync] attempt %s failed: %s", attempt, e)
+                db.rollback()
                 if attempt < attempts:
                     time.sleep(2)
                 else:
                     logger.error("[startup-sync] giving up after retries")
+                    readiness.mark_failed(str(e))
+        return False
@@ -0,0 +1,382 @@
+from __future__ import annotations
+
+import logging
+import time
+from dataclasses import dataclass, field
+from threading import Lock, RLock
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.deps import SessionLocal
+from app.models import Key, KeyStatus
+from app.services.periodic import PeriodicTask
+from app.services.stats_service import StatsService
+from app.services.traffic_history_service import TrafficHistoryService
+from app.services.traffic_quota import TrafficQuotaService
+from app.services.traffic_rates import DEFAULT_RATE_WINDOW, RATE_WINDOWS, TrafficRates
+from app.services.traffic_resets import TrafficResetScheduler
+from app.services.traffic_service import TrafficService
+from app.services.traffic_store import TrafficStore, create_traffic_store, local_sqlite_store
+from app.utils.email import email_for_key, user_id_from_email
+
+
+logger = logging.getLogger("xray-agent")
+
+_EMPTY_TRAFFIC = {"available": False, "uplink": 0, "downlink": 0, "total": 0}
+_EMPTY_TOTALS = {"uplink": 0, "downlink": 0, "total": 0}
+_EMPTY_RATE = {"uplink_bps": 0.0, "downlink_bps": 0.0, "total_bps": 0.0}
+
+
+@dataclass(frozen=True)
+class TrafficSnapshot:
+    """One collector pass. Published as a whole and never mutated afterwards,
+    so routers can hand out its pieces without locking."""
+
+    ts: float
+    duration_sec: float
+    server_id: int
+    stats_available: bool
+    users_stats_available: bool
+    server: dict
+    inbound: dict
+    users: list[dict]
+    users_sorted: list[dict]
+    top_users: list[dict]
+    summary: dict
+    # window -> users by total bytes/sec, highest first (at most top_talkers_max_k).
+    top_talkers: dict[str, list[dict]] = field(repr=False)
+    by_email: dict[str, dict] = field(repr=False)
+    by_user_id: dict[int, dict] = field(repr=False)
+
+
+class TrafficCollector:
+    """Single background loop that polls Xray stats and applies them to the snapshot store.
+
+    Every `traffic_collector_interval_sec` it reads active keys, user and
+    inbound counters and online state once, applies the deltas to
+    the snapshot store in one bulk call, updates per-user throughput
+    rates (instantaneous and EWMA) from the totals, records the per-minute
+    growth in the traffic history, rolls over scheduled per-user reset
+    periods, enforces per-user quotas, and publishes a TrafficSnapshot.
+    Request handlers read `snapshot()` instead of touching Xray or SQLite.
+    """
+
+    def __init__(
+        self,
+        traffic: TrafficService | None = None,
+        persistent: TrafficStore | None = None,
+        stats: StatsService | None = None,
+    ):
+        self.traffic = traffic or TrafficService()
+        self.persistent = persistent or create_traffic_store()
+        self.stats = stats or StatsService()
+        self._snapshot: TrafficSnapshot | None = None
+        # Reset-mode deltas already taken out of Xray but not yet persisted.
+        self._pending: dict[int, dict] = {}
+        self.rates = TrafficRates(max_k=settings.top_talkers_max_k)
+        self.history = TrafficHistoryService(local_sqlite_store(self.persistent))
+        self.quota = TrafficQuotaService(self.persistent)
+        self.resets = TrafficResetScheduler(self.persistent)
+        self._first_lock = Lock()
+        # Held for a whole collect pass; resets take it too so they never interleave
+        # with a pass that read counters before the reset and writes them after.
+        self._collect_lock = RLock()
+        self.task = PeriodicTask(
+            "traffic-collector",
+            self.collect_once,
+            interval_sec=settings.traffic_collector_interval_sec,
+            initial_delay_sec=0,
+        )
+
+    def start(self) -> None:
+        self.persistent.start()
+        self.task.start()
+
+    def stop(self) -> None:
+        self.task.stop()
+
+    def refresh_soon(self) -> None:
+        self.task.trigger()
+
+    def reset_users(self, db: Session | None, *, emails: list[str], user_ids: list[int]) -> tuple[dict, int]:
+        """Reset Xray counters and persisted totals of the given users in one pass.
+
+        Runs under the collector lock, so no collect pass can interleave and
+        re-add pre-reset traffic. Returns (xray reset summary, snapshot rows reset).
+        """
+        with self._collect_lock:
+            users_reset = self.traffic.reset_users_traffic(emails)
+            snapshots_reset = 0
+            if user_ids:
+                snapshots_reset = self.persistent.reset_users(
+                    db, server_id=settings.sync_server_id, user_ids=user_ids
+                )
+                for uid in user_ids:
+                    self._pending.pop(int(uid), None)
+                self.history.forget(user_ids)
+        self.refresh_soon()
+        return users_reset, snapshots_reset
+
+    def snapshot(self) -> TrafficSnapshot:
+        snap = self._snapshot
+        if snap is not None:
+            return snap
+        # Nothing published yet (first request raced the first tick): collect inline once.
+        with self._first_lock:
+            if self._snapshot is None:
+                self.collect_once()
+            return self._snapshot
+
+    def _active_keys(self) -> list[Key]:
+        db = SessionLocal()
+        try:
+            return db.execute(
+                select(Key).where(
+                    Key.status == KeyStatus.active,
+                    Key.server_id == settings.sync_server_id,
+                )
+            ).scalars().all()
+        finally:
+            db.close()
+
+    def _pull_and_accumulate(self, keys: list[Key]) -> tuple[dict[str, dict], dict[int, dict]]:
+        """Reset-mode pass: take counters out of Xray atomically and add them to the totals.
+
+        Every managed user whose counters were zeroed is credited, not only
+        the active keys read at the start of the pass: Xray no longer holds
+        that traffic. If the store write fails, the deltas are kept and
+        retried on the next pass.
+        """
+        emails = [email_for_key(k) for k in keys]
+        try:
+            user_traffic = self.traffic.pull_users_traffic(emails)
+        except Exception as exc:
+            logger.warning("[traffic-collector] stats pull failed: %s", exc)
+            user_traffic = {email: dict(_EMPTY_TRAFFIC) for email in emails}
+
+        for email, traffic in user_traffic.items():
+            uid = user_id_from_email(email)
+            if uid is None or not traffic["available"] or not traffic["total"]:
+                continue
+            pending = self._pending.setdefault(uid, {"user_id": uid, "email": email, "uplink": 0, "downlink": 0})
+            pending["uplink"] += int(traffic["uplink"])
+            pending["downlink"] += int(traffic["downlink"])
+
+        try:
+            self.persistent.add_deltas_bulk(
+                None, server_id=settings.sync_server_id, deltas=list(self._pending.values())
+            )
+            self._pending.clear()
+        except Exception as exc:
+            logger.error(
+                "[traffic-collector] persisting %s delta(s) failed, will retry: %s", len(self._pending), exc
+            )
+        persisted = self.persistent.get_totals_bulk(
+            None, server_id=settings.sync_server_id, user_ids=[int(k.user_id) for k in keys]
+        )
+        return user_traffic, persisted
+
+    def _prime_history(self, keys: list[Key]) -> None:
+        # Totals before this pass writes, for users the history has nothing to diff against yet.
+        missing = self.history.unprimed([int(k.user_id) for k in keys])
+        if missing:
+            self.history.prime(
+                missing, self.persistent.get_totals_bulk(None, server_id=settings.sync_server_id, user_ids=missing)
+            )
+
+    def _record_history(self, persisted_by_user_id: dict[int, dict]) -> None:
+        try:
+            self.history.record(server_id=settings.sync_server_id, ts=time.time(), totals=persisted_by_user_id)
+            self.history.maintain()
+        except Exception as exc:
+            logger.warning("[traffic-collector] traffic history update failed: %s", exc)
+
+    def _roll_over_periods(self, persisted_by_user_id: dict[int, dict]) -> None:
+        """Archive and zero totals of users whose reset period ended, then zero their Xray counters.
+
+        The due users' counters are zeroed by reset_users_counters, one
+        regexp QueryStats call per 1000 users on builds that support it. The
+        store keeps last_* at the counters this pass read, so if the Xray
+        reset fails nothing is counted twice. Once it succeeds, the
+        pre-reset values it returns go through add_deltas_bulk: whatever
+        arrived after this pass read the counters (value - last_*) opens the
+        new period and last_* go to zero with the counters. Reset mode has
+        nothing left in Xray to reset.
+        """
+        try:
+            rolled = self.resets.roll_over()
+        except Exception as exc:
+            logger.warning("[traffic-collector] traffic period rollover failed, will retry: %s", exc)
+            return
+        if not rolled:
+            return
+        user_ids = [int(item["user_id"]) for item in rolled]
+        totals: dict[int, dict] = {}
+        if settings.traffic_accounting_mode != "reset":
+            reset = self.traffic.reset_users_counters([item["email"] for item in rolled])
+            if reset is not None:
+                totals = self.persistent.add_deltas_bulk(
+                    None,
+                    server_id=settings.sync_server_id,
+                    deltas=[
+                        {"user_id": int(item["user_id"]), "email": item["email"], **reset.get(item["email"], {})}
+                        for item in rolled
+                    ],
+                )
+            else:
+                logger.warning("[traffic-collector] Xray counters of %s rolled over user(s) not reset", len(user_ids))
+        self.history.forget(user_ids)
+        for uid in user_ids:
+            if uid in persisted_by_user_id:
+                persisted_by_user_id[uid] = totals.get(uid, dict(_EMPTY_TOTALS))
+
+    def _enforce_quotas(self, keys: list[Key], persisted_by_user_id: dict[int, dict]) -> None:
+        try:
+            self.quota.enforce(keys, persisted_by_user_id)
+        except Exception as exc:
+            logger.warning("[traffic-collector] quota enforcement failed: %s", exc)
+
+    def collect_once(self) -> TrafficSnapshot:
+        with self._collect_lock:
+            snap = self._collect()
+        self._snapshot = snap
+        return snap
+
+    def _collect(self) -> TrafficSnapshot:
+        started = time.perf_counter()
+        keys = self._active_keys()
+        emails = [email_for_key(k) for k in keys]
+
+        history = settings.traffic_history_enabled
+        if history:
+            self._prime_history(keys)
+
+        reset_mode = settings.traffic_accounting_mode == "reset"
+        if reset_mode:
+            user_traffic, persisted_by_user_id = self._pull_and_accumulate(keys)
+        else:
+            user_traffic = self.traffic.get_users_traffic(emails)
+        user_online = self.traffic.get_users_online(emails, user_traffic, traffic_is_delta=reset_mode)
+        inbound = self.traffic.get_inbound_traffic()
+        traffic_by_user_id = {
+            int(k.user_id): user_traffic.get(email_for_key(k), _EMPTY_TRAFFIC)
+            for k in keys
+        }
+        if not reset_mode:
+            persisted_by_user_id = self.persistent.apply_snapshots_bulk(
+                None,
+                server_id=settings.sync_server_id,
+                snapshots=[
+                    {
+                        "user_id": int(k.user_id),
+                        "email": email_for_key(k),
+                        "available": bool(traffic_by_user_id[int(k.user_id)]["available"]),
+                        "current_uplink": int(traffic_by_user_id[int(k.user_id)]["uplink"]),
+                        "current_downlink": int(traffic_by_user_id[int(k.user_id)]["downlink"]),
+                    }
+                    for k in keys
+                ],
+            )
+        if history:
+            self._record_history(persisted_by_user_id)
+        if settings.traffic_resets_enabled:
+            # After the history took this pass's growth, so it lands in the period that just ended.
+            self._roll_over_periods(persisted_by_user_id)
+        if settings.traffic_quota_enabled:
+            self._enforce_quotas(keys, persisted_by_user_id)
+        server = self.stats.get_stats().__dict__
+        rates = self.rates.update(
+            time.monotonic(),
+            {int(k.user_id): persisted_by_user_id[int(k.user_id)] for k in keys if int(k.user_id) in persisted_by_user_id},
+            {int(k.user_id): email_for_key(k) for k in keys},
+        )
+
+        users = []
+        total_user_up = 0
+        total_user_down = 0
+        online_now = 0
+        online_supported_users = 0
+        stats_available = bool(inbound["available"])
+        users_stats_available = False
+
+        for k in keys:
+            email = email_for_key(k)
+            traffic = traffic_by_user_id.get(int(k.user_id), _EMPTY_TRAFFIC)
+            stats_available = stats_available or bool(traffic["available"])
+            users_stats_available = users_stats_available or bool(traffic["available"])
+            persisted = persisted_by_user_id.get(int(k.user_id), _EMPTY_TOTALS)
+            user_rates = rates.get(int(k.user_id), {}).get("rates", {})
+            instant = user_rates.get("instant", _EMPTY_RATE)
+            smoothed = user_rates.get(DEFAULT_RATE_WINDOW, _EMPTY_RATE)
+
+            total_user_up += int(persisted["uplink"])
+            total_user_down += int(persisted["downlink"])
+            online_data = user_online.get(email, {"supported": False, "online": False, "value": 0})
+            if bool(online_data["supported"]):
+                online_supported_users += 1
+            if bool(online_data["online"]):
+                online_now += 1
+            users.append(
+                {
+                    "user_id": int(k.user_id),
+                    "uuid": k.uuid,
+                    "email": email,
+                    "uri": k.uri,
+                    "uplink": int(persisted["uplink"]),
+                    "downlink": int(persisted["downlink"]),
+                    "total": int(persisted["total"]),
+                    "current_uplink": int(traffic["uplink"]),
+                    "current_downlink": int(traffic["downlink"]),
+                    "current_total": int(traffic["total"]),
+                    "stats_available": bool(traffic["available"]),
+                    "online": bool(online_data["online"]),
+                    "online_supported": bool(online_data["supported"]),
+                    "online_value": int(online_data["value"]),
+                    "ips": int(online_data.get("ips", 0)),
+                    "last_seen": online_data.get("last_seen"),
+                    "uplink_bps": instant["uplink_bps"],
+                    "downlink_bps": instant["downlink_bps"],
+                    "uplink_bps_ewma": smoothed["uplink_bps"],
+                    "downlink_bps_ewma": smoothed["downlink_bps"],
+                }
+            )
+
+        active = len(keys)
+        summary = {
+            "active_keys": active,
+            "online_now": online_now,
+            "offline_now": max(active - online_now, 0),
+            "online_supported_users": online_supported_users,
+            "online_ratio_percent": round((online_now / active * 100.0), 1) if active else 0.0,
+            "inbound_uplink": int(inbound["uplink"]),
+            "inbound_downlink": int(inbound["downlink"]),
+            "inbound_total": int(inbound["total"]),
+            "users_uplink": total_user_up,
+            "users_downlink": total_user_down,
+            "users_total": total_user_up + total_user_down,
+            "avg_user_total": int((total_user_up + total_user_down) / active) if active else 0,
+        }
+
+        duration = time.perf_counter() - started
+        logger.debug("[traffic-collector] users=%s took %.3fs", active, duration)
+        return TrafficSnapshot(
+            ts=time.time(),
+            duration_sec=duration,
+            server_id=settings.sync_server_id,
+            stats_available=stats_available,
+            users_stats_available=users_stats_available,
+            server=server,
+            inbound=dict(inbound),
+            users=users,
+            users_sorted=sorted(users, key=lambda u: (not u["online"], -u["total"], u["user_id"])),
+            top_users=sorted(users, key=lambda u: u["total"], reverse=True)[:5],
+            summary=summary,
+            top_talkers={window: self.rates.top(window, self.rates.max_k) for window in RATE_WINDOWS},
+            by_email={u["email"]: u for u in users},
+            by_user_id={u["user_id"]: u for u in users},
+        )
+
+
+traffic_collector = TrafficCollector()
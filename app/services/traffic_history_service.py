@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+import time
+
+from app.config import settings
+from app.services.persistent_traffic_service import PersistentTrafficService
+
+
+logger = logging.getLogger("xray-agent")
+
+# (name, bucket size in seconds), finest first. Each level is rolled up from the one before it.
+RESOLUTIONS: tuple[tuple[str, int], ...] = (("1m", 60), ("1h", 3600), ("1d", 86400))
+
+_PRUNE_EVERY_SEC = 3600
+
+
+def _table(name: str) -> str:
+    return f"vpn_user_traffic_history_{name}"
+
+
+def _retention_sec(name: str) -> float:
+    days = {
+        "1m": settings.traffic_history_retention_1m_days,
+        "1h": settings.traffic_history_retention_1h_days,
+        "1d": settings.traffic_history_retention_1d_days,
+    }[name]
+    return max(0.0, float(days)) * 86400
+
+
+class TrafficHistoryService:
+    """Per-user traffic over time, next to the totals in the snapshot store.
+
+    The collector feeds `record()` with the totals of every pass; the
+    difference to the previous pass lands in a 1-minute bucket. Closed
+    buckets are rolled up into 1-hour and 1-day tables; a watermark per
+    resolution marks how far each one is complete, so a rollup only reads
+    what closed since the last one. Every resolution has its own retention,
+    and 1m/1h rows are only dropped once they are rolled up.
+    """
+
+    def __init__(self, store: PersistentTrafficService):
+        self.store = store
+        self._tables_ready = False
+        # user_id -> (total_uplink, total_downlink) seen on the previous pass.
+        self._baseline: dict[int, tuple[int, int]] = {}
+        self._last_prune = 0.0
+
+    def ensure_tables(self) -> None:
+        if self._tables_ready:
+            return
+        with self.store.write() as conn:
+            for name, _ in RESOLUTIONS:
+                conn.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {_table(name)} (
+                        server_id INTEGER NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        bucket INTEGER NOT NULL,
+                        uplink INTEGER NOT NULL DEFAULT 0,
+                        downlink INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (server_id, user_id, bucket)
+                    ) WITHOUT ROWID
+                    """
+                )
+                conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{_table(name)}_bucket ON {_table(name)}(bucket)")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS vpn_user_traffic_history_watermark (
+                    resolution TEXT PRIMARY KEY,
+                    complete_until INTEGER NOT NULL
+                )
+                """
+            )
+        self._tables_ready = True
+
+    def unprimed(self, user_ids: list[int]) -> list[int]:
+        """Users with no previous totals to diff against (first pass, newly active keys)."""
+        return [uid for uid in user_ids if uid not in self._baseline]
+
+    def prime(self, user_ids: list[int], totals: dict[int, dict]) -> None:
+        """Set the previous totals from the store, read before this pass writes to it."""
+        for uid in user_ids:
+            t = totals.get(uid)
+            self._baseline[uid] = (int(t["uplink"]), int(t["downlink"])) if t else (0, 0)
+
+    def forget(self, user_ids: list[int]) -> None:
+        """Totals of these users were reset to zero outside a collector pass."""
+        for uid in user_ids:
+            if int(uid) in self._baseline:
+                self._baseline[int(uid)] = (0, 0)
+
+    def record(self, *, server_id: int, ts: float, totals: dict[int, dict]) -> int:
+        """Add the growth of each user's totals since the previous pass to the bucket of `ts`."""
+        self.ensure_tables()
+        bucket = int(ts) // 60 * 60
+        sid = int(server_id)
+        rows = []
+        baseline: dict[int, tuple[int, int]] = {}
+        for uid, t in totals.items():
+            up = int(t["uplink"])
+            down = int(t["downlink"])
+            prev = self._baseline.get(uid)
+            baseline[uid] = (up, down)
+            if prev is None:
+                continue
+            # Totals only go down on a reset: whatever is there now accrued after it.
+            delta_up = up - prev[0] if up >= prev[0] else up
+            delta_down = down - prev[1] if down >= prev[1] else down
+            if delta_up or delta_down:
+                rows.append((sid, int(uid), bucket, delta_up, delta_down))
+
+        if rows:
+            with self.store.write() as conn:
+                conn.executemany(
+                    f"""
+                    INSERT INTO {_table("1m")} (server_id, user_id, bucket, uplink, downlink)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(server_id, user_id, bucket) DO UPDATE SET
+                        uplink = uplink + excluded.uplink,
+                        downlink = downlink + excluded.downlink
+                    """,
+                    rows,
+                )
+        # Users that left the active set are re-primed from the store if they come back.
+        self._baseline = baseline
+        return len(rows)
+
+    @staticmethod
+    def _watermarks(conn: sqlite3.Connection) -> dict[str, int]:
+        return {
+            str(row[0]): int(row[1])
+            for row in conn.execute("SELECT resolution, complete_until FROM vpn_user_traffic_history_watermark")
+        }
+
+    def rollup(self, now: float | None = None) -> dict[str, int]:
+        """Roll closed buckets up one resolution at a time; returns rows written per resolution."""
+        self.ensure_tables()
+        now = time.time() if now is None else now
+        written: dict[str, int] = {}
+        with self.store.write() as conn:
+            marks = self._watermarks(conn)
+            # The current minute is still being written to.
+            complete = int(now) // 60 * 60
+            for (src, _), (dst, size) in zip(RESOLUTIONS, RESOLUTIONS[1:]):
+                until = complete // size * size
+                start = marks.get(dst)
+                if start is None:
+                    first = conn.execute(f"SELECT MIN(bucket) FROM {_table(src)}").fetchone()[0]
+                    start = until if first is None else int(first) // size * size
+                if start < until:
+                    cur = conn.execute(
+                        f"""
+                        INSERT INTO {_table(dst)} (server_id, user_id, bucket, uplink, downlink)
+                        SELECT server_id, user_id, bucket - bucket % ?, SUM(uplink), SUM(downlink)
+                        FROM {_table(src)}
+                        WHERE bucket >= ? AND bucket < ?
+                        GROUP BY server_id, user_id, bucket - bucket % ?
+                        ON CONFLICT(server_id, user_id, bucket) DO UPDATE SET
+                            uplink = excluded.uplink,
+                            downlink = excluded.downlink
+                        """,
+                        (size, start, until, size),
+                    )
+                    written[dst] = int(cur.rowcount or 0)
+                if marks.get(dst) != max(start, until):
+                    marks[dst] = max(start, until)
+                    conn.execute(
+                        """
+                        INSERT INTO vpn_user_traffic_history_watermark (resolution, complete_until) VALUES (?, ?)
+                        ON CONFLICT(resolution) DO UPDATE SET complete_until = excluded.complete_until
+                        """,
+                        (dst, marks[dst]),
+                    )
+                complete = marks[dst]
+        return written
+
+    def prune(self, now: float | None = None) -> dict[str, int]:
+        """Drop buckets past their retention; never ones the next resolution has not absorbed yet."""
+        self.ensure_tables()
+        now = time.time() if now is None else now
+        deleted: dict[str, int] = {}
+        with self.store.write() as conn:
+            marks = self._watermarks(conn)
+            for i, (name, _) in enumerate(RESOLUTIONS):
+                cutoff = int(now - _retention_sec(name))
+                if i + 1 < len(RESOLUTIONS):
+                    cutoff = min(cutoff, marks.get(RESOLUTIONS[i + 1][0], 0))
+                cur = conn.execute(f"DELETE FROM {_table(name)} WHERE bucket < ?", (cutoff,))
+                deleted[name] = int(cur.rowcount or 0)
+        return deleted
+
+    def maintain(self, now: float | None = None) -> None:
+        now = time.time() if now is None else now
+        self.rollup(now)
+        if now - self._last_prune >= _PRUNE_EVERY_SEC:
+            deleted = self.prune(now)
+            self._last_prune = now
+            if any(deleted.values()):
+                logger.info("[traffic-history] pruned %s", deleted)
+
+    @staticmethod
+    def resolution_for_step(step: int) -> tuple[str, int]:
+        """The coarsest resolution whose buckets tile `step` exactly."""
+        for name, size in reversed(RESOLUTIONS):
+            if step % size == 0:
+                return name, size
+        raise ValueError(f"step must be a multiple of {RESOLUTIONS[0][1]} seconds")
+
+    def query(self, *, server_id: int, user_id: int, start: int, end: int, step: int) -> dict:
+        """Traffic of one user in [start, end) summed into `step`-second points (aligned to UTC epoch).
+
+        Reads the coarsest resolution that tiles `step`; the part of the range
+        that resolution has not rolled up yet comes from the finer tables.
+        """
+        self.ensure_tables()
+        name, _ = self.resolution_for_step(step)
+        level = [n for n, _ in RESOLUTIONS].index(name)
+        start = int(start) // step * step
+        end = int(end)
+        sums: dict[int, list[int]] = {}
+        with self.store.read() as conn:
+            marks = self._watermarks(conn)
+            lower = start
+            for lvl in range(level, -1, -1):
+                res = RESOLUTIONS[lvl][0]
+                upper = end if lvl == 0 else min(end, max(lower, marks.get(res, lower)))
+                if upper > lower:
+                    rows = conn.execute(
+                        f"""
+                        SELECT bucket - bucket % ? AS point, SUM(uplink), SUM(downlink)
+                        FROM {_table(res)}
+                        WHERE server_id = ? AND user_id = ? AND bucket >= ? AND bucket < ?
+                        GROUP BY point
+                        """,
+                        (step, int(server_id), int(user_id), lower, upper),
+                    ).fetchall()
+                    for point, up, down in rows:
+                        acc = sums.setdefault(int(point), [0, 0])
+                        acc[0] += int(up or 0)
+                        acc[1] += int(down or 0)
+                lower = upper
+                if lower >= end:
+                    break
+
+        points = []
+        total_up = 0
+        total_down = 0
+        for point in range(start, end, step):
+            up, down = sums.get(point, (0, 0))
+            total_up += up
+            total_down += down
+            points.append({"ts": point, "uplink": up, "downlink": down, "total": up + down})
+        return {
+            "resolution": name,
+            "step": step,
+            "from": start,
+            "to": end,
+            "points": points,
+            "totals": {"uplink": total_up, "downlink": total_down, "total": total_up + total_down},
+        }
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select
+
+from app.config import settings
+from app.deps import SessionLocal
+from app.models import Key, KeyStatus
+from app.routers.metrics import (
+    TRAFFIC_MAINTENANCE_LAST_DURATION,
+    TRAFFIC_MAINTENANCE_RUNS,
+    TRAFFIC_STORE_BYTES,
+    TRAFFIC_STORE_PAGES,
+    TRAFFIC_STORE_PRUNED,
+    TRAFFIC_STORE_VACUUMED_PAGES,
+)
+from app.services.periodic import PeriodicTask
+from app.services.traffic_collector import TrafficCollector, traffic_collector
+
+
+logger = logging.getLogger("xray-agent")
+
+
+class TrafficStoreMaintenance:
+    """Keeps the snapshot store from growing without bound on long-lived nodes.
+
+    Every `traffic_maintenance_interval_sec` it deletes totals of users with
+    no active key on this server that the collector has not seen for
+    `traffic_prune_grace_days` and archived reset periods past
+    `traffic_period_retention_days`, then releases free SQLite pages
+    (incremental vacuum), runs `PRAGMA optimize`, truncates the WAL and
+    exports file size and page gauges.
+    """
+
+    def __init__(self, collector: TrafficCollector | None = None):
+        self.collector = collector or traffic_collector
+        self.last_report: dict | None = None
+        self.task = PeriodicTask(
+            "traffic-maintenance",
+            self.run_once,
+            interval_sec=settings.traffic_maintenance_interval_sec,
+            jitter_sec=min(300.0, settings.traffic_maintenance_interval_sec / 10),
+            on_skip=lambda: TRAFFIC_MAINTENANCE_RUNS.labels(result="skipped").inc(),
+        )
+
+    def start(self) -> None:
+        self.task.start()
+
+    def stop(self) -> None:
+        self.task.stop()
+
+    def _active_user_ids(self) -> set[int]:
+        db = SessionLocal()
+        try:
+            return set(db.execute(
+                select(Key.user_id).where(
+                    Key.status == KeyStatus.active,
+                    Key.server_id == settings.sync_server_id,
+                )
+            ).scalars().all())
+        finally:
+            db.close()
+
+    def prune(self, now: datetime | None = None) -> list[int]:
+        """Delete totals of users without an active key idle past the grace period; returns their ids."""
+        if settings.traffic_prune_grace_days <= 0:
+            return []
+        active = self._active_user_ids()
+        if not active:
+            # An empty key list is more likely a wrong server id or a DB hiccup than a node with no users.
+            logger.warning("[traffic-maintenance] no active keys for server_id=%s, not pruning", settings.sync_server_id)
+            return []
+        now = now or datetime.now(timezone.utc)
+        pruned = self.collector.persistent.prune_users(
+            None,
+            server_id=settings.sync_server_id,
+            keep_user_ids=active,
+            updated_before=now - timedelta(days=settings.traffic_prune_grace_days),
+        )
+        if pruned:
+            self.collector.history.forget(pruned)
+            TRAFFIC_STORE_PRUNED.inc(len(pruned))
+            logger.info("[traffic-maintenance] pruned %s user(s) without an active key", len(pruned))
+        return pruned
+
+    def prune_periods(self, now: datetime | None = None) -> int:
+        """Delete archived reset periods older than the retention; returns how many."""
+        if settings.traffic_period_retention_days <= 0:
+            return 0
+        now = now or datetime.now(timezone.utc)
+        removed = self.collector.resets.prune_periods(now - timedelta(days=settings.traffic_period_retention_days))
+        if removed:
+            logger.info("[traffic-maintenance] dropped %s archived traffic period(s)", removed)
+        return removed
+
+    def compact(self) -> dict[str, int]:
+        """Vacuum the local SQLite file and refresh the size gauges; returns its storage stats."""
+        store = self.collector.history.store
+        released = store.compact()
+        if released:
+            TRAFFIC_STORE_VACUUMED_PAGES.inc(released)
+        stats = store.storage_stats()
+        TRAFFIC_STORE_BYTES.labels(file="db").set(stats["file_bytes"])
+        TRAFFIC_STORE_BYTES.labels(file="wal").set(stats["wal_bytes"])
+        TRAFFIC_STORE_PAGES.labels(kind="total").set(stats["page_count"])
+        TRAFFIC_STORE_PAGES.labels(kind="free").set(stats["freelist_count"])
+        return {**stats, "vacuumed_pages": released}
+
+    def run_once(self) -> None:
+        started = time.perf_counter()
+        try:
+            pruned = self.prune()
+            periods = self.prune_periods()
+            storage = self.compact()
+        except Exception:
+            TRAFFIC_MAINTENANCE_RUNS.labels(result="error").inc()
+            raise
+        finally:
+            TRAFFIC_MAINTENANCE_LAST_DURATION.set(time.perf_counter() - started)
+
+        TRAFFIC_MAINTENANCE_RUNS.labels(result="ok").inc()
+        self.last_report = {"pruned": len(pruned), "pruned_periods": periods, **storage}
+        logger.info(
+            "[traffic-maintenance] done in %.2fs: pruned=%s vacuumed_pages=%s file=%sB wal=%sB free_pages=%s",
+            time.perf_counter() - started, len(pruned), storage["vacuumed_pages"],
+            storage["file_bytes"], storage["wal_bytes"], storage["freelist_count"],
+        )
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import logging
+from threading import Lock
+
+from app.config import settings
+from app.models import Key
+from app.services.resync_executor import ResyncExecutor
+from app.services.traffic_store import TrafficStore
+from app.services.xray_service import XrayService
+from app.utils.email import email_for_key, email_for_user_id
+
+
+logger = logging.getLogger("xray-agent")
+
+
+class TrafficQuotaService:
+    """Per-user traffic limits, enforced from the collector pass.
+
+    Limits and the disabled flag live in the snapshot store (`quota_bytes`,
+    `quota_disabled_at`) and are mirrored in memory, so a pass only compares
+    the users that have a limit and whose total moved since the previous
+    pass. Users over their limit are removed from Xray and flagged; flagged
+    users are re-added as soon as their total drops below the limit (reset,
+    raised or removed limit). Reconcile and the key listener skip flagged
+    users, so a failed Xray call is repaired by the next reconcile.
+    """
+
+    def __init__(self, store: TrafficStore, executor: ResyncExecutor | None = None):
+        self.store = store
+        self._executor = executor
+        self._lock = Lock()
+        self._loaded = False
+        self._limits: dict[int, int] = {}
+        self._disabled: set[int] = set()
+        # Total seen by the previous check; users whose total did not move are skipped.
+        self._last_total: dict[int, int] = {}
+
+    @property
+    def executor(self) -> ResyncExecutor:
+        if self._executor is None:
+            self._executor = ResyncExecutor(XrayService())
+        return self._executor
+
+    def _ensure_loaded(self) -> None:
+        # Imported lazily: app.routers pulls in the collector to hand this quota to SyncService.
+        from app.routers.metrics import TRAFFIC_QUOTA_DISABLED
+
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            for uid, (limit, disabled) in self.store.fetch_quotas(server_id=settings.sync_server_id).items():
+                if limit is not None:
+                    self._limits[uid] = limit
+                if disabled:
+                    self._disabled.add(uid)
+            TRAFFIC_QUOTA_DISABLED.set(len(self._disabled))
+            self._loaded = True
+
+    def disabled_user_ids(self) -> set[int]:
+        """Users taken out of Xray for exceeding their limit (empty when enforcement is off)."""
+        if not settings.traffic_quota_enabled:
+            return set()
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._disabled)
+
+    def get(self, user_id: int) -> dict:
+        self._ensure_loaded()
+        with self._lock:
+            return {"limit_bytes": self._limits.get(int(user_id)), "disabled": int(user_id) in self._disabled}
+
+    def set_limits(self, limits: dict[int, int | None]) -> None:
+        """Store limits (None removes one); they are checked on the next collector pass."""
+        self._ensure_loaded()
+        limits = {int(uid): (None if limit is None else max(0, int(limit))) for uid, limit in limits.items()}
+        self.store.set_quotas(server_id=settings.sync_server_id, quotas=limits)
+        with self._lock:
+            for uid, limit in limits.items():
+                if limit is None:
+                    self._limits.pop(uid, None)
+                else:
+                    self._limits[uid] = limit
+                self._last_total.pop(uid, None)
+
+    def enforce(self, keys: list[Key], totals: dict[int, dict]) -> dict[str, list[int]]:
+        """Disable users whose total reached their limit, re-enable flagged users back under it.
+
+        `totals` are the persisted totals of this pass by user id. Returns the
+        user ids acted on as {"disabled": [...], "enabled": [...]}.
+        """
+        from app.routers.metrics import TRAFFIC_QUOTA_DISABLED
+
+        self._ensure_loaded()
+        active = {int(k.user_id): k for k in keys}
+        to_disable: list[int] = []
+        to_enable: list[int] = []
+        with self._lock:
+            for uid, limit in self._limits.items():
+                t = totals.get(uid)
+                if t is None or uid in self._disabled or uid not in active:
+                    continue
+                total = int(t["total"])
+                if self._last_total.get(uid) == total:
+                    continue
+                self._last_total[uid] = total
+                if total >= limit:
+                    to_disable.append(uid)
+            for uid in self._disabled:
+                limit = self._limits.get(uid)
+                total = int(totals.get(uid, {}).get("total", 0))
+                if uid in active and (limit is None or total < limit):
+                    to_enable.append(uid)
+            # Flag before removing and unflag before adding, so a reconcile running
+            # meanwhile never undoes the change.
+            self._disabled.update(to_disable)
+            self._disabled.difference_update(to_enable)
+            TRAFFIC_QUOTA_DISABLED.set(len(self._disabled))
+
+        if to_disable:
+            self.store.set_quota_disabled(server_id=settings.sync_server_id, user_ids=to_disable, disabled=True)
+            results = self.executor.remove_users([email_for_user_id(uid) for uid in to_disable], label="quota-disable")
+            self._count("disable", results)
+            logger.info("[traffic-quota] disabled %s user(s) over their limit", len(to_disable))
+        if to_enable:
+            self.store.set_quota_disabled(server_id=settings.sync_server_id, user_ids=to_enable, disabled=False)
+            results = self.executor.add_users(
+                [{"email": email_for_key(active[uid]), "uuid": active[uid].uuid, "level": 0} for uid in to_enable],
+                label="quota-enable",
+            )
+            self._count("enable", results)
+            logger.info("[traffic-quota] re-enabled %s user(s) back under their limit", len(to_enable))
+        return {"disabled": to_disable, "enabled": to_enable}
+
+    @staticmethod
+    def _count(action: str, results: list[dict]) -> None:
+        from app.routers.metrics import TRAFFIC_QUOTA_ACTIONS
+
+        for r in results:
+            TRAFFIC_QUOTA_ACTIONS.labels(action=action, result="error" if r["result"] == "error" else "ok").inc()
+            if r["result"] == "error":
+                logger.warning("[traffic-quota] %s %s failed, reconcile will retry: %s", action, r["email"], r.get("error"))
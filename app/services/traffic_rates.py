@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import heapq
+import math
+from dataclasses import dataclass, field
+
+
+# window name -> EWMA time constant in seconds; 0 means the instantaneous rate.
+RATE_WINDOWS: dict[str, float] = {
+    "instant": 0.0,
+    "1m": 60.0,
+    "5m": 300.0,
+    "15m": 900.0,
+}
+DEFAULT_RATE_WINDOW = "1m"
+
+
+@dataclass
+class _UserRate:
+    last_ts: float
+    last_uplink: int
+    last_downlink: int
+    # window -> [uplink_bps, downlink_bps]
+    rates: dict[str, list[float]] = field(default_factory=lambda: {w: [0.0, 0.0] for w in RATE_WINDOWS})
+
+
+class TrafficRates:
+    """Per-user bytes/sec from successive cumulative totals.
+
+    `update()` is fed once per collector pass. It keeps the instantaneous
+    rate plus time-aware EWMAs (alpha = 1 - exp(-dt / tau), so uneven
+    intervals weigh correctly), and precomputes the top `max_k` users per
+    window with heapq so readers only slice a ready list.
+    """
+
+    def __init__(self, max_k: int = 100):
+        self.max_k = max(1, int(max_k))
+        self._users: dict[int, _UserRate] = {}
+        self._top: dict[str, list[dict]] = {w: [] for w in RATE_WINDOWS}
+
+    def update(self, ts: float, totals: dict[int, dict], emails: dict[int, str]) -> dict[int, dict]:
+        """Fold one pass of {user_id: {uplink, downlink}} totals in; returns rates per user."""
+        seen = set()
+        out: dict[int, dict] = {}
+        for uid, t in totals.items():
+            seen.add(uid)
+            up = int(t["uplink"])
+            down = int(t["downlink"])
+            state = self._users.get(uid)
+            if state is None:
+                self._users[uid] = _UserRate(last_ts=ts, last_uplink=up, last_downlink=down)
+                out[uid] = self._row(uid, emails.get(uid, ""), self._users[uid])
+                continue
+
+            dt = ts - state.last_ts
+            if dt > 0:
+                # Totals only shrink on a reset; count that pass as idle.
+                inst_up = max(0, up - state.last_uplink) / dt
+                inst_down = max(0, down - state.last_downlink) / dt
+                for window, tau in RATE_WINDOWS.items():
+                    r = state.rates[window]
+                    if tau <= 0:
+                        r[0], r[1] = inst_up, inst_down
+                    else:
+                        alpha = 1.0 - math.exp(-dt / tau)
+                        r[0] += alpha * (inst_up - r[0])
+                        r[1] += alpha * (inst_down - r[1])
+                state.last_ts = ts
+            state.last_uplink = up
+            state.last_downlink = down
+            out[uid] = self._row(uid, emails.get(uid, ""), state)
+
+        for uid in [u for u in self._users if u not in seen]:
+            del self._users[uid]
+
+        rows = list(out.values())
+        self._top = {
+            window: [
+                {
+                    "user_id": row["user_id"],
+                    "email": row["email"],
+                    "uplink_bps": row["rates"][window]["uplink_bps"],
+                    "downlink_bps": row["rates"][window]["downlink_bps"],
+                    "total_bps": row["rates"][window]["total_bps"],
+                }
+                for row in heapq.nlargest(self.max_k, rows, key=lambda row: row["rates"][window]["total_bps"])
+            ]
+            for window in RATE_WINDOWS
+        }
+        return out
+
+    @staticmethod
+    def _row(uid: int, email: str, state: _UserRate) -> dict:
+        return {
+            "user_id": uid,
+            "email": email,
+            "rates": {
+                window: {
+                    "uplink_bps": round(r[0], 1),
+                    "downlink_bps": round(r[1], 1),
+                    "total_bps": round(r[0] + r[1], 1),
+                }
+                for window, r in state.rates.items()
+            },
+        }
+
+    def top(self, window: str = DEFAULT_RATE_WINDOW, k: int = 10) -> list[dict]:
+        return self._top.get(window, [])[: max(0, int(k))]
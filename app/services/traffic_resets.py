@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timezone
+from threading import Lock
+
+from app.config import settings
+from app.services.traffic_store import TrafficStore
+from app.utils.periods import period_bounds
+
+
+logger = logging.getLogger("xray-agent")
+
+
+class TrafficResetScheduler:
+    """Per-user periodic traffic resets, rolled over from the collector pass.
+
+    A schedule is an anchor time plus a period of N months and/or N days,
+    stored with the user's totals (`reset_anchor_at`, `reset_every_*`,
+    `period_started_at`, `reset_next_at`). Only the earliest `reset_next_at`
+    is kept in memory, so a pass with nothing due costs one datetime
+    comparison; when something is due the store archives and zeroes every
+    due user at once and moves their next reset forward.
+    """
+
+    def __init__(self, store: TrafficStore):
+        self.store = store
+        self._lock = Lock()
+        self._loaded = False
+        self._next_due: datetime | None = None
+
+    def _refresh_next_due(self) -> None:
+        # Imported lazily: app.routers imports the collector, which builds this scheduler.
+        from app.routers.metrics import TRAFFIC_NEXT_RESET
+
+        self._next_due = self.store.next_reset_at(server_id=settings.sync_server_id)
+        TRAFFIC_NEXT_RESET.set(self._next_due.timestamp() if self._next_due else 0)
+        self._loaded = True
+
+    def get(self, user_id: int, *, periods: int = 12) -> dict:
+        """The user's schedule (None when unscheduled) and the last `periods` archived periods."""
+        sid = settings.sync_server_id
+        schedule = self.store.fetch_reset_schedules(server_id=sid, user_ids=[int(user_id)]).get(int(user_id))
+        return {
+            "schedule": schedule,
+            "periods": self.store.fetch_periods(server_id=sid, user_id=int(user_id), limit=periods),
+        }
+
+    def set_schedules(self, schedules: dict[int, tuple[datetime, int, int] | None], now: datetime | None = None) -> None:
+        """Store (anchor, every_months, every_days) per user; None removes the schedule.
+
+        The current period is the one containing `now`, so a new schedule
+        never resets anyone retroactively.
+        """
+        now = now or datetime.now(timezone.utc)
+        rows: dict[int, dict | None] = {}
+        for uid, item in schedules.items():
+            if item is None:
+                rows[int(uid)] = None
+                continue
+            anchor, months, days = item
+            if anchor.tzinfo is None:
+                anchor = anchor.replace(tzinfo=timezone.utc)
+            start, end = period_bounds(anchor, int(months), int(days), now)
+            rows[int(uid)] = {
+                "anchor_at": anchor.astimezone(timezone.utc),
+                "every_months": int(months),
+                "every_days": int(days),
+                "period_started_at": start,
+                "next_reset_at": end,
+            }
+        self.store.set_reset_schedules(server_id=settings.sync_server_id, schedules=rows)
+        with self._lock:
+            self._refresh_next_due()
+
+    def roll_over(self, now: datetime | None = None) -> list[dict]:
+        """Archive and zero the totals of users whose period ended; returns what the store rolled over."""
+        from app.routers.metrics import TRAFFIC_PERIOD_RESETS
+
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            if not self._loaded:
+                self._refresh_next_due()
+            if self._next_due is None or now < self._next_due:
+                return []
+            try:
+                rolled = self.store.roll_over_due(server_id=settings.sync_server_id, now=now)
+            finally:
+                self._refresh_next_due()
+        if rolled:
+            TRAFFIC_PERIOD_RESETS.inc(len(rolled))
+            logger.info("[traffic-resets] rolled over %s user(s) into a new period", len(rolled))
+        return rolled
+
+    def prune_periods(self, ended_before: datetime) -> int:
+        return self.store.prune_periods(server_id=settings.sync_server_id, ended_before=ended_before)
@@ -3,14 +3,54 @@ import time
 from fastapi import HTTPException
 
 from app.config import settings
+from app.services.access_log_tailer import access_log_tailer
+from app.services.xray_capabilities import XrayCapabilityRegistry, xray_capabilities
+from app.services.xray_grpc_client import XrayGrpcClient, get_grpc_client
+from app.utils.grpc_codec import (
+    decode_get_stats_response,
+    decode_query_stats_response,
+    encode_get_stats_request,
+    encode_query_stats_request,
+    quote_regexp,
+)
+from app.utils.email import user_id_from_email
 from app.utils.subprocess_run import run_cmd
 
 
+USER_STATS_PATTERN = "user>>>"
+# Users per regexp QueryStats when resetting; keeps each pattern well inside what Xray compiles quickly.
+_RESET_REGEXP_BATCH = 1000
+
+
+# Traffic counters of the agent's own user-<id>@lunet emails; users defined in config.json do not match.
+_MANAGED_TRAFFIC_REGEXP = r"^user>>>user-[0-9]+@lunet>>>traffic>>>(?:up|down)link$"
+
+
+def _user_traffic_regexp(emails: list[str]) -> str:
+    """Anchored RE2 pattern matching exactly the traffic counters of `emails`."""
+    return "^user>>>(?:" + "|".join(quote_regexp(e) for e in emails) + ")>>>traffic>>>(?:up|down)link$"
+
+
 class TrafficService:
-    def __init__(self):
+    def __init__(
+        self,
+        backend: str | None = None,
+        grpc_client: XrayGrpcClient | None = None,
+        capabilities: XrayCapabilityRegistry | None = None,
+    ):
+        self.backend = (backend or settings.xray_api_backend).lower()
+        self._grpc_client = grpc_client
+        if capabilities is None:
+            shared = xray_capabilities.backend == self.backend and grpc_client is None
+            capabilities = xray_capabilities if shared else XrayCapabilityRegistry(self.backend, grpc_client)
+        self.capabilities = capabilities
         self._online_cache: dict[str, dict[str, int | float]] = {}
-        self._statsquery_cache: dict[str, int] = {}
-        self._statsquery_cache_ts: float = 0.0
+        # pattern -> (fetched_at, {stat name: value})
+        self._statsquery_cache: dict[str, tuple[float, dict[str, int]]] = {}
+
+    @property
+    def grpc(self) -> XrayGrpcClient:
+        return self._grpc_client or get_grpc_client()
 
     @staticmethod
     def _is_stat_missing_error(exc: Exception) -> bool:
@@ -22,23 +62,42 @@ class TrafficService:
         low = detail.lower()
         return "not found" in low or "notfound" in low or "unknown stat" in low
 
-    @staticmethod
-    def _is_service_unavailable_error(exc: Exception) -> bool:
-        detail = str(getattr(exc, "detail", exc)).lower()
-        return "does not expose service" in detail or "unimplemented" in detail
+    def query_stats(self, pattern: str = "", *, reset: bool = False, regexp: bool = False) -> dict[str, int]:
+        """All counters whose name contains `pattern`, as {name: value}, in one call.
 
-    def _statsquery_map(self, *, force: bool = False) -> dict[str, int]:
-        now = time.time()
-        # Keep very short cache to avoid hammering xray api for every single counter.
-        if not force and (now - self._statsquery_cache_ts) < 1.0 and self._statsquery_cache:
-            return self._statsquery_cache
+        Filtering happens inside Xray, so `user>>>` or `inbound>>>` only ship
+        the counters asked for. With reset=True the returned counters are zeroed.
+        regexp=True matches `pattern` as an RE2 regexp and needs
+        `capabilities.query_stats_regexp`.
+        """
+        caps = self.capabilities.get()
+        if caps.query_stats_via is None:
+            raise HTTPException(status_code=500, detail="Xray QueryStats is not available")
+        if regexp and not caps.query_stats_regexp:
+            raise HTTPException(status_code=500, detail="Xray QueryStats does not support regexp patterns")
+        try:
+            if caps.query_stats_via == "grpc":
+                raw = self.grpc.call(
+                    caps.query_stats_method,
+                    encode_query_stats_request(pattern=pattern, reset=reset, regexp=regexp),
+                )
+                return decode_query_stats_response(raw)
+            return self._query_stats_via_xray_cli(pattern, reset=reset)
+        except Exception as exc:
+            self.capabilities.note_error(exc)
+            raise
 
+    def _query_stats_via_xray_cli(self, pattern: str, *, reset: bool = False) -> dict[str, int]:
         cmd = [
             settings.xray_bin,
             "api",
             "statsquery",
             f"--server={settings.xray_addr}",
         ]
+        if pattern:
+            cmd += ["-pattern", pattern]
+        if reset:
+            cmd.append("-reset")
         raw = run_cmd(cmd).decode(errors="replace").strip()
         data = json.loads(raw) if raw else {}
         result: dict[str, int] = {}
@@ -49,8 +108,17 @@ class TrafficService:
             if not stat_name:
                 continue
             result[stat_name] = int(item.get("value", 0) or 0)
-        self._statsquery_cache = result
-        self._statsquery_cache_ts = now
+        return result
+
+    def _statsquery_map(self, pattern: str = USER_STATS_PATTERN, *, force: bool = False) -> dict[str, int]:
+        now = time.time()
+        # Keep very short cache to avoid hammering xray api for every single counter.
+        cached = self._statsquery_cache.get(pattern)
+        if not force and cached is not None and (now - cached[0]) < 1.0:
+            return cached[1]
+
+        result = self.query_stats(pattern)
+        self._statsquery_cache[pattern] = (now, result)
         return result
 
     def _get_stat_via_xray_cli(self, name: str, *, reset: bool = False) -> dict:
@@ -69,55 +137,79 @@ class TrafficService:
             value = int((data or {}).get("value", 0))
             return {"ok": True, "name": name, "value": value, "missing": False}
 
-        values = self._statsquery_map()
+        values = self.query_stats(name)
         value = int(values.get(name, 0))
         return {"ok": True, "name": name, "value": value, "missing": name not in values}
 
-    def _get_stat(self, name: str, *, reset: bool = False) -> dict:
+    def _get_stat_via_grpc(self, method: str, name: str, *, reset: bool = False) -> dict:
+        try:
+            raw = self.grpc.call(method, encode_get_stats_request(name=name, reset=reset))
+        except Exception as exc:
+            if self._is_stat_missing_error(exc):
+                return {"ok": True, "name": name, "value": 0, "missing": True}
+            raise
+        stat = decode_get_stats_response(raw)
+        value = int(stat[1]) if stat else 0
+        return {"ok": True, "name": name, "value": value, "missing": False}
+
+    def _get_stat_via_grpcurl(self, method: str, name: str, *, reset: bool = False) -> dict:
         payload = json.dumps({"name": name, "reset": reset}, separators=(",", ":"))
-        last_exc: Exception | None = None
-        for method in (
-            "xray.app.stats.command.StatsService/GetStats",
-            "v2ray.core.app.stats.command.StatsService/GetStats",
-        ):
-            try:
-                raw = run_cmd([
-                    settings.grpcurl_bin,
-                    "-plaintext",
-                    "-protoset",
-                    settings.protoset,
-                    "-d",
-                    payload,
-                    settings.xray_addr,
-                    method,
-                ]).decode()
-                break
-            except Exception as exc:
-                last_exc = exc
-                # Xray may return "not found" for counters that were not created yet.
-                # This still means StatsService is reachable, so expose zero value.
-                if self._is_stat_missing_error(exc):
-                    return {"ok": True, "name": name, "value": 0, "missing": True}
-                if self._is_service_unavailable_error(exc):
-                    try:
-                        return self._get_stat_via_xray_cli(name, reset=reset)
-                    except Exception:
-                        continue
-                raise
-        else:
-            if last_exc is not None:
-                raise last_exc
-            raise RuntimeError("StatsService call failed without explicit exception")
+        try:
+            raw = run_cmd([
+                settings.grpcurl_bin,
+                "-plaintext",
+                "-protoset",
+                settings.protoset,
+                "-d",
+                payload,
+                settings.xray_addr,
+                method,
+            ]).decode()
+        except Exception as exc:
+            # Xray may return "not found" for counters that were not created yet.
+            # This still means StatsService is reachable, so expose zero value.
+            if self._is_stat_missing_error(exc):
+                return {"ok": True, "name": name, "value": 0, "missing": True}
+            raise
         data = json.loads(raw) if raw else {}
 
         stat = data.get("stat") or {}
         value = int(stat.get("value", 0))
         return {"ok": True, "name": name, "value": value, "missing": False}
 
+    def _get_stat(self, name: str, *, reset: bool = False) -> dict:
+        # Dispatch straight to whatever the capability probe found; no trial-and-error per call.
+        caps = self.capabilities.get()
+        try:
+            if caps.stats_via == "grpc":
+                return self._get_stat_via_grpc(caps.get_stats_method, name, reset=reset)
+            if caps.stats_via == "grpcurl":
+                return self._get_stat_via_grpcurl(caps.get_stats_method, name, reset=reset)
+            if caps.stats_via == "cli":
+                return self._get_stat_via_xray_cli(name, reset=reset)
+        except Exception as exc:
+            self.capabilities.note_error(exc)
+            raise
+        raise HTTPException(status_code=500, detail="Xray StatsService is not available")
+
     def get_inbound_traffic(self) -> dict:
+        prefix = f"inbound>>>{settings.inbound_tag}>>>traffic>>>"
+        try:
+            values = self._statsquery_map(prefix)
+            up_val = int(values.get(f"{prefix}uplink", 0))
+            down_val = int(values.get(f"{prefix}downlink", 0))
+            return {
+                "available": True,
+                "uplink": up_val,
+                "downlink": down_val,
+                "total": up_val + down_val,
+            }
+        except Exception:
+            pass
+
         try:
-            up = self._get_stat(f"inbound>>>{settings.inbound_tag}>>>traffic>>>uplink")
-            down = self._get_stat(f"inbound>>>{settings.inbound_tag}>>>traffic>>>downlink")
+            up = self._get_stat(f"{prefix}uplink")
+            down = self._get_stat(f"{prefix}downlink")
             return {
                 "available": True,
                 "uplink": up["value"],
@@ -170,46 +262,69 @@ class TrafficService:
                 }
         return out
 
-    def get_users_online(self, emails: list[str], traffic_map: dict[str, dict] | None = None) -> dict[str, dict]:
+    def pull_users_traffic(self, emails: list[str]) -> dict[str, dict]:
+        """Read and zero user traffic counters in one QueryStats(reset=true) call.
+
+        Returns the traffic since the previous pull for each of `emails` and
+        for every other `user-<id>@lunet` counter that was zeroed with them,
+        so the caller can account users that are not in its list (a key
+        deactivated a moment ago, a user added since the list was read).
+        Builds with regexp QueryStats zero only those managed counters;
+        older ones zero every `user>>>` counter. Raises if Xray cannot be
+        queried, and nothing is reset in that case.
+        """
+        if self.capabilities.get().query_stats_regexp:
+            values = self.query_stats(_MANAGED_TRAFFIC_REGEXP, reset=True, regexp=True)
+        else:
+            values = self.query_stats(USER_STATS_PATTERN, reset=True)
+        self._statsquery_cache.pop(USER_STATS_PATTERN, None)
+        pulled = {self._email_from_user_stat(name) for name in values}
+        out: dict[str, dict] = {}
+        for email in [*emails, *(e for e in sorted(pulled) if user_id_from_email(e) is not None)]:
+            up_val = int(values.get(f"user>>>{email}>>>traffic>>>uplink", 0))
+            down_val = int(values.get(f"user>>>{email}>>>traffic>>>downlink", 0))
+            out[email] = {
+                "available": True,
+                "uplink": up_val,
+                "downlink": down_val,
+                "total": up_val + down_val,
+            }
+        return out
+
+    def get_users_online(
+        self,
+        emails: list[str],
+        traffic_map: dict[str, dict] | None = None,
+        *,
+        traffic_is_delta: bool = False,
+    ) -> dict[str, dict]:
         out: dict[str, dict] = {}
         now = time.time()
         activity_window = max(15, int(settings.xray_online_activity_window_sec))
         stat_values: dict[str, int] = {}
-        try:
-            stat_values = self._statsquery_map()
-        except Exception:
-            stat_values = {}
+        # Only builds seen exposing per-user online counters are asked for them;
+        # everyone else goes straight to inference from traffic growth.
+        online_suffix = self.capabilities.get().online_stat_suffix
+        if online_suffix:
+            try:
+                stat_values = self._statsquery_map()
+            except Exception:
+                stat_values = {}
+        if traffic_map is None:
+            traffic_map = self.get_users_traffic(emails)
+        # Connections seen in the access log, when it is tailed; read from memory only.
+        presence = access_log_tailer.presence(emails, now) if access_log_tailer.running else None
         for email in emails:
-            # Newer Xray builds may expose per-user online counters when enabled in policy stats.
-            # If not available, we return supported=False and online=False.
             supported = False
             value = 0
-            online_names = (
-                f"user>>>{email}>>>online",
-                f"user>>>{email}>>>online>>>count",
-            )
-            for stat_name in online_names:
-                if stat_name in stat_values:
-                    value = int(stat_values.get(stat_name, 0))
-                    supported = True
-                    break
-            if not supported:
-                for stat_name in online_names:
-                    try:
-                        stat = self._get_stat(stat_name)
-                        if bool(stat.get("missing")):
-                            continue
-                        value = int(stat["value"])
-                        supported = True
-                        break
-                    except Exception:
-                        continue
+            stat_name = f"user>>>{email}{online_suffix}" if online_suffix else ""
+            if stat_name and stat_name in stat_values:
+                value = int(stat_values[stat_name])
+                supported = True
 
             inferred = False
             if not supported:
-                traffic = (traffic_map or {}).get(email)
-                if traffic is None:
-                    traffic = self.get_users_traffic([email]).get(email, {"total": 0})
+                traffic = traffic_map.get(email, {"total": 0})
                 total = int((traffic or {}).get("total", 0))
                 state = self._online_cache.get(email, {"last_total": 0, "last_seen": now, "last_active": 0.0})
                 last_total = int(state.get("last_total", total))
@@ -219,7 +334,7 @@ class TrafficService:
                 # consider user recently active for one activity window.
                 if email not in self._online_cache and total > 0:
                     last_active = now
-                if total > last_total:
+                if total > last_total or (traffic_is_delta and total > 0):
                     last_active = now
                 is_online = (now - last_active) <= activity_window if last_active > 0 else False
                 self._online_cache[email] = {
@@ -235,6 +350,12 @@ class TrafficService:
                 "value": int(value),
                 "inferred": inferred,
             }
+            if presence is not None:
+                seen = presence[email]
+                # A fresh connection in the log, or bytes still moving on an older one.
+                out[email]["online"] = bool(seen["online"]) or out[email]["online"]
+                out[email]["ips"] = int(seen["ips"])
+                out[email]["last_seen"] = seen["last_seen"]
         return out
 
     def reset_inbound_traffic(self) -> dict:
@@ -257,21 +378,18 @@ class TrafficService:
                 "reset_total": 0,
             }
 
-    def reset_users_traffic(self, emails: list[str]) -> dict:
-        total_up = 0
-        total_down = 0
-        available = False
-
-        for email in emails:
-            try:
-                up = self._get_stat(f"user>>>{email}>>>traffic>>>uplink", reset=True)
-                down = self._get_stat(f"user>>>{email}>>>traffic>>>downlink", reset=True)
-                total_up += up["value"]
-                total_down += down["value"]
-                available = True
-            except Exception:
-                continue
+    @staticmethod
+    def _email_from_user_stat(name: str) -> str:
+        # user>>>{email}>>>traffic>>>uplink
+        parts = name.split(">>>")
+        return parts[1] if len(parts) > 2 else ""
 
+    def reset_users_traffic(self, emails: list[str]) -> dict:
+        """Zero the traffic counters of `emails` and return what they held in total."""
+        reset = self.reset_users_counters(emails)
+        available = reset is not None
+        total_up = sum(item["uplink"] for item in (reset or {}).values())
+        total_down = sum(item["downlink"] for item in (reset or {}).values())
         return {
             "ok": available,
             "available": available,
@@ -279,3 +397,50 @@ class TrafficService:
             "reset_downlink": total_down,
             "reset_total": total_up + total_down,
         }
+
+    def reset_users_counters(self, emails: list[str]) -> dict[str, dict[str, int]] | None:
+        """Zero the traffic counters of `emails`; returns {email: {uplink, downlink}} as they were
+        just before the reset, or None when Xray could not be reached.
+
+        Builds with regexp QueryStats get one QueryStats(reset) per
+        `_RESET_REGEXP_BATCH` users, matching exactly their traffic
+        counters with an anchored regexp. Otherwise, when the targets cover
+        every user counter Xray has, a single QueryStats(user>>>, reset) does
+        it; failing that each user is reset with its own exact
+        `user>>>{email}>>>traffic>>>` pattern so other users' counters are
+        left untouched.
+        """
+        targets = {e for e in emails if e}
+        if not targets:
+            return None
+
+        reset: dict[str, dict[str, int]] = {}
+        try:
+            if self.capabilities.get().query_stats_regexp:
+                ordered = sorted(targets)
+                batches = [
+                    (_user_traffic_regexp(ordered[i:i + _RESET_REGEXP_BATCH]), True)
+                    for i in range(0, len(ordered), _RESET_REGEXP_BATCH)
+                ]
+            else:
+                present = {self._email_from_user_stat(name) for name in self.query_stats(USER_STATS_PATTERN)}
+                present.discard("")
+                if present <= targets:
+                    batches = [(USER_STATS_PATTERN, False)]
+                else:
+                    batches = [(f"user>>>{email}>>>traffic>>>", False) for email in sorted(targets & present)]
+
+            for pattern, regexp in batches:
+                for name, value in self.query_stats(pattern, reset=True, regexp=regexp).items():
+                    email = self._email_from_user_stat(name)
+                    if email not in targets:
+                        continue
+                    item = reset.setdefault(email, {"uplink": 0, "downlink": 0})
+                    if name.endswith(">>>traffic>>>uplink"):
+                        item["uplink"] += int(value)
+                    elif name.endswith(">>>traffic>>>downlink"):
+                        item["downlink"] += int(value)
+        except Exception:
+            reset = None
+        self._statsquery_cache.pop(USER_STATS_PATTERN, None)
+        return reset
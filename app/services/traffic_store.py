@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+from app.config import settings
+from app.services.persistent_traffic_service import PersistentTrafficService
+from app.services.pg_traffic_service import PostgresTrafficService
+from app.services.traffic_write_buffer import WriteBehindTrafficStore
+
+
+TrafficStore = PersistentTrafficService | PostgresTrafficService | WriteBehindTrafficStore
+
+
+def create_traffic_store() -> TrafficStore:
+    """The snapshot store picked by XRAY_TRAFFIC_STORE_BACKEND, write-behind unless the flush interval is 0."""
+    if settings.traffic_store_backend == "postgres":
+        backend: PersistentTrafficService | PostgresTrafficService = PostgresTrafficService()
+    else:
+        backend = PersistentTrafficService()
+    if settings.traffic_flush_interval_sec > 0:
+        return WriteBehindTrafficStore(backend)
+    return backend
+
+
+def local_sqlite_store(store: TrafficStore) -> PersistentTrafficService:
+    """The SQLite file behind `store`, or a separate one when the totals live in Postgres.
+
+    Node-local data (the traffic history) always stays in SQLite.
+    """
+    if isinstance(store, WriteBehindTrafficStore):
+        store = store.backend
+    if isinstance(store, PersistentTrafficService):
+        return store
+    return PersistentTrafficService()
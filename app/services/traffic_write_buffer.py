@@ -0,0 +1,496 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from threading import Lock
+
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.services.periodic import PeriodicTask
+from app.services.persistent_traffic_service import PersistentTrafficService
+from app.services.pg_traffic_service import PostgresTrafficService
+
+
+logger = logging.getLogger("xray-agent")
+
+# Cached row: [email, last_uplink, last_downlink, total_uplink, total_downlink, updated_at]
+_EMAIL, _LAST_UP, _LAST_DOWN, _TOTAL_UP, _TOTAL_DOWN, _UPDATED = range(6)
+
+# Rows changed per hold of the buffer lock, so readers never wait for a whole tick.
+_CHUNK_ROWS = 1000
+
+# Unchanged rows still get updated_at refreshed this often, so it tells when the
+# collector last saw the user, as in the backends (maintenance prunes by it).
+_TOUCH_EVERY = timedelta(hours=1)
+
+
+class WriteBehindTrafficStore:
+    """A snapshot backend (SQLite or Postgres) with totals kept in memory and written behind.
+
+    Exposes the same methods as the backends. Every row a caller touches is loaded once and then owned by the cache
+    (this process is the only writer), so applying counters, adding deltas,
+    resets and reads are dict operations. Changed rows are marked dirty and
+    appended to a journal file; `flush()` writes all dirty rows in one
+    transaction every `XRAY_TRAFFIC_FLUSH_INTERVAL_SEC`, as soon as
+    `XRAY_TRAFFIC_FLUSH_MAX_ROWS` are dirty, and on close.
+
+    The journal holds the latest absolute row values, so replaying it is
+    idempotent: on startup whatever a crash left in it is written to the
+    backend before the first read. A killed process loses nothing; losing the host
+    loses at most what the OS had not written back, about one interval.
+    """
+
+    def __init__(self, backend: PersistentTrafficService | PostgresTrafficService):
+        self.backend = backend
+        self._buf_lock = Lock()
+        self._flush_lock = Lock()
+        # Taken before _buf_lock is released, so journal batches land in mutation order.
+        self._journal_lock = Lock()
+        self._cache: dict[tuple[int, int], list] = {}
+        self._dirty: set[tuple[int, int]] = set()
+        journal = settings.traffic_journal_path or f"{settings.traffic_sqlite_path}.journal"
+        self._journal_path = Path(journal).expanduser()
+        # Journal rotated out by a flush that has not committed yet.
+        self._flushing_path = self._journal_path.with_name(self._journal_path.name + ".flushing")
+        self._journal = None
+        self._recovered = False
+        self.task = PeriodicTask(
+            "traffic-flush",
+            self._flush_task,
+            interval_sec=settings.traffic_flush_interval_sec,
+        )
+
+    def start(self) -> None:
+        self.task.start()
+
+    def ensure_table(self, db: Session | None = None) -> None:
+        self.backend.ensure_table(db)
+        if self._recovered:
+            return
+        with self._buf_lock:
+            if not self._recovered:
+                self._replay_journal()
+                self._recovered = True
+
+    def _replay_journal(self) -> None:
+        rows: dict[tuple[int, int], tuple] = {}
+        for path in (self._flushing_path, self._journal_path):
+            if not path.exists():
+                continue
+            with open(path, "rb") as fh:
+                for line in fh:
+                    try:
+                        batch = json.loads(line)
+                    except ValueError:
+                        # Torn last line from a crash mid-append.
+                        continue
+                    for row in batch:
+                        rows[(int(row[0]), int(row[1]))] = tuple(row)
+        if rows:
+            self.backend.write_rows(list(rows.values()))
+            logger.info("[traffic-buffer] replayed %s row(s) from %s", len(rows), self._journal_path)
+        for path in (self._flushing_path, self._journal_path):
+            if path.exists():
+                path.unlink()
+
+    def _append_journal(self, batch: list[list]) -> None:
+        # Caller holds _journal_lock.
+        if not batch:
+            return
+        if self._journal is None:
+            self._journal_path.parent.mkdir(parents=True, exist_ok=True)
+            self._journal = open(self._journal_path, "ab")
+        self._journal.write(json.dumps(batch, separators=(",", ":")).encode() + b"\n")
+        # Into the page cache, so the entry survives the process (not the host) dying.
+        self._journal.flush()
+
+    def _rotate_journal(self) -> None:
+        # Caller holds _buf_lock and _journal_lock. Everything journaled so far moves to .flushing.
+        if self._journal is None:
+            return
+        self._journal.close()
+        self._journal = None
+        if self._flushing_path.exists():
+            # A previous flush failed: its rows are still uncommitted, keep them and add ours.
+            with open(self._flushing_path, "ab") as dst, open(self._journal_path, "rb") as src:
+                dst.write(src.read())
+            self._journal_path.unlink()
+        else:
+            os.replace(self._journal_path, self._flushing_path)
+
+    def _load(self, server_id: int, user_ids: list[int] | None) -> None:
+        """Pull rows not cached yet from the backend (all rows of the server when user_ids is None).
+
+        The backend is read without _buf_lock; a row missing from the cache is
+        not dirty, so the backend has its latest value. The rows go into the
+        cache under _buf_lock, since other threads iterate it, and setdefault
+        never replaces a row that was cached meanwhile.
+        """
+        sid = int(server_id)
+        if user_ids is not None:
+            user_ids = [int(uid) for uid in user_ids if (sid, int(uid)) not in self._cache]
+            if not user_ids:
+                return
+        rows = [
+            (
+                (sid, int(uid)),
+                [
+                    str(email or ""),
+                    max(0, int(last_up or 0)),
+                    max(0, int(last_down or 0)),
+                    max(0, int(total_up or 0)),
+                    max(0, int(total_down or 0)),
+                    # UTC isoformat() everywhere, so cached timestamps compare as strings.
+                    updated_at.astimezone(timezone.utc).isoformat() if isinstance(updated_at, datetime) else str(updated_at),
+                ],
+            )
+            for uid, email, last_up, last_down, total_up, total_down, updated_at
+            in self.backend.fetch_rows(server_id=sid, user_ids=user_ids)
+        ]
+        with self._buf_lock:
+            for key, row in rows:
+                self._cache.setdefault(key, row)
+
+    @staticmethod
+    def _totals(row: list) -> dict[str, int]:
+        return {"uplink": row[_TOTAL_UP], "downlink": row[_TOTAL_DOWN], "total": row[_TOTAL_UP] + row[_TOTAL_DOWN]}
+
+    @contextmanager
+    def _mutation(self):
+        """Hold _buf_lock while the block changes rows (appending their keys to the
+        yielded list); mark them dirty and journal them after the lock is released."""
+        changed: list[tuple[int, int]] = []
+        journal_locked = False
+        try:
+            with self._buf_lock:
+                try:
+                    yield changed
+                finally:
+                    # Rows changed before an error in the block are cached, so they are journaled too.
+                    self._dirty.update(changed)
+                    batch = [[sid, uid, *self._cache[(sid, uid)]] for sid, uid in changed]
+                    dirty = len(self._dirty)
+                    self._journal_lock.acquire()
+                    journal_locked = True
+        finally:
+            if journal_locked:
+                try:
+                    self._append_journal(batch)
+                finally:
+                    self._journal_lock.release()
+        if dirty >= max(1, settings.traffic_flush_max_rows):
+            self.task.trigger()
+
+    def apply_snapshot(
+        self,
+        db: Session,
+        *,
+        server_id: int,
+        user_id: int,
+        email: str,
+        current_uplink: int,
+        current_downlink: int,
+    ) -> dict[str, int]:
+        return self.apply_snapshots_bulk(
+            db,
+            server_id=server_id,
+            snapshots=[
+                {
+                    "user_id": user_id,
+                    "email": email,
+                    "available": True,
+                    "current_uplink": current_uplink,
+                    "current_downlink": current_downlink,
+                }
+            ],
+        )[int(user_id)]
+
+    def apply_snapshots_bulk(
+        self,
+        db: Session,
+        *,
+        server_id: int,
+        snapshots: list[dict],
+    ) -> dict[int, dict[str, int]]:
+        """Same rules as the SQL path: a counter below the last value means Xray restarted."""
+        self.ensure_table(db)
+        if not snapshots:
+            return {}
+
+        now_dt = datetime.now(timezone.utc)
+        now = now_dt.isoformat()
+        touch_before = (now_dt - _TOUCH_EVERY).isoformat()
+        sid = int(server_id)
+        result: dict[int, dict[str, int]] = {}
+        # Last one wins for duplicate user ids, as in the SQL path.
+        by_user_id = {int(item["user_id"]): item for item in snapshots}
+        self._load(sid, list(by_user_id))
+        items = list(by_user_id.items())
+        for i in range(0, len(items), _CHUNK_ROWS):
+            with self._mutation() as changed:
+                for uid, item in items[i:i + _CHUNK_ROWS]:
+                    self._apply_one(sid, uid, item, now, touch_before, changed)
+                    result[uid] = self._totals(self._cache[(sid, uid)])
+        return result
+
+    def _apply_one(
+        self, sid: int, uid: int, item: dict, now: str, touch_before: str, changed: list[tuple[int, int]]
+    ) -> None:
+        # Caller holds _buf_lock.
+        email = str(item.get("email") or "")
+        cur_up = max(0, int(item.get("current_uplink", 0) or 0))
+        cur_down = max(0, int(item.get("current_downlink", 0) or 0))
+        row = self._cache.get((sid, uid))
+        if row is None:
+            self._cache[(sid, uid)] = [email, cur_up, cur_down, cur_up, cur_down, now]
+            changed.append((sid, uid))
+        elif bool(item.get("available")):
+            if (
+                cur_up == row[_LAST_UP] and cur_down == row[_LAST_DOWN] and email == row[_EMAIL]
+                and row[_UPDATED] >= touch_before
+            ):
+                return
+            row[_EMAIL] = email
+            row[_TOTAL_UP] += cur_up - row[_LAST_UP] if cur_up >= row[_LAST_UP] else cur_up
+            row[_TOTAL_DOWN] += cur_down - row[_LAST_DOWN] if cur_down >= row[_LAST_DOWN] else cur_down
+            row[_LAST_UP] = cur_up
+            row[_LAST_DOWN] = cur_down
+            row[_UPDATED] = now
+            changed.append((sid, uid))
+        elif email != row[_EMAIL] or row[_UPDATED] < touch_before:
+            # Unavailable counters leave totals and last_* alone.
+            row[_EMAIL] = email
+            row[_UPDATED] = now
+            changed.append((sid, uid))
+
+    def add_deltas_bulk(
+        self,
+        db: Session,
+        *,
+        server_id: int,
+        deltas: list[dict],
+    ) -> dict[int, dict[str, int]]:
+        self.ensure_table(db)
+        if not deltas:
+            return {}
+
+        now = datetime.now(timezone.utc).isoformat()
+        sid = int(server_id)
+        result: dict[int, dict[str, int]] = {}
+        merged: dict[int, list] = {}
+        for item in deltas:
+            uid = int(item["user_id"])
+            up = max(0, int(item.get("uplink", 0) or 0))
+            down = max(0, int(item.get("downlink", 0) or 0))
+            if uid in merged:
+                merged[uid][1] += up
+                merged[uid][2] += down
+            else:
+                merged[uid] = [str(item.get("email") or ""), up, down]
+
+        self._load(sid, list(merged))
+        items = list(merged.items())
+        for i in range(0, len(items), _CHUNK_ROWS):
+            with self._mutation() as changed:
+                for uid, (email, up, down) in items[i:i + _CHUNK_ROWS]:
+                    row = self._cache.get((sid, uid))
+                    if row is None:
+                        row = self._cache[(sid, uid)] = [email, 0, 0, 0, 0, now]
+                    # Leftover last_* from absolute accounting are subtracted once, as in the SQL path.
+                    row[_TOTAL_UP] += up - row[_LAST_UP] if up >= row[_LAST_UP] else up
+                    row[_TOTAL_DOWN] += down - row[_LAST_DOWN] if down >= row[_LAST_DOWN] else down
+                    row[_LAST_UP] = 0
+                    row[_LAST_DOWN] = 0
+                    row[_EMAIL] = email
+                    row[_UPDATED] = now
+                    changed.append((sid, uid))
+                    result[uid] = self._totals(row)
+        return result
+
+    def get_totals(self, db: Session, *, server_id: int, user_id: int) -> dict[str, int]:
+        return self.get_totals_bulk(db, server_id=server_id, user_ids=[user_id]).get(
+            int(user_id), {"uplink": 0, "downlink": 0, "total": 0}
+        )
+
+    def get_totals_bulk(self, db: Session, *, server_id: int, user_ids: list[int]) -> dict[int, dict[str, int]]:
+        self.ensure_table(db)
+        if not user_ids:
+            return {}
+        sid = int(server_id)
+        self._load(sid, user_ids)
+        with self._buf_lock:
+            return {
+                int(uid): self._totals(self._cache[(sid, int(uid))])
+                for uid in user_ids
+                if (sid, int(uid)) in self._cache
+            }
+
+    def reset_users(self, db: Session, *, server_id: int, user_ids: list[int] | None = None) -> int:
+        self.ensure_table(db)
+        now = datetime.now(timezone.utc).isoformat()
+        sid = int(server_id)
+        # Like the backends: no user ids means every row of the server.
+        user_ids = user_ids or None
+        self._load(sid, user_ids)
+        with self._mutation() as changed:
+            if user_ids is None:
+                changed.extend(key for key in self._cache if key[0] == sid)
+            else:
+                changed.extend((sid, int(uid)) for uid in user_ids if (sid, int(uid)) in self._cache)
+            for key in changed:
+                row = self._cache[key]
+                row[_LAST_UP] = row[_LAST_DOWN] = row[_TOTAL_UP] = row[_TOTAL_DOWN] = 0
+                row[_UPDATED] = now
+        return len(changed)
+
+    def fetch_quotas(self, *, server_id: int) -> dict[int, tuple[int | None, bool]]:
+        # Quota columns are never cached or flushed: they go straight to the backend.
+        self.ensure_table()
+        return self.backend.fetch_quotas(server_id=server_id)
+
+    def set_quotas(self, *, server_id: int, quotas: dict[int, int | None]) -> None:
+        self.ensure_table()
+        self.backend.set_quotas(server_id=server_id, quotas=quotas)
+
+    def set_quota_disabled(self, *, server_id: int, user_ids: list[int], disabled: bool) -> None:
+        self.ensure_table()
+        self.backend.set_quota_disabled(server_id=server_id, user_ids=user_ids, disabled=disabled)
+
+    def fetch_reset_schedules(self, *, server_id: int, user_ids: list[int] | None = None) -> dict[int, dict]:
+        # Schedules and archived periods are never cached either.
+        self.ensure_table()
+        return self.backend.fetch_reset_schedules(server_id=server_id, user_ids=user_ids)
+
+    def set_reset_schedules(self, *, server_id: int, schedules: dict[int, dict | None]) -> None:
+        self.ensure_table()
+        self.backend.set_reset_schedules(server_id=server_id, schedules=schedules)
+
+    def next_reset_at(self, *, server_id: int) -> datetime | None:
+        self.ensure_table()
+        return self.backend.next_reset_at(server_id=server_id)
+
+    def fetch_periods(self, *, server_id: int, user_id: int, limit: int = 12) -> list[dict]:
+        self.ensure_table()
+        return self.backend.fetch_periods(server_id=server_id, user_id=user_id, limit=limit)
+
+    def prune_periods(self, *, server_id: int, ended_before: datetime) -> int:
+        self.ensure_table()
+        return self.backend.prune_periods(server_id=server_id, ended_before=ended_before)
+
+    def roll_over_due(self, *, server_id: int, now: datetime) -> list[dict]:
+        """Flush, let the backend archive and zero the due totals, then zero them in the cache.
+
+        Holds _flush_lock and _buf_lock throughout, so no update lands between
+        the flush and the rollover and gets written back over the zeroes
+        later. Only called when a reset is due.
+        """
+        self.ensure_table()
+        sid = int(server_id)
+        with self._flush_lock, self._buf_lock:
+            if self._dirty:
+                rows = [(s, uid, *self._cache[(s, uid)]) for s, uid in self._dirty]
+                with self._journal_lock:
+                    self._rotate_journal()
+                # On failure the rows stay dirty and in .flushing, as after a failed flush().
+                self.backend.write_rows(rows)
+                self._dirty = set()
+                if self._flushing_path.exists():
+                    self._flushing_path.unlink()
+            rolled = self.backend.roll_over_due(server_id=sid, now=now)
+            for item in rolled:
+                row = self._cache.get((sid, int(item["user_id"])))
+                if row is not None:
+                    row[_TOTAL_UP] = row[_TOTAL_DOWN] = 0
+        return rolled
+
+    def prune_users(
+        self,
+        db: Session | None,
+        *,
+        server_id: int,
+        keep_user_ids: set[int],
+        updated_before: datetime,
+    ) -> list[int]:
+        """Drop stale rows of users outside `keep_user_ids` from the cache and the backend.
+
+        The backend decides: it keeps rows holding a quota or a reset
+        schedule, which the cache does not carry, so a stale cached row goes
+        only if the backend pruned it or never had it. Runs under _flush_lock
+        so no flush in flight writes a dropped row back. Journal entries of
+        dropped rows may still be replayed after a crash; they are as stale
+        as before and go on the next run.
+        """
+        self.ensure_table(db)
+        sid = int(server_id)
+        keep = {int(uid) for uid in keep_user_ids}
+        cutoff = updated_before.astimezone(timezone.utc).isoformat()
+        with self._flush_lock:
+            pruned = set(self.backend.prune_users(
+                db, server_id=sid, keep_user_ids=keep, updated_before=updated_before
+            ))
+            with self._buf_lock:
+                stale = [
+                    key for key, row in self._cache.items()
+                    if key[0] == sid and key[1] not in keep and row[_UPDATED] < cutoff
+                ]
+            kept = {int(row[0]) for row in self.backend.fetch_rows(
+                server_id=sid, user_ids=[uid for _, uid in stale if uid not in pruned]
+            )} if stale else set()
+            with self._buf_lock:
+                # Rows applied again since the first look are no longer stale.
+                dropped = [
+                    key for key in stale
+                    if key[1] not in kept and key in self._cache and self._cache[key][_UPDATED] < cutoff
+                ]
+                for key in dropped:
+                    del self._cache[key]
+                    self._dirty.discard(key)
+        return sorted(pruned | {uid for _, uid in dropped})
+
+    def flush(self) -> int:
+        """Write every dirty row to the backend in one transaction; returns how many."""
+        self.ensure_table()
+        with self._flush_lock:
+            with self._buf_lock:
+                if not self._dirty:
+                    return 0
+                keys = self._dirty
+                self._dirty = set()
+                rows = [(sid, uid, *self._cache[(sid, uid)]) for sid, uid in keys]
+                with self._journal_lock:
+                    self._rotate_journal()
+            try:
+                # Outside _buf_lock: callers keep reading and writing the cache meanwhile.
+                self.backend.write_rows(rows)
+            except Exception:
+                with self._buf_lock:
+                    self._dirty |= keys
+                raise
+            if self._flushing_path.exists():
+                self._flushing_path.unlink()
+        logger.debug("[traffic-buffer] flushed %s row(s)", len(rows))
+        return len(rows)
+
+    def _flush_task(self) -> None:
+        try:
+            self.flush()
+        except Exception as exc:
+            logger.error("[traffic-buffer] flush failed, rows stay buffered and journaled: %s", exc)
+
+    def close(self) -> None:
+        self.task.stop()
+        try:
+            self.flush()
+        except Exception as exc:
+            logger.error("[traffic-buffer] final flush failed, journal kept for replay: %s", exc)
+        with self._journal_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+        self.backend.close()
+
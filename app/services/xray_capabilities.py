@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+from dataclasses import asdict, dataclass, replace
+from threading import Lock
+
+from fastapi import HTTPException
+
+from app.config import settings
+from app.services.xray_grpc_client import XrayGrpcClient, get_grpc_client
+from app.utils.grpc_codec import (
+    decode_query_stats_response,
+    encode_get_inbound_user_request,
+    encode_get_stats_request,
+    encode_query_stats_request,
+)
+from app.utils.subprocess_run import run_cmd
+
+
+logger = logging.getLogger("xray-agent")
+
+STATS_NAMESPACES = (
+    "xray.app.stats.command.StatsService",
+    "v2ray.core.app.stats.command.StatsService",
+)
+GET_INBOUND_USERS_METHOD = "xray.app.proxyman.command.HandlerService/GetInboundUsers"
+ONLINE_STAT_SUFFIXES = (">>>online", ">>>online>>>count")
+
+# Counter name that never exists: GetStats answers "not found" when the method does.
+_PROBE_STAT = "xray-agent>>>probe>>>traffic>>>uplink"
+# Not a valid RE2 pattern: builds honouring `regexp` reject it, older ones look for it as a substring
+# and find nothing. Either way the answer does not depend on which counters exist yet.
+_PROBE_REGEXP = "xray-agent>>>probe>>>("
+# Both online counter families contain it, and no traffic counter does.
+_ONLINE_PATTERN = ">>>online"
+
+
+@dataclass(frozen=True)
+class XrayCapabilities:
+    """What the connected Xray exposes, as found by one probe.
+
+    `stats_via` is how single counters are read: "grpc" / "grpcurl" with
+    `stats_service` as the StatsService name, "cli" for `xray api`, or None
+    when stats are not available at all. `query_stats_via` is the same for
+    pattern queries ("grpc" or "cli"). `query_stats_regexp` tells whether
+    QueryStats over gRPC honours `regexp = 4` (older builds skip the field and
+    match the pattern as a plain substring). `online_stat_suffix` is the
+    per-user online counter family seen in QueryStats, None until one shows up.
+    """
+
+    probed: bool
+    probed_at: float
+    stats_via: str | None
+    stats_service: str | None
+    query_stats_via: str | None
+    online_stat_suffix: str | None
+    inbound_users_listing: bool
+    query_stats_regexp: bool
+
+    @property
+    def get_stats_method(self) -> str | None:
+        return f"{self.stats_service}/GetStats" if self.stats_service else None
+
+    @property
+    def query_stats_method(self) -> str | None:
+        return f"{self.stats_service}/QueryStats" if self.stats_service else None
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def _assumed(backend: str) -> XrayCapabilities:
+    # Used until a probe succeeds: current Xray names, no per-user online or regexp queries.
+    return XrayCapabilities(
+        probed=False,
+        probed_at=0.0,
+        stats_via=backend,
+        stats_service=STATS_NAMESPACES[0],
+        query_stats_via="grpc" if backend == "grpc" else "cli",
+        online_stat_suffix=None,
+        inbound_users_listing=True,
+        query_stats_regexp=False,
+    )
+
+
+def _online_suffix(names: list[str]) -> str | None:
+    for suffix in ONLINE_STAT_SUFFIXES:
+        if any(name.endswith(suffix) for name in names):
+            return suffix
+    return None
+
+
+def _detail(exc: Exception) -> str:
+    return str(exc.detail) if isinstance(exc, HTTPException) else str(exc)
+
+
+def _is_unsupported(detail: str) -> bool:
+    low = detail.lower()
+    return any(
+        marker in low
+        for marker in ("unimplemented", "unknown method", "unknown service", "does not expose service", "failed to find")
+    )
+
+
+def _is_not_found(detail: str) -> bool:
+    low = detail.lower()
+    return "not found" in low or "notfound" in low
+
+
+def _is_transient(detail: str) -> bool:
+    low = detail.lower()
+    return any(
+        marker in low
+        for marker in ("unavailable", "deadline", "timed out", "connection refused", "failed to dial")
+    )
+
+
+class XrayCapabilityRegistry:
+    """Probes the Xray API once and serves the result as a dispatch table.
+
+    The probe runs at startup and again after Xray was seen unreachable
+    (a restart may bring a different build). While no probe has succeeded,
+    `get()` returns assumed defaults and retries at most every `retry_sec`.
+    Online counters only exist once someone has connected, which on a fresh
+    Xray is after the probe, so until a family is found `get()` looks for
+    them again at most every `online_retry_sec`.
+    """
+
+    def __init__(
+        self,
+        backend: str | None = None,
+        grpc_client: XrayGrpcClient | None = None,
+        *,
+        retry_sec: float = 30.0,
+        online_retry_sec: float = 60.0,
+    ):
+        self.backend = (backend or settings.xray_api_backend).lower()
+        self._grpc_client = grpc_client
+        self.retry_sec = retry_sec
+        self.online_retry_sec = online_retry_sec
+        self._caps: XrayCapabilities | None = None
+        self._last_attempt = 0.0
+        self._last_online_check = 0.0
+        self._lock = Lock()
+
+    @property
+    def grpc(self) -> XrayGrpcClient:
+        return self._grpc_client or get_grpc_client()
+
+    def get(self) -> XrayCapabilities:
+        caps = self._caps
+        if caps is not None:
+            if caps.online_stat_suffix is None and caps.query_stats_via is not None:
+                return self._recheck_online(caps)
+            return caps
+        if time.monotonic() - self._last_attempt >= self.retry_sec and self._lock.acquire(blocking=False):
+            try:
+                return self._probe_locked()
+            except Exception as exc:
+                logger.warning("[xray-caps] probe failed: %s", _detail(exc))
+            finally:
+                self._lock.release()
+        return _assumed(self.backend)
+
+    def probe(self) -> XrayCapabilities:
+        with self._lock:
+            return self._probe_locked()
+
+    def _recheck_online(self, caps: XrayCapabilities) -> XrayCapabilities:
+        if time.monotonic() - self._last_online_check < self.online_retry_sec or not self._lock.acquire(blocking=False):
+            return caps
+        try:
+            self._last_online_check = time.monotonic()
+            suffix = _online_suffix(self._stat_names(caps.stats_service, caps.query_stats_via, _ONLINE_PATTERN))
+            if suffix and self._caps is caps:
+                caps = self._caps = replace(caps, online_stat_suffix=suffix)
+                logger.info("[xray-caps] per-user online counters appeared: %s", suffix)
+        except Exception as exc:
+            logger.debug("[xray-caps] online counter check failed: %s", _detail(exc))
+        finally:
+            self._lock.release()
+        return caps
+
+    def invalidate(self) -> None:
+        self._caps = None
+        self._last_attempt = 0.0
+
+    def note_error(self, exc: Exception) -> None:
+        """Forget the table when Xray looks unreachable, so it is re-probed after reconnect."""
+        if self._caps is not None and _is_transient(_detail(exc)):
+            logger.info("[xray-caps] xray unreachable, will re-probe: %s", _detail(exc))
+            self.invalidate()
+
+    def _call(self, method: str, request: bytes, payload: dict) -> bytes:
+        if self.backend == "grpc":
+            return self.grpc.call(method, request)
+        return run_cmd([
+            settings.grpcurl_bin, "-plaintext",
+            "-protoset", settings.protoset,
+            "-d", json.dumps(payload, separators=(",", ":")),
+            settings.xray_addr, method,
+        ])
+
+    def _method_exists(self, method: str, request: bytes, payload: dict) -> bool:
+        try:
+            self._call(method, request, payload)
+            return True
+        except Exception as exc:
+            detail = _detail(exc)
+            if _is_not_found(detail):
+                return True
+            if _is_transient(detail) or not _is_unsupported(detail):
+                raise
+            return False
+
+    def _stat_names(self, stats_service: str | None, via: str | None, pattern: str) -> list[str]:
+        """Names of the counters matching `pattern`, read the way `via` says."""
+        if via == "grpc":
+            raw = self.grpc.call(f"{stats_service}/QueryStats", encode_query_stats_request(pattern=pattern))
+            return list(decode_query_stats_response(raw))
+        out = run_cmd([
+            settings.xray_bin, "api", "statsquery",
+            f"--server={settings.xray_addr}", "-pattern", pattern,
+        ]).decode(errors="replace").strip()
+        data = json.loads(out) if out else {}
+        return [str(item.get("name") or "") for item in (data.get("stat") or []) if isinstance(item, dict)]
+
+    def _probe_locked(self) -> XrayCapabilities:
+        self._last_attempt = time.monotonic()
+        started = time.perf_counter()
+
+        stats_service = None
+        for service in STATS_NAMESPACES:
+            if self._method_exists(
+                f"{service}/GetStats",
+                encode_get_stats_request(name=_PROBE_STAT),
+                {"name": _PROBE_STAT},
+            ):
+                stats_service = service
+                break
+
+        stats_via = self.backend if stats_service else None
+        names: list[str] = []
+        query_stats_via = None
+        if stats_service and self.backend == "grpc":
+            try:
+                names = self._stat_names(stats_service, "grpc", _ONLINE_PATTERN)
+                query_stats_via = "grpc"
+            except Exception as exc:
+                if _is_transient(_detail(exc)):
+                    raise
+        if query_stats_via is None:
+            # grpcurl backend, or a build without QueryStats over gRPC: the xray CLI embeds its own protos.
+            try:
+                names = self._stat_names(stats_service, "cli", _ONLINE_PATTERN)
+                query_stats_via = "cli"
+                stats_via = stats_via or "cli"
+            except Exception as exc:
+                if _is_transient(_detail(exc)):
+                    raise
+
+        query_stats_regexp = False
+        if query_stats_via == "grpc":
+            # Only a build that compiles the pattern fails with "error parsing regexp".
+            try:
+                self.grpc.call(
+                    f"{stats_service}/QueryStats", encode_query_stats_request(pattern=_PROBE_REGEXP, regexp=True)
+                )
+            except Exception as exc:
+                detail = _detail(exc)
+                if _is_transient(detail):
+                    raise
+                query_stats_regexp = "regexp" in detail.lower()
+
+        online_stat_suffix = _online_suffix(names)
+        self._last_online_check = time.monotonic()
+
+        inbound_users_listing = self._method_exists(
+            GET_INBOUND_USERS_METHOD,
+            encode_get_inbound_user_request(tag=settings.inbound_tag),
+            {"tag": settings.inbound_tag},
+        )
+
+        caps = XrayCapabilities(
+            probed=True,
+            probed_at=time.time(),
+            stats_via=stats_via,
+            stats_service=stats_service,
+            query_stats_via=query_stats_via,
+            online_stat_suffix=online_stat_suffix,
+            inbound_users_listing=inbound_users_listing,
+            query_stats_regexp=query_stats_regexp,
+        )
+        self._caps = caps
+        logger.info(
+            "[xray-caps] probed in %.3fs: stats_via=%s service=%s query_via=%s regexp=%s online=%s inbound_users=%s",
+            time.perf_counter() - started, stats_via, stats_service, query_stats_via, query_stats_regexp,
+            online_stat_suffix, inbound_users_listing,
+        )
+        return caps
+
+
+xray_capabilities = XrayCapabilityRegistry()
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import itertools
+import logging
+from threading import Lock
+from typing import Any
+
+from fastapi import HTTPException
+
+from app.config import settings
+
+
+logger = logging.getLogger("xray-agent")
+
+
+class XrayGrpcClient:
+    """Persistent pool of plaintext gRPC channels to the Xray API.
+
+    Calls are made with raw bytes in/out, so no generated stubs are needed:
+    callers pass an already-serialized request message and get the serialized
+    response back. Errors are surfaced as HTTPException with a grpcurl-like
+    detail, so existing checks (e.g. "already exists") keep working.
+    """
+
+    def __init__(self, addr: str | None = None, pool_size: int | None = None, timeout: float | None = None):
+        self.addr = addr or settings.xray_addr
+        self.pool_size = max(1, int(pool_size or settings.xray_grpc_pool_size))
+        self.timeout = float(timeout or settings.xray_grpc_timeout_sec)
+        self._lock = Lock()
+        self._channels: list[Any] = []
+        self._callables: dict[tuple[int, str], Any] = {}
+        self._rr = itertools.count()
+
+    def _ensure_channels(self) -> list[Any]:
+        if self._channels:
+            return self._channels
+        with self._lock:
+            if not self._channels:
+                import grpc
+
+                options = [
+                    ("grpc.keepalive_time_ms", 30_000),
+                    ("grpc.keepalive_permit_without_calls", 1),
+                    # Separate subchannels per pooled channel instead of one shared TCP connection.
+                    ("grpc.use_local_subchannel_pool", 1),
+                ]
+                self._channels = [grpc.insecure_channel(self.addr, options=options) for _ in range(self.pool_size)]
+                logger.info("[grpc] opened %s channel(s) to %s", self.pool_size, self.addr)
+        return self._channels
+
+    def _callable(self, method: str) -> Any:
+        channels = self._ensure_channels()
+        idx = next(self._rr) % len(channels)
+        key = (idx, method)
+        fn = self._callables.get(key)
+        if fn is None:
+            fn = channels[idx].unary_unary(f"/{method}")
+            self._callables[key] = fn
+        return fn
+
+    def call(self, method: str, request: bytes, *, timeout: float | None = None) -> bytes:
+        import grpc
+
+        fn = self._callable(method)
+        try:
+            return fn(request, timeout=timeout or self.timeout)
+        except grpc.RpcError as exc:
+            code = exc.code().name if exc.code() is not None else "UNKNOWN"
+            raise HTTPException(status_code=500, detail=f"Code: {code}\nMessage: {exc.details()}")
+
+    def close(self) -> None:
+        with self._lock:
+            for ch in self._channels:
+                ch.close()
+            self._channels = []
+            self._callables = {}
+
+
+_shared: XrayGrpcClient | None = None
+_shared_lock = Lock()
+
+
+def get_grpc_client() -> XrayGrpcClient:
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = XrayGrpcClient()
+    return _shared
+
+
+def close_grpc_client() -> None:
+    global _shared
+    with _shared_lock:
+        if _shared is not None:
+            _shared.close()
+            _shared = None
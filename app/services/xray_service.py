@@ -1,76 +1,142 @@
+import base64
+import json
+
 from fastapi import HTTPException
 from app.config import settings
-from app.utils.grpc_codec import encode_proto, bytes_to_hex_escape, b64
+from app.services.xray_grpc_client import XrayGrpcClient, get_grpc_client
+from app.utils.grpc_codec import (
+    ADD_USER_OPERATION_TYPE,
+    REMOVE_USER_OPERATION_TYPE,
+    VLESS_ACCOUNT_TYPE,
+    b64,
+    decode_get_inbound_user_response,
+    decode_vless_account_id,
+    encode_add_user_operation,
+    encode_alter_inbound_request,
+    encode_get_inbound_user_request,
+    encode_remove_user_operation,
+)
 from app.utils.subprocess_run import run_cmd
 
 
+ALTER_INBOUND_METHOD = "xray.app.proxyman.command.HandlerService/AlterInbound"
+GET_INBOUND_USERS_METHOD = "xray.app.proxyman.command.HandlerService/GetInboundUsers"
+
+_TRANSIENT_MARKERS = (
+    "unavailable",
+    "deadline",
+    "timed out",
+    "timeout",
+    "connection refused",
+    "failed to dial",
+    "resource_exhausted",
+    "resourceexhausted",
+)
+
+
 class XrayService:
-    def add_user(self, *, email: str, level: int, uid: str) -> str:
-        account_text = f'id: "{uid}"\n'
-        account_bin = encode_proto("xray.proxy.vless.Account", account_text, "proxy/vless/account.proto")
-        account_hex = bytes_to_hex_escape(account_bin)
-
-        add_user_text = f'''
-user {{
-  email: "{email}"
-  level: {level}
-  account {{
-    type: "xray.proxy.vless.Account"
-    value: "{account_hex}"
-  }}
-}}
-'''.lstrip()
-
-        add_user_bin = encode_proto(
-            "xray.app.proxyman.command.AddUserOperation",
-            add_user_text,
-            "app/proxyman/command/command.proto",
-        )
-        add_user_b64 = b64(add_user_bin)
+    def __init__(self, backend: str | None = None, grpc_client: XrayGrpcClient | None = None):
+        self.backend = (backend or settings.xray_api_backend).lower()
+        if self.backend not in ("grpc", "grpcurl"):
+            raise ValueError(f"Unknown xray api backend: {self.backend}")
+        self._grpc_client = grpc_client
+
+    @property
+    def grpc(self) -> XrayGrpcClient:
+        return self._grpc_client or get_grpc_client()
+
+    def _alter_inbound(self, operation_type: str, operation_bin: bytes, *, timeout: float | None = None) -> str:
+        if self.backend == "grpc":
+            request_bin = encode_alter_inbound_request(
+                tag=settings.inbound_tag,
+                operation_type=operation_type,
+                operation=operation_bin,
+            )
+            self.grpc.call(ALTER_INBOUND_METHOD, request_bin, timeout=timeout)
+            # AlterInboundResponse is empty; mirror grpcurl's JSON output.
+            return "{}\n"
 
         payload = (
             '{'
             f'"tag":"{settings.inbound_tag}",'
             '"operation":{'
-              '"type":"xray.app.proxyman.command.AddUserOperation",'
-              f'"value":"{add_user_b64}"'
+              f'"type":"{operation_type}",'
+              f'"value":"{b64(operation_bin)}"'
             '}}'
         )
 
+        cmd = [settings.grpcurl_bin, "-plaintext"]
+        if timeout:
+            cmd += ["-max-time", f"{float(timeout):g}"]
         out = run_cmd([
-            settings.grpcurl_bin, "-plaintext",
+            *cmd,
             "-protoset", settings.protoset,
             "-d", payload,
-            settings.xray_addr, "xray.app.proxyman.command.HandlerService/AlterInbound",
+            settings.xray_addr, ALTER_INBOUND_METHOD,
         ]).decode()
         return out
 
-    def remove_user(self, *, email: str) -> str:
-        remove_text = f'email: "{email}"\n'
-        remove_bin = encode_proto(
-            "xray.app.proxyman.command.RemoveUserOperation",
-            remove_text,
-            "app/proxyman/command/command.proto",
-        )
-        remove_b64 = b64(remove_bin)
+    def add_user(self, *, email: str, level: int, uid: str, timeout: float | None = None) -> str:
+        add_user_bin = encode_add_user_operation(email=email, level=level, uid=uid)
+        return self._alter_inbound(ADD_USER_OPERATION_TYPE, add_user_bin, timeout=timeout)
 
-        payload = (
-            '{'
-            f'"tag":"{settings.inbound_tag}",'
-            '"operation":{'
-              '"type":"xray.app.proxyman.command.RemoveUserOperation",'
-              f'"value":"{remove_b64}"'
-            '}}'
-        )
+    def remove_user(self, *, email: str, timeout: float | None = None) -> str:
+        remove_bin = encode_remove_user_operation(email=email)
+        return self._alter_inbound(REMOVE_USER_OPERATION_TYPE, remove_bin, timeout=timeout)
+
+    def list_inbound_users(self, *, timeout: float | None = None) -> dict[str, str]:
+        """Users currently loaded in the inbound as {email: uuid} (uuid is "" for non-VLESS accounts).
+
+        Needs an Xray build with HandlerService/GetInboundUsers; older builds
+        raise HTTPException with an Unimplemented / unknown method detail.
+        """
+        if self.backend == "grpc":
+            raw = self.grpc.call(
+                GET_INBOUND_USERS_METHOD,
+                encode_get_inbound_user_request(tag=settings.inbound_tag),
+                timeout=timeout,
+            )
+            return {u["email"]: u["uuid"] for u in decode_get_inbound_user_response(raw) if u["email"]}
 
         out = run_cmd([
             settings.grpcurl_bin, "-plaintext",
             "-protoset", settings.protoset,
-            "-d", payload,
-            settings.xray_addr, "xray.app.proxyman.command.HandlerService/AlterInbound",
-        ]).decode()
-        return out
+            "-d", json.dumps({"tag": settings.inbound_tag}, separators=(",", ":")),
+            settings.xray_addr, GET_INBOUND_USERS_METHOD,
+        ]).decode(errors="replace").strip()
+        data = json.loads(out) if out else {}
+        users: dict[str, str] = {}
+        for u in (data.get("users") or []):
+            email = str(u.get("email") or "")
+            if not email:
+                continue
+            account = u.get("account") or {}
+            uid = ""
+            if account.get("type") == VLESS_ACCOUNT_TYPE and account.get("value"):
+                uid = decode_vless_account_id(base64.b64decode(account["value"]))
+            users[email] = uid
+        return users
+
+    @staticmethod
+    def is_unsupported_error(detail: str) -> bool:
+        low = (detail or "").lower()
+        return "unimplemented" in low or "unknown method" in low or "does not expose service" in low
+
+    @staticmethod
+    def error_detail(exc: Exception) -> str:
+        if isinstance(exc, HTTPException):
+            return str(exc.detail)
+        return str(exc)
 
     @staticmethod
     def is_already_exists_error(detail: str) -> bool:
         return "already exists" in (detail or "").lower()
+
+    @staticmethod
+    def is_not_found_error(detail: str) -> bool:
+        return "not found" in (detail or "").lower()
+
+    @staticmethod
+    def is_transient_error(detail: str) -> bool:
+        low = (detail or "").lower()
+        return any(marker in low for marker in _TRANSIENT_MARKERS)
@@ -1,3 +1,5 @@
+import re
+
 from app.models import Key
 
 
@@ -7,3 +9,12 @@ def email_for_key(k: Key) -> str:
 
 def email_for_user_id(uid: int) -> str:
     return f"user-{uid}@lunet"
+
+
+_MANAGED_EMAIL_RE = re.compile(r"^user-(\d+)@lunet$")
+
+
+def user_id_from_email(email: str) -> int | None:
+    """user_id for emails the agent generates itself; None for anything else."""
+    m = _MANAGED_EMAIL_RE.match(email or "")
+    return int(m.group(1)) if m else None
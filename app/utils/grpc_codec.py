@@ -1,27 +1,299 @@
 import base64
-from app.config import settings
-from app.utils.subprocess_run import run_cmd
 
 
-def encode_proto(type_name: str, textproto: str, proto_rel_path: str) -> bytes:
-    cmd = [
-        settings.protoc_bin,
-        f"--encode={type_name}",
-        "-I", settings.proto_root,
-        "-I", f"{settings.proto_root}/common",
-        "-I", f"{settings.proto_root}/app",
-        "-I", f"{settings.proto_root}/proxy",
-        "-I", f"{settings.proto_root}/infra",
-        "-I", f"{settings.proto_root}/transport",
-        "-I", f"{settings.proto_root}/core",
-        f"{settings.proto_root}/{proto_rel_path}",
-    ]
-    return run_cmd(cmd, stdin=textproto.encode())
+VLESS_ACCOUNT_TYPE = "xray.proxy.vless.Account"
+ADD_USER_OPERATION_TYPE = "xray.app.proxyman.command.AddUserOperation"
+REMOVE_USER_OPERATION_TYPE = "xray.app.proxyman.command.RemoveUserOperation"
 
-
-def bytes_to_hex_escape(data: bytes) -> str:
-    return "".join(f"\\x{b:02x}" for b in data)
+_WIRE_VARINT = 0
+_WIRE_I64 = 1
+_WIRE_LEN = 2
+_WIRE_I32 = 5
 
 
 def b64(data: bytes) -> str:
     return base64.b64encode(data).decode()
+
+
+# Proto3 wire-format encoding for the few Xray messages the agent sends.
+# Output matches `protoc --encode`: fields in tag order, defaults (0 / "") omitted.
+
+def _varint(value: int) -> bytes:
+    if value < 0:
+        raise ValueError(f"varint must be non-negative, got {value}")
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _field_varint(field: int, value: int) -> bytes:
+    if not value:
+        return b""
+    return _varint(field << 3 | _WIRE_VARINT) + _varint(value)
+
+
+def _field_bytes(field: int, value: bytes) -> bytes:
+    if not value:
+        return b""
+    return _varint(field << 3 | _WIRE_LEN) + _varint(len(value)) + value
+
+
+def _field_str(field: int, value: str) -> bytes:
+    return _field_bytes(field, (value or "").encode())
+
+
+def _field_message(field: int, value: bytes) -> bytes:
+    # Sub-message fields are emitted even when empty (presence semantics).
+    return _varint(field << 3 | _WIRE_LEN) + _varint(len(value)) + value
+
+
+def encode_typed_message(type_name: str, value: bytes) -> bytes:
+    """xray.common.serial.TypedMessage {type = 1; value = 2}"""
+    return _field_str(1, type_name) + _field_bytes(2, value)
+
+
+def encode_vless_account(uid: str, *, flow: str = "", encryption: str = "") -> bytes:
+    """xray.proxy.vless.Account {id = 1; flow = 2; encryption = 3}"""
+    return _field_str(1, uid) + _field_str(2, flow) + _field_str(3, encryption)
+
+
+def encode_user(*, email: str, level: int, account: bytes) -> bytes:
+    """xray.common.protocol.User {level = 1; email = 2; account = 3 (TypedMessage)}"""
+    if not 0 <= int(level) <= 0xFFFFFFFF:
+        raise ValueError(f"level must fit uint32, got {level}")
+    return _field_varint(1, int(level)) + _field_str(2, email) + _field_message(3, account)
+
+
+def encode_add_user_operation(*, email: str, level: int, uid: str) -> bytes:
+    """xray.app.proxyman.command.AddUserOperation {user = 1} with a VLESS account."""
+    account = encode_typed_message(VLESS_ACCOUNT_TYPE, encode_vless_account(uid))
+    return _field_message(1, encode_user(email=email, level=level, account=account))
+
+
+def encode_remove_user_operation(*, email: str) -> bytes:
+    """xray.app.proxyman.command.RemoveUserOperation {email = 1}"""
+    return _field_str(1, email)
+
+
+def encode_alter_inbound_request(*, tag: str, operation_type: str, operation: bytes) -> bytes:
+    """xray.app.proxyman.command.AlterInboundRequest {tag = 1; operation = 2 (TypedMessage)}"""
+    return _field_str(1, tag) + _field_message(2, encode_typed_message(operation_type, operation))
+
+
+def encode_get_inbound_user_request(*, tag: str, email: str = "") -> bytes:
+    """xray.app.proxyman.command.GetInboundUserRequest {tag = 1; email = 2}"""
+    return _field_str(1, tag) + _field_str(2, email)
+
+
+def encode_query_stats_request(
+    *, pattern: str = "", reset: bool = False, patterns: list[str] | tuple[str, ...] = (), regexp: bool = False
+) -> bytes:
+    """xray.app.stats.command.QueryStatsRequest {pattern = 1; reset = 2; repeated patterns = 3; regexp = 4}
+
+    Builds that predate fields 3 and 4 skip them as unknown fields.
+    """
+    # Repeated elements are emitted even when empty, unlike singular proto3 strings.
+    repeated = b"".join(_field_message(3, p.encode()) for p in patterns)
+    return _field_str(1, pattern) + _field_varint(2, int(bool(reset))) + repeated + _field_varint(4, int(bool(regexp)))
+
+
+_REGEXP_META = set("\\.+*?()|[]{}^$")
+
+
+def quote_regexp(value: str) -> str:
+    """Escape `value` for a literal match in an RE2 (Go regexp) pattern, like regexp.QuoteMeta."""
+    return "".join("\\" + ch if ch in _REGEXP_META else ch for ch in value)
+
+
+def encode_get_stats_request(*, name: str, reset: bool = False) -> bytes:
+    """xray.app.stats.command.GetStatsRequest {name = 1; reset = 2}"""
+    return _field_str(1, name) + _field_varint(2, int(bool(reset)))
+
+
+# Decoding: just enough to read responses of the calls above.
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("truncated varint")
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _skip_field(data: bytes, pos: int, wire_type: int) -> int:
+    if wire_type == _WIRE_VARINT:
+        return _read_varint(data, pos)[1]
+    if wire_type == _WIRE_LEN:
+        size, pos = _read_varint(data, pos)
+        return pos + size
+    if wire_type == _WIRE_I64:
+        return pos + 8
+    if wire_type == _WIRE_I32:
+        return pos + 4
+    raise ValueError(f"unsupported wire type {wire_type}")
+
+
+def iter_fields(data: bytes):
+    """Yield (field_number, wire_type, value) for each field in a serialized message.
+
+    Varints come back as int, length-delimited fields as bytes; fixed-width
+    fields are returned as raw bytes.
+    """
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = _read_varint(data, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == _WIRE_VARINT:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == _WIRE_LEN:
+            size, pos = _read_varint(data, pos)
+            value = data[pos:pos + size]
+            if len(value) != size:
+                raise ValueError("truncated length-delimited field")
+            pos += size
+        elif wire_type == _WIRE_I64:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == _WIRE_I32:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"unsupported wire type {wire_type}")
+        yield field, wire_type, value
+
+
+def decode_typed_message(data: bytes) -> tuple[str, bytes]:
+    type_name, value = "", b""
+    for field, _, raw in iter_fields(data):
+        if field == 1:
+            type_name = raw.decode(errors="replace")
+        elif field == 2:
+            value = raw
+    return type_name, value
+
+
+def decode_vless_account_id(data: bytes) -> str:
+    for field, _, raw in iter_fields(data):
+        if field == 1:
+            return raw.decode(errors="replace")
+    return ""
+
+
+def decode_user(data: bytes) -> dict:
+    """xray.common.protocol.User -> {email, level, account_type, uuid}"""
+    user = {"email": "", "level": 0, "account_type": "", "uuid": ""}
+    for field, _, raw in iter_fields(data):
+        if field == 1:
+            user["level"] = int(raw)
+        elif field == 2:
+            user["email"] = raw.decode(errors="replace")
+        elif field == 3:
+            account_type, account = decode_typed_message(raw)
+            user["account_type"] = account_type
+            if account_type == VLESS_ACCOUNT_TYPE:
+                user["uuid"] = decode_vless_account_id(account)
+    return user
+
+
+def decode_get_inbound_user_response(data: bytes) -> list[dict]:
+    """xray.app.proxyman.command.GetInboundUserResponse {repeated User users = 1}"""
+    return [decode_user(raw) for field, _, raw in iter_fields(data) if field == 1]
+
+
+def _int64(value: int) -> int:
+    # int64 is sent as a two's-complement 64-bit varint.
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def decode_stat(data: bytes) -> tuple[str, int]:
+    """xray.app.stats.command.Stat {name = 1; int64 value = 2}"""
+    name, value = "", 0
+    for field, _, raw in iter_fields(data):
+        if field == 1:
+            name = raw.decode(errors="replace")
+        elif field == 2:
+            value = _int64(raw)
+    return name, value
+
+
+def decode_query_stats_response(data: bytes) -> dict[str, int]:
+    """xray.app.stats.command.QueryStatsResponse {repeated Stat stat = 1} -> {name: value}
+
+    Hot path (two stats per user on every collector tick), so the loop is
+    inlined with a one-byte fast path for tags and lengths instead of going
+    through iter_fields; unknown fields are skipped.
+    """
+    out: dict[str, int] = {}
+    read_varint = _read_varint
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key = data[pos]
+        if key == 0x0A:
+            pos += 1
+        else:
+            key, pos = read_varint(data, pos)
+            if key != 0x0A:  # not field 1 / length-delimited
+                pos = _skip_field(data, pos, key & 0x07)
+                continue
+        size = data[pos]
+        if size < 0x80:
+            pos += 1
+        else:
+            size, pos = read_varint(data, pos)
+        stop = pos + size
+        if stop > end:
+            raise ValueError("truncated length-delimited field")
+
+        name = ""
+        value = 0
+        while pos < stop:
+            tag = data[pos]
+            pos += 1
+            if tag == 0x0A:
+                n = data[pos]
+                if n < 0x80:
+                    pos += 1
+                else:
+                    n, pos = read_varint(data, pos)
+                name = data[pos:pos + n].decode(errors="replace")
+                pos += n
+            elif tag == 0x10:
+                value = 0
+                shift = 0
+                while True:
+                    b = data[pos]
+                    pos += 1
+                    value |= (b & 0x7F) << shift
+                    if b < 0x80:
+                        break
+                    shift += 7
+            else:
+                tag, pos = read_varint(data, pos - 1)
+                pos = _skip_field(data, pos, tag & 0x07)
+        if pos != stop:
+            raise ValueError("malformed Stat message")
+        if name:
+            out[name] = value - (1 << 64) if value >= 1 << 63 else value
+    return out
+
+
+def decode_get_stats_response(data: bytes) -> tuple[str, int] | None:
+    """xray.app.stats.command.GetStatsResponse {Stat stat = 1}; None when the stat is absent."""
+    for field, _, raw in iter_fields(data):
+        if field == 1:
+            return decode_stat(raw)
+    return None
@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+import calendar
+from datetime import datetime, timedelta, timezone
+
+
+def add_periods(anchor: datetime, months: int, days: int, n: int) -> datetime:
+    """`anchor` moved by n periods of `months` months plus `days` days.
+
+    Month steps keep the anchor's day and clamp it to shorter months
+    (Jan 31 + 1 month = Feb 28), always counted from the anchor so the day
+    does not drift after a short month.
+    """
+    index = anchor.month - 1 + months * n
+    year, month = anchor.year + index // 12, index % 12 + 1
+    day = min(anchor.day, calendar.monthrange(year, month)[1])
+    return anchor.replace(year=year, month=month, day=day) + timedelta(days=days * n)
+
+
+def period_bounds(anchor: datetime, months: int, days: int, at: datetime) -> tuple[datetime, datetime]:
+    """(start, end) of the period containing `at`: start <= at < end, both in UTC."""
+    if months <= 0 and days <= 0:
+        raise ValueError("period must be at least one day or one month")
+    anchor = anchor.astimezone(timezone.utc)
+    at = at.astimezone(timezone.utc)
+    approx = timedelta(days=months * 30.436875 + days)
+    n = int((at - anchor) / approx)
+    while add_periods(anchor, months, days, n) > at:
+        n -= 1
+    while add_periods(anchor, months, days, n + 1) <= at:
+        n += 1
+    return add_periods(anchor, months, days, n), add_periods(anchor, months, days, n + 1)
@@ -1,18 +1,116 @@
+import asyncio
+import os
 import subprocess
+import threading
+import time
 from typing import Optional
 from fastapi import HTTPException
 
+from app.config import settings
 
-def run_cmd(cmd: list[str], stdin: Optional[bytes] = None) -> bytes:
-    try:
-        p = subprocess.run(
-            cmd,
-            input=stdin,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True,
-        )
-        return p.stdout
-    except subprocess.CalledProcessError as e:
-        err = (e.stderr or b"").decode(errors="replace")
-        raise HTTPException(status_code=500, detail=err or str(e))
\ No newline at end of file
+
+# All child processes are driven from one background event loop, so a single
+# semaphore caps them process-wide regardless of which thread asked.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _runner_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is not None:
+        return _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="subprocess-runner", daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def _call_labels(cmd: list[str], method: Optional[str]) -> tuple[str, str]:
+    binary = os.path.basename(cmd[0]) if cmd else ""
+    if method:
+        return binary, method
+    if binary == "grpcurl" and cmd:
+        return binary, cmd[-1]
+    if binary == "xray" and len(cmd) > 2 and cmd[1] == "api":
+        return binary, f"api {cmd[2]}"
+    for arg in cmd[1:]:
+        if arg.startswith("--encode="):
+            return binary, arg.split("=", 1)[1]
+    return binary, ""
+
+
+def _observe(binary: str, method: str, duration: float, failure: Optional[str]) -> None:
+    # Imported lazily: app.routers pulls in services that import this module.
+    from app.routers.metrics import SUBPROCESS_FAILURES, SUBPROCESS_LATENCY
+
+    SUBPROCESS_LATENCY.labels(binary=binary, method=method).observe(duration)
+    if failure:
+        SUBPROCESS_FAILURES.labels(binary=binary, method=method, reason=failure).inc()
+
+
+async def _run(cmd: list[str], stdin: Optional[bytes], timeout: Optional[float], method: Optional[str]) -> bytes:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max(1, settings.subprocess_max_concurrency))
+
+    binary, label = _call_labels(cmd, method)
+    async with _semaphore:
+        start = time.perf_counter()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except OSError as e:
+            _observe(binary, label, time.perf_counter() - start, "spawn")
+            raise HTTPException(status_code=500, detail=str(e))
+
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(stdin), timeout=timeout or None)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            _observe(binary, label, time.perf_counter() - start, "timeout")
+            what = " ".join(part for part in (binary, label) if part)
+            raise HTTPException(status_code=504, detail=f"{what} timed out after {timeout:g}s")
+
+        failure = "exit" if proc.returncode != 0 else None
+        _observe(binary, label, time.perf_counter() - start, failure)
+        if failure:
+            e = subprocess.CalledProcessError(proc.returncode, cmd, output=out, stderr=err)
+            detail = (err or b"").decode(errors="replace")
+            raise HTTPException(status_code=500, detail=detail or str(e))
+        return out
+
+
+async def run_cmd_async(
+    cmd: list[str],
+    stdin: Optional[bytes] = None,
+    *,
+    timeout: Optional[float] = None,
+    method: Optional[str] = None,
+) -> bytes:
+    """Run a command with a timeout (kill on expiry) under the global concurrency cap."""
+    timeout = settings.subprocess_timeout_sec if timeout is None else timeout
+    loop = _runner_loop()
+    coro = _run(cmd, stdin, timeout, method)
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+def run_cmd(
+    cmd: list[str],
+    stdin: Optional[bytes] = None,
+    *,
+    timeout: Optional[float] = None,
+    method: Optional[str] = None,
+) -> bytes:
+    timeout = settings.subprocess_timeout_sec if timeout is None else timeout
+    fut = asyncio.run_coroutine_threadsafe(_run(cmd, stdin, timeout, method), _runner_loop())
+    return fut.result()
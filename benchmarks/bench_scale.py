@@ -0,0 +1,319 @@
+"""Scale benchmark: agent endpoints and services at 1k / 10k / 100k keys against a fake Xray.
+
+For every user count it seeds a keys database with N active keys (a throwaway
+SQLite file by default, or --db-dsn for a scratch Postgres), starts the fake
+gRPC Xray from benchmarks/fake_xray.py with matching synthetic counters, and
+runs each scenario in a fresh worker process so peak RSS is per scenario:
+
+    dashboard             GET /web/api/dashboard (session cookie)
+    graphs_live           GET /web/api/graphs/live (session cookie)
+    user_traffic          GET /user_traffic?user_id=... (Bearer)
+    resync_full           SyncService.resync with an empty inbound (adds all N)
+    resync_steady         SyncService.resync with the inbound already in sync
+    collector_tick        TrafficCollector.collect_once (stats pull + store + history)
+    apply_snapshots_bulk  PersistentTrafficService.apply_snapshots_bulk for N users
+
+Each scenario reports p50/p99/mean/max latency, throughput and peak RSS as JSON.
+
+    python -m benchmarks.bench_scale --users 1000,10000,100000 --seconds 10 > scale.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.fake_xray import FakeXray, key_uuid  # noqa: E402
+
+SCENARIOS = (
+    "dashboard",
+    "graphs_live",
+    "user_traffic",
+    "resync_full",
+    "resync_steady",
+    "collector_tick",
+    "apply_snapshots_bulk",
+)
+
+_SERVER_ID = 1
+_INBOUND_TAG = "bench-in"
+_AGENT_TOKEN = "bench-token"
+_WEB_USER = "bench"
+
+
+def _rss_peak_mb() -> float:
+    # ru_maxrss is KiB on Linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _latency_report(samples: list[float], wall: float) -> dict:
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+    return {
+        "runs": len(ordered),
+        "p50_ms": pct(0.50),
+        "p99_ms": pct(0.99),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "throughput_per_sec": round(len(ordered) / wall, 2) if wall else 0.0,
+    }
+
+
+def _repeat(fn, *, seconds: float, max_runs: int, min_runs: int = 3) -> dict:
+    samples: list[float] = []
+    started = time.perf_counter()
+    while len(samples) < max_runs:
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+        if len(samples) >= min_runs and time.perf_counter() - started >= seconds:
+            break
+    return _latency_report(samples, time.perf_counter() - started)
+
+
+def seed_keys(dsn: str, users: int) -> float:
+    """Replace the bench server's keys with N active ones; returns seconds taken."""
+    from sqlalchemy import Column, Integer, Table, create_engine, delete, insert, select
+
+    from app.models import Base, Key, KeyStatus
+    from app.utils.email import email_for_user_id
+
+    started = time.perf_counter()
+    engine = create_engine(dsn, future=True)
+    servers = Base.metadata.tables.get("vpn_servers")
+    if servers is None:
+        # The panel owns vpn_servers; a bare id column is all the keys FK needs.
+        servers = Table("vpn_servers", Base.metadata, Column("id", Integer, primary_key=True))
+    Base.metadata.create_all(engine, tables=[servers, Key.__table__])
+    with engine.begin() as conn:
+        if conn.execute(select(servers.c.id).where(servers.c.id == _SERVER_ID)).first() is None:
+            conn.execute(insert(servers).values(id=_SERVER_ID))
+        conn.execute(delete(Key).where(Key.server_id == _SERVER_ID))
+        batch = 5000
+        for lo in range(1, users + 1, batch):
+            conn.execute(
+                insert(Key),
+                [
+                    {
+                        "user_id": uid,
+                        "server_id": _SERVER_ID,
+                        "uuid": key_uuid(uid),
+                        "uri": f"vless://{key_uuid(uid)}@bench.invalid:443#{email_for_user_id(uid)}",
+                        "status": KeyStatus.active,
+                    }
+                    for uid in range(lo, min(users, lo + batch - 1) + 1)
+                ],
+            )
+    engine.dispose()
+    return round(time.perf_counter() - started, 3)
+
+
+def _worker(scenario: str, users: int, seconds: float, max_runs: int) -> dict:
+    """Runs inside a fresh interpreter whose env points the agent at the fake Xray."""
+    from app.config import settings
+
+    rss_start = _rss_peak_mb()
+    if scenario in ("dashboard", "graphs_live", "user_traffic"):
+        from fastapi.testclient import TestClient
+
+        from app.main import app
+        from app.services.traffic_collector import traffic_collector
+        from app.utils.web_auth import create_session_token
+
+        client = TestClient(app)
+        traffic_collector.collect_once()
+        if scenario == "user_traffic":
+            rnd = random.Random(7)
+            headers = {"Authorization": f"Bearer {settings.agent_token}"}
+
+            def call():
+                resp = client.get("/user_traffic", params={"user_id": rnd.randint(1, users)}, headers=headers)
+                assert resp.status_code == 200 and resp.json()["ok"], resp.text
+        else:
+            path = "/web/api/dashboard" if scenario == "dashboard" else "/web/api/graphs/live"
+            client.cookies.set("xray_web_session", create_session_token(settings.web_username))
+
+            def call():
+                resp = client.get(path)
+                assert resp.status_code == 200, resp.text
+        rss_setup = _rss_peak_mb()
+        report = _repeat(call, seconds=seconds, max_runs=max_runs)
+
+    elif scenario in ("resync_full", "resync_steady"):
+        from app.deps import SessionLocal
+        from app.services.sync_service import SyncService
+        from app.services.xray_service import XrayService
+
+        sync = SyncService(xray=XrayService())
+        db = SessionLocal()
+        outcome: dict = {}
+
+        def call():
+            result = sync.resync(db)
+            db.rollback()
+            outcome.update(synced=result["synced"], failed=len(result["failed"]), changes=len(result["details"]))
+
+        rss_setup = _rss_peak_mb()
+        # A full resync only happens once per empty inbound; later runs would be steady ones.
+        report = _repeat(call, seconds=seconds, max_runs=1 if scenario == "resync_full" else max_runs, min_runs=1)
+        report["last_result"] = outcome
+        db.close()
+
+    elif scenario == "collector_tick":
+        from app.services.traffic_collector import traffic_collector
+
+        traffic_collector.collect_once()
+        rss_setup = _rss_peak_mb()
+        report = _repeat(traffic_collector.collect_once, seconds=seconds, max_runs=max_runs)
+        traffic_collector.persistent.close()
+
+    elif scenario == "apply_snapshots_bulk":
+        from app.services.persistent_traffic_service import PersistentTrafficService
+
+        store = PersistentTrafficService()
+        store.ensure_table(None)
+        tick = [0]
+
+        def call():
+            tick[0] += 1
+            store.apply_snapshots_bulk(
+                None,
+                server_id=_SERVER_ID,
+                snapshots=[
+                    {
+                        "user_id": uid,
+                        "email": f"user-{uid}@lunet",
+                        "available": True,
+                        "current_uplink": tick[0] * 1000 + uid,
+                        "current_downlink": tick[0] * 3000 + uid,
+                    }
+                    for uid in range(1, users + 1)
+                ],
+            )
+
+        call()
+        rss_setup = _rss_peak_mb()
+        report = _repeat(call, seconds=seconds, max_runs=max_runs)
+        store.close()
+
+    else:
+        raise SystemExit(f"unknown scenario {scenario}")
+
+    report.update(rss_start_mb=rss_start, rss_setup_mb=rss_setup, rss_peak_mb=_rss_peak_mb())
+    return report
+
+
+def _run_worker(scenario: str, *, users: int, env: dict, seconds: float, max_runs: int, tmp: Path) -> dict:
+    result_file = tmp / f"{scenario}.json"
+    cmd = [
+        sys.executable, "-m", "benchmarks.bench_scale",
+        "--worker", scenario, "--users", str(users),
+        "--seconds", str(seconds), "--max-runs", str(max_runs),
+        "--result-file", str(result_file),
+    ]
+    started = time.perf_counter()
+    proc = subprocess.run(
+        cmd, env=env, cwd=str(Path(__file__).resolve().parents[1]),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+    )
+    if proc.returncode != 0 or not result_file.exists():
+        return {"error": f"worker exited with {proc.returncode}", "output": proc.stdout[-2000:]}
+    report = json.loads(result_file.read_text())
+    report["process_sec"] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def bench_users(users: int, *, scenarios: list[str], db_dsn: str | None, seconds: float, max_runs: int) -> dict:
+    with tempfile.TemporaryDirectory(prefix=f"bench-scale-{users}-") as tmp_dir:
+        tmp = Path(tmp_dir)
+        dsn = db_dsn or f"sqlite:///{tmp / 'keys.sqlite3'}"
+        seed_sec = seed_keys(dsn, users)
+
+        fake = FakeXray(users, tag=_INBOUND_TAG)
+        port = fake.start(0)
+        base_env = {
+            **os.environ,
+            "XRAY_ADDR": f"127.0.0.1:{port}",
+            "XRAY_API_BACKEND": "grpc",
+            "XRAY_INBOUND_TAG": _INBOUND_TAG,
+            "XRAY_DB_DSN": dsn,
+            "XRAY_SYNC_SERVER_ID": str(_SERVER_ID),
+            # The resync scenarios measure the diff-based path.
+            "XRAY_SYNC_MODE": "reconcile",
+            "XRAY_AGENT_TOKEN": _AGENT_TOKEN,
+            "XRAY_WEB_USERNAME": _WEB_USER,
+            "XRAY_WEB_SESSION_SECRET": "bench-secret",
+            "XRAY_RECONCILE_INTERVAL_SEC": "0",
+            "XRAY_KEY_LISTENER_ENABLED": "0",
+            "XRAY_ACCESS_LOG_ENABLED": "0",
+            "XRAY_LOG_LEVEL": "WARNING",
+        }
+        results: dict[str, dict] = {}
+        try:
+            for scenario in scenarios:
+                if scenario == "resync_full":
+                    fake.clear_inbound()
+                elif scenario == "resync_steady" and len(fake.inbound_users) != users:
+                    fake.preload()
+                env = dict(base_env, XRAY_TRAFFIC_SQLITE_PATH=str(tmp / f"traffic-{scenario}.sqlite3"))
+                calls_before = sum(fake.calls.values())
+                report = _run_worker(scenario, users=users, env=env, seconds=seconds, max_runs=max_runs, tmp=tmp)
+                report["xray_calls"] = sum(fake.calls.values()) - calls_before
+                results[scenario] = report
+        finally:
+            fake.stop()
+
+    return {
+        "users": users,
+        "keys_db": "postgres" if db_dsn else "sqlite",
+        "seed_sec": seed_sec,
+        "scenarios": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1000,10000,100000", help="comma-separated key counts")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seconds", type=float, default=10.0, help="time budget per scenario")
+    parser.add_argument("--max-runs", type=int, default=500, help="cap on runs per scenario")
+    parser.add_argument("--db-dsn", default=None, help="scratch database for the keys table (its keys get replaced)")
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        report = _worker(args.worker, int(args.users), args.seconds, args.max_runs)
+        Path(args.result_file).write_text(json.dumps(report))
+        return
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = sorted(set(scenarios) - set(SCENARIOS))
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    results = [
+        bench_users(int(n), scenarios=scenarios, db_dsn=args.db_dsn, seconds=args.seconds, max_runs=args.max_runs)
+        for n in args.users.split(",") if n.strip()
+    ]
+    print(json.dumps({
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
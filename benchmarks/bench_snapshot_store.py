@@ -0,0 +1,160 @@
+"""Snapshot store (PersistentTrafficService) cost per collector tick and per read.
+
+Compares the managed store (long-lived WAL writer + read-only pool) with the
+previous behavior (a fresh rollback-journal connection per operation, reads
+serialized behind the writer lock) and with the write-behind store (totals in
+memory, journaled, flushed in one transaction) on a throwaway SQLite file.
+
+    python -m benchmarks.bench_snapshot_store --users 10000 --ticks 10 --reads 2000
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.config import settings  # noqa: E402
+from app.services.persistent_traffic_service import PersistentTrafficService  # noqa: E402
+from app.services.traffic_write_buffer import WriteBehindTrafficStore  # noqa: E402
+
+
+class LegacyStore(PersistentTrafficService):
+    """Connection per operation, default journal, every call behind the lock."""
+
+    def _connect(self) -> sqlite3.Connection:
+        self._db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self._db_path), timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _reader(self):
+        with self._lock:
+            yield self._connect()
+
+    def close(self) -> None:
+        pass
+
+
+def _snapshots(users: int, tick: int) -> list[dict]:
+    return [
+        {
+            "user_id": uid,
+            "email": f"user-{uid}@lunet",
+            "available": True,
+            "current_uplink": tick * 1000 + uid,
+            "current_downlink": tick * 3000 + uid,
+        }
+        for uid in range(1, users + 1)
+    ]
+
+
+def _pct(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def bench_store(name: str, store: PersistentTrafficService | WriteBehindTrafficStore, users: int, ticks: int, reads: int, readers: int) -> dict:
+    store.ensure_table(None)
+    store.apply_snapshots_bulk(None, server_id=1, snapshots=_snapshots(users, 0))
+
+    tick_sec = []
+    for tick in range(1, ticks + 1):
+        batch = _snapshots(users, tick)
+        start = time.perf_counter()
+        store.apply_snapshots_bulk(None, server_id=1, snapshots=batch)
+        tick_sec.append(time.perf_counter() - start)
+
+    rnd = random.Random(42)
+    ids = [rnd.randint(1, users) for _ in range(reads)]
+    start = time.perf_counter()
+    for uid in ids:
+        store.get_totals(None, server_id=1, user_id=uid)
+    read_sec = time.perf_counter() - start
+
+    # Readers polling while the writer keeps ticking, like dashboards during collection.
+    stop = threading.Event()
+    latencies: list[float] = []
+    lat_lock = threading.Lock()
+
+    def reader() -> None:
+        local = []
+        r = random.Random()
+        while not stop.is_set():
+            uid = r.randint(1, users)
+            t0 = time.perf_counter()
+            store.get_totals(None, server_id=1, user_id=uid)
+            local.append(time.perf_counter() - t0)
+            stop.wait(0.002)  # paced like API polls, not a GIL-bound busy loop
+        with lat_lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    mixed_ticks = []
+    for tick in range(ticks + 1, ticks + 4):
+        batch = _snapshots(users, tick)
+        t0 = time.perf_counter()
+        store.apply_snapshots_bulk(None, server_id=1, snapshots=batch)
+        mixed_ticks.append(time.perf_counter() - t0)
+    stop.set()
+    for t in threads:
+        t.join()
+    start = time.perf_counter()
+    flushed = store.flush()
+    flush_sec = time.perf_counter() - start
+    store.close()
+
+    return {
+        "store": name,
+        "users": users,
+        "tick_sec_median": round(statistics.median(tick_sec), 4),
+        "tick_sec_max": round(max(tick_sec), 4),
+        "point_reads": reads,
+        "point_read_us": round(read_sec / reads * 1e6, 1) if reads else None,
+        "mixed_tick_sec_median": round(statistics.median(mixed_ticks), 4),
+        "mixed_readers": readers,
+        "mixed_reads": len(latencies),
+        "mixed_read_ms_p50": round(_pct(latencies, 0.50) * 1000, 3),
+        "mixed_read_ms_p99": round(_pct(latencies, 0.99) * 1000, 3),
+        "final_flush_rows": flushed,
+        "final_flush_sec": round(flush_sec, 4),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--ticks", type=int, default=10)
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = (
+            ("legacy", LegacyStore),
+            ("managed", PersistentTrafficService),
+            ("write_behind", lambda: WriteBehindTrafficStore(PersistentTrafficService())),
+        )
+        for name, cls in stores:
+            settings.traffic_sqlite_path = str(Path(tmp) / f"{name}.sqlite3")
+            results.append(bench_store(name, cls(), args.users, args.ticks, args.reads, args.readers))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Add/remove throughput of XrayService per API backend (grpc vs grpcurl).
+
+Runs against the Xray configured via XRAY_ADDR / XRAY_INBOUND_TAG, using
+throwaway emails (bench-<n>@lunet) that are removed again afterwards.
+
+    python -m benchmarks.bench_xray_backends --count 200 --backends grpc,grpcurl
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.services.xray_service import XrayService  # noqa: E402
+
+
+def _run(fn, items: list, workers: int) -> tuple[float, int]:
+    errors = 0
+    start = time.perf_counter()
+    if workers <= 1:
+        for item in items:
+            try:
+                fn(item)
+            except Exception:
+                errors += 1
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for fut in [pool.submit(fn, item) for item in items]:
+                try:
+                    fut.result()
+                except Exception:
+                    errors += 1
+    return time.perf_counter() - start, errors
+
+
+def bench_backend(backend: str, count: int, workers: int) -> dict:
+    svc = XrayService(backend=backend)
+    users = [(f"bench-{i}@lunet", str(uuid.uuid4())) for i in range(count)]
+
+    add_sec, add_err = _run(lambda u: svc.add_user(email=u[0], level=0, uid=u[1]), users, workers)
+    remove_sec, remove_err = _run(lambda u: svc.remove_user(email=u[0]), users, workers)
+
+    return {
+        "backend": backend,
+        "count": count,
+        "workers": workers,
+        "add_sec": round(add_sec, 4),
+        "add_per_sec": round(count / add_sec, 1) if add_sec > 0 else None,
+        "add_errors": add_err,
+        "remove_sec": round(remove_sec, 4),
+        "remove_per_sec": round(count / remove_sec, 1) if remove_sec > 0 else None,
+        "remove_errors": remove_err,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--backends", default="grpc,grpcurl")
+    args = parser.parse_args()
+
+    results = [
+        bench_backend(b.strip(), args.count, args.workers)
+        for b in args.backends.split(",")
+        if b.strip()
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Stand-in Xray API for benchmarks: StatsService and HandlerService over plaintext gRPC.
+
+Serves synthetic, steadily growing traffic counters for users user-1@lunet ..
+user-N@lunet plus one inbound, and keeps an in-memory inbound user list for
+AlterInbound / GetInboundUsers. Requests and responses are raw protobuf, the
+same codec the agent uses, so no generated stubs are needed.
+
+    python -m benchmarks.fake_xray --users 10000 --port 10085
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.utils.email import email_for_user_id  # noqa: E402
+from app.utils.grpc_codec import (  # noqa: E402
+    ADD_USER_OPERATION_TYPE,
+    REMOVE_USER_OPERATION_TYPE,
+    VLESS_ACCOUNT_TYPE,
+    _field_bytes,
+    _field_message,
+    _field_str,
+    _varint,
+    decode_typed_message,
+    decode_user,
+    encode_typed_message,
+    encode_user,
+    encode_vless_account,
+    iter_fields,
+)
+
+STATS_SERVICE = "xray.app.stats.command.StatsService"
+HANDLER_SERVICE = "xray.app.proxyman.command.HandlerService"
+
+
+def key_uuid(user_id: int) -> str:
+    """Deterministic key uuid for a synthetic user, shared with the seeded keys table."""
+    return str(uuid.UUID(int=int(user_id)))
+
+
+def _stat(name_field: bytes, value: int) -> bytes:
+    # Stat {string name = 1; int64 value = 2}
+    return name_field + b"\x10" + _varint(value)
+
+
+class FakeXray:
+    """Synthetic counters: user i moves `rate[i]` bytes/sec (a share of users idle),
+    evaluated at whole seconds since start so repeated reads within a second agree."""
+
+    def __init__(self, users: int, *, tag: str = "inbound", active_share: float = 0.3, seed: int = 1, regexp: bool = True):
+        rnd = random.Random(seed)
+        self.tag = tag
+        # False behaves like builds without QueryStatsRequest.regexp: the field is ignored.
+        self.regexp = regexp
+        self.started = time.monotonic()
+        self.names: list[str] = []
+        self.rates: list[int] = []
+        for uid in range(1, users + 1):
+            email = email_for_user_id(uid)
+            active = rnd.random() < active_share
+            up = rnd.randint(1_000, 200_000) if active else 0
+            self.names += [f"user>>>{email}>>>traffic>>>uplink", f"user>>>{email}>>>traffic>>>downlink"]
+            self.rates += [up, up * rnd.randint(2, 10)]
+        total_up = sum(self.rates[0::2])
+        total_down = sum(self.rates[1::2])
+        self.names += [f"inbound>>>{tag}>>>traffic>>>uplink", f"inbound>>>{tag}>>>traffic>>>downlink"]
+        self.rates += [total_up, total_down]
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self._name_fields = [_field_str(1, name) for name in self.names]
+        # Subtracted after a reset=true read, per counter.
+        self._offsets = [0] * len(self.names)
+        self._cache: dict[tuple[str, int], bytes] = {}
+        self._lock = threading.Lock()
+        self.inbound_users: dict[str, bytes] = {}
+        self.calls: Counter[str] = Counter()
+        self._server = None
+
+    def preload(self) -> None:
+        """Put every synthetic user in the inbound, with the uuid the benchmark seeds for it."""
+        with self._lock:
+            self.inbound_users = {}
+            for uid in range(1, (len(self.names) - 2) // 2 + 1):
+                email = email_for_user_id(uid)
+                self.inbound_users[email] = encode_user(
+                    email=email,
+                    level=0,
+                    account=encode_typed_message(VLESS_ACCOUNT_TYPE, encode_vless_account(key_uuid(uid))),
+                )
+
+    def clear_inbound(self) -> None:
+        with self._lock:
+            self.inbound_users = {}
+
+    def _elapsed(self) -> int:
+        return int(time.monotonic() - self.started) + 1
+
+    def _value(self, i: int, elapsed: int) -> int:
+        return self.rates[i] * elapsed - self._offsets[i]
+
+    def _matching(self, pattern: str, regexp: bool = False) -> list[int]:
+        if regexp:
+            compiled = re.compile(pattern)
+            return [i for i, name in enumerate(self.names) if compiled.search(name)]
+        if pattern.startswith("user>>>") and pattern.endswith(">>>traffic>>>"):
+            i = self._index.get(pattern + "uplink")
+            return [] if i is None else [i, i + 1]
+        if not pattern:
+            return list(range(len(self.names)))
+        return [i for i, name in enumerate(self.names) if pattern in name]
+
+    def query_stats(self, request: bytes, context) -> bytes:
+        pattern, reset, regexp = "", False, False
+        for field, _, raw in iter_fields(request):
+            if field == 1:
+                pattern = raw.decode()
+            elif field == 2:
+                reset = bool(raw)
+            elif field == 4:
+                regexp = bool(raw) and self.regexp
+        elapsed = self._elapsed()
+        with self._lock:
+            if not reset:
+                cached = self._cache.get((pattern, regexp, elapsed))
+                if cached is not None:
+                    return cached
+            try:
+                idx = self._matching(pattern, regexp)
+            except re.error as exc:
+                import grpc
+
+                context.abort(grpc.StatusCode.UNKNOWN, f"error parsing regexp: {exc}")
+            # QueryStatsResponse {repeated Stat stat = 1}
+            out = b"".join(_field_message(1, _stat(self._name_fields[i], self._value(i, elapsed))) for i in idx)
+            if reset:
+                for i in idx:
+                    self._offsets[i] = self.rates[i] * elapsed
+                self._cache.clear()
+            else:
+                self._cache = {k: v for k, v in self._cache.items() if k[2] == elapsed}
+                self._cache[(pattern, regexp, elapsed)] = out
+        return out
+
+    def get_stats(self, request: bytes, context) -> bytes:
+        import grpc
+
+        name = ""
+        for field, _, raw in iter_fields(request):
+            if field == 1:
+                name = raw.decode()
+        i = self._index.get(name)
+        if i is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"{name} not found.")
+        with self._lock:
+            # GetStatsResponse {Stat stat = 1}
+            return _field_message(1, _stat(self._name_fields[i], self._value(i, self._elapsed())))
+
+    def alter_inbound(self, request: bytes, context) -> bytes:
+        import grpc
+
+        op_type, op = "", b""
+        for field, _, raw in iter_fields(request):
+            if field == 2:
+                op_type, op = decode_typed_message(raw)
+        with self._lock:
+            if op_type == ADD_USER_OPERATION_TYPE:
+                user = next((decode_user(raw) for field, _, raw in iter_fields(op) if field == 1), None)
+                if user is None or not user["email"]:
+                    context.abort(grpc.StatusCode.INVALID_ARGUMENT, "no user")
+                if user["email"] in self.inbound_users:
+                    context.abort(grpc.StatusCode.UNKNOWN, f"User {user['email']} already exists.")
+                self.inbound_users[user["email"]] = encode_user(
+                    email=user["email"],
+                    level=user["level"],
+                    account=encode_typed_message(VLESS_ACCOUNT_TYPE, encode_vless_account(user["uuid"])),
+                )
+            elif op_type == REMOVE_USER_OPERATION_TYPE:
+                email = next((raw.decode() for field, _, raw in iter_fields(op) if field == 1), "")
+                if self.inbound_users.pop(email, None) is None:
+                    context.abort(grpc.StatusCode.UNKNOWN, f"User {email} not found.")
+            else:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"unknown operation {op_type}")
+        return b""
+
+    def get_inbound_users(self, request: bytes, context) -> bytes:
+        with self._lock:
+            return b"".join(_field_bytes(1, user) for user in self.inbound_users.values())
+
+    def start(self, port: int = 0, *, workers: int = 16) -> int:
+        """Serve on 127.0.0.1; returns the bound port."""
+        import grpc
+
+        methods = {
+            f"{STATS_SERVICE}/QueryStats": self.query_stats,
+            f"{STATS_SERVICE}/GetStats": self.get_stats,
+            f"{HANDLER_SERVICE}/AlterInbound": self.alter_inbound,
+            f"{HANDLER_SERVICE}/GetInboundUsers": self.get_inbound_users,
+        }
+
+        def counted(name, fn):
+            def handler(request, context):
+                self.calls[name] += 1
+                return fn(request, context)
+            return handler
+
+        handlers = {
+            method.split("/", 1)[1]: grpc.unary_unary_rpc_method_handler(counted(method, fn))
+            for method, fn in methods.items()
+        }
+        generic = [
+            grpc.method_handlers_generic_handler(service, {
+                name: h for name, h in handlers.items() if f"{service}/{name}" in methods
+            })
+            for service in (STATS_SERVICE, HANDLER_SERVICE)
+        ]
+        self._server = grpc.server(ThreadPoolExecutor(max_workers=workers), handlers=generic)
+        bound = self._server.add_insecure_port(f"127.0.0.1:{port}")
+        self._server.start()
+        return bound
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.stop(grace=None)
+            self._server = None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--port", type=int, default=10085)
+    parser.add_argument("--tag", default="inbound")
+    parser.add_argument("--preload", action="store_true", help="start with every user already in the inbound")
+    args = parser.parse_args()
+
+    fake = FakeXray(args.users, tag=args.tag)
+    if args.preload:
+        fake.preload()
+    port = fake.start(args.port)
+    print(f"fake xray on 127.0.0.1:{port} with {args.users} users", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Copy per-user traffic totals from the local SQLite store into Postgres.
+
+Streams `vpn_user_traffic_snapshot` out of the SQLite file in batches; each
+batch is COPYed into a temp table and merged into the Postgres table of the
+same name with INSERT ... ON CONFLICT, one transaction per batch, so memory
+stays flat and an interrupted run can simply be repeated. Stop the agent
+first (or let it flush) so the file is final.
+
+    python scripts/migrate_traffic_snapshot.py --sqlite ./data/traffic_snapshot.sqlite3 --batch 5000
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import io
+import json
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import create_engine  # noqa: E402
+
+from app.config import settings  # noqa: E402
+from app.services.pg_traffic_service import PostgresTrafficService  # noqa: E402
+
+_COLUMNS = (
+    "server_id", "user_id", "email", "last_uplink", "last_downlink",
+    "total_uplink", "total_downlink", "updated_at", "quota_bytes", "quota_disabled_at",
+    "reset_anchor_at", "reset_every_months", "reset_every_days", "period_started_at", "reset_next_at",
+)
+# Files written before these columns existed read them as NULL.
+_OPTIONAL = _COLUMNS[8:]
+
+_ON_CONFLICT = {
+    # Rows Postgres already has (e.g. written by a node already on the postgres backend) win.
+    "skip": "DO NOTHING",
+    "replace": "DO UPDATE SET " + ", ".join(f"{col} = EXCLUDED.{col}" for col in _COLUMNS[2:]),
+}
+
+
+def migrate(sqlite_path: str, dsn: str, *, batch: int, on_conflict: str, server_id: int | None) -> dict:
+    src = sqlite3.connect(f"file:{Path(sqlite_path).expanduser()}?mode=ro", uri=True)
+    engine = create_engine(dsn, future=True)
+    PostgresTrafficService(engine).ensure_table()
+
+    present = {row[1] for row in src.execute("PRAGMA table_info(vpn_user_traffic_snapshot)")}
+    select_list = [col if col in present or col not in _OPTIONAL else f"NULL AS {col}" for col in _COLUMNS]
+    query = f"SELECT {', '.join(select_list)} FROM vpn_user_traffic_snapshot"
+    params: tuple = ()
+    if server_id is not None:
+        query += " WHERE server_id = ?"
+        params = (int(server_id),)
+    query += " ORDER BY server_id, user_id"
+
+    started = time.perf_counter()
+    read = written = batches = 0
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        cur.execute(
+            """
+            CREATE TEMP TABLE traffic_snapshot_import (
+                server_id INTEGER, user_id INTEGER, email TEXT,
+                last_uplink BIGINT, last_downlink BIGINT, total_uplink BIGINT, total_downlink BIGINT,
+                updated_at TIMESTAMPTZ, quota_bytes BIGINT, quota_disabled_at TIMESTAMPTZ,
+                reset_anchor_at TIMESTAMPTZ, reset_every_months INTEGER, reset_every_days INTEGER,
+                period_started_at TIMESTAMPTZ, reset_next_at TIMESTAMPTZ
+            ) ON COMMIT DELETE ROWS
+            """
+        )
+        raw.commit()
+        rows = src.execute(query, params)
+        while True:
+            chunk = rows.fetchmany(batch)
+            if not chunk:
+                break
+            buf = io.StringIO()
+            csv.writer(buf).writerows(chunk)
+            buf.seek(0)
+            cur.copy_expert(f"COPY traffic_snapshot_import ({', '.join(_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buf)
+            cur.execute(
+                f"""
+                INSERT INTO vpn_user_traffic_snapshot ({', '.join(_COLUMNS)})
+                SELECT {', '.join(_COLUMNS)} FROM traffic_snapshot_import
+                ON CONFLICT (server_id, user_id) {_ON_CONFLICT[on_conflict]}
+                """
+            )
+            written += max(0, cur.rowcount or 0)
+            raw.commit()
+            read += len(chunk)
+            batches += 1
+        cur.close()
+    finally:
+        raw.close()
+        src.close()
+        engine.dispose()
+
+    return {
+        "sqlite": str(sqlite_path),
+        "server_id": server_id,
+        "on_conflict": on_conflict,
+        "rows_read": read,
+        "rows_written": written,
+        "batches": batches,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sqlite", default=settings.traffic_sqlite_path)
+    parser.add_argument("--dsn", default=settings.db_dsn)
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--on-conflict", choices=sorted(_ON_CONFLICT), default="skip")
+    parser.add_argument("--server-id", type=int, default=None)
+    args = parser.parse_args()
+
+    print(json.dumps(
+        migrate(args.sqlite, args.dsn, batch=max(1, args.batch), on_conflict=args.on_conflict, server_id=args.server_id),
+        indent=2,
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Settings are read at import time: point everything at throwaway local files first.
+_TMP = tempfile.mkdtemp(prefix="xray-agent-tests-")
+os.environ.setdefault("XRAY_DB_DSN", f"sqlite:///{_TMP}/keys.sqlite3")
+os.environ.setdefault("XRAY_TRAFFIC_SQLITE_PATH", f"{_TMP}/traffic.sqlite3")
+os.environ.setdefault("XRAY_AGENT_TOKEN", "test-token")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import pytest  # noqa: E402
+
+from app.config import settings  # noqa: E402
+
+
+@pytest.fixture
+def sqlite_path(tmp_path, monkeypatch) -> Path:
+    """A fresh traffic SQLite file (and journal next to it) per test."""
+    path = tmp_path / "traffic.sqlite3"
+    monkeypatch.setattr(settings, "traffic_sqlite_path", str(path))
+    monkeypatch.setattr(settings, "traffic_journal_path", "")
+    return path
+
+
+@pytest.fixture
+def xray():
+    """Factory for a fake Xray on a free port plus the agent-side client, capabilities and TrafficService.
+
+    `xray(regexp=False)` emulates a build without QueryStatsRequest.regexp.
+    The capabilities are probed right away, as the agent does at startup.
+    """
+    from types import SimpleNamespace
+
+    from fake_xray import FakeXray
+
+    from app.services.traffic_service import TrafficService
+    from app.services.xray_capabilities import XrayCapabilityRegistry
+    from app.services.xray_grpc_client import XrayGrpcClient
+
+    started = []
+
+    def make(*, regexp: bool = True) -> SimpleNamespace:
+        fake = FakeXray(regexp=regexp)
+        client = XrayGrpcClient(f"127.0.0.1:{fake.start()}", pool_size=1, timeout=5)
+        started.append((fake, client))
+        capabilities = XrayCapabilityRegistry("grpc", client)
+        capabilities.probe()
+        traffic = TrafficService(backend="grpc", grpc_client=client, capabilities=capabilities)
+        return SimpleNamespace(fake=fake, client=client, capabilities=capabilities, traffic=traffic)
+
+    yield make
+    for fake, client in started:
+        client.close()
+        fake.stop()
+
+
+@pytest.fixture
+def keys_db(tmp_path, monkeypatch):
+    """A session on a throwaway vpn_keys table; this agent is server 1."""
+    from sqlalchemy import Column, Integer, Table, create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from app.models import Base, Key
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'keys.sqlite3'}", future=True)
+    servers = Base.metadata.tables.get("vpn_servers")
+    if servers is None:
+        servers = Table("vpn_servers", Base.metadata, Column("id", Integer, primary_key=True))
+    Base.metadata.create_all(engine, tables=[servers, Key.__table__])
+    monkeypatch.setattr(settings, "sync_server_id", 1)
+    db = sessionmaker(bind=engine, future=True)()
+    yield db
+    db.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def pg_dsn():
+    """DSN of a fresh schema in the scratch Postgres named by XRAY_TEST_PG_DSN; skips without one."""
+    import uuid
+
+    from sqlalchemy import create_engine, make_url, text
+
+    base = os.environ.get("XRAY_TEST_PG_DSN")
+    if not base:
+        pytest.skip("XRAY_TEST_PG_DSN not set")
+    schema = f"xray_agent_test_{uuid.uuid4().hex[:12]}"
+    admin = create_engine(base, future=True)
+    with admin.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA {schema}"))
+    try:
+        yield make_url(base).update_query_dict({"options": f"-csearch_path={schema}"}).render_as_string(hide_password=False)
+    finally:
+        with admin.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+        admin.dispose()
@@ -0,0 +1,198 @@
+"""In-process fake of the Xray API for tests: StatsService and HandlerService over plaintext gRPC.
+
+Unlike benchmarks/fake_xray.py nothing grows on its own: tests create
+counters with `add_traffic` / `set_online` and read them back with
+`counter`. Like a fresh Xray, it starts without any counters and without
+users in the inbound.
+"""
+from __future__ import annotations
+
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import grpc
+
+from app.utils.grpc_codec import (
+    ADD_USER_OPERATION_TYPE,
+    REMOVE_USER_OPERATION_TYPE,
+    VLESS_ACCOUNT_TYPE,
+    decode_typed_message,
+    decode_user,
+    encode_typed_message,
+    encode_user,
+    encode_vless_account,
+    iter_fields,
+)
+
+STATS_SERVICE = "xray.app.stats.command.StatsService"
+HANDLER_SERVICE = "xray.app.proxyman.command.HandlerService"
+QUERY_STATS = f"{STATS_SERVICE}/QueryStats"
+
+
+def _encode_stat(name: str, value: int) -> bytes:
+    # Stat {string name = 1; int64 value = 2}; zero values are omitted like protoc does.
+    body = _len_field(1, name.encode())
+    if value:
+        body += b"\x10" + _varint(value)
+    return _len_field(1, body)
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        bits, value = value & 0x7F, value >> 7
+        out.append(bits | 0x80 if value else bits)
+        if not value:
+            return bytes(out)
+
+
+def _len_field(field: int, value: bytes) -> bytes:
+    return _varint(field << 3 | 2) + _varint(len(value)) + value
+
+
+class FakeXray:
+    """`regexp=False` behaves like builds without QueryStatsRequest.patterns/regexp:
+    those fields are ignored and `pattern` is matched as a plain substring."""
+
+    def __init__(self, *, regexp: bool = True):
+        self.regexp = regexp
+        self.calls: Counter[str] = Counter()
+        self._counters: dict[str, int] = {}
+        self._users: dict[str, tuple[str, int]] = {}
+        self._lock = Lock()
+        self._server = None
+
+    # -- test API -------------------------------------------------------
+
+    def add_traffic(self, email: str, up: int = 0, down: int = 0) -> None:
+        with self._lock:
+            for direction, value in (("uplink", up), ("downlink", down)):
+                name = f"user>>>{email}>>>traffic>>>{direction}"
+                self._counters[name] = self._counters.get(name, 0) + int(value)
+
+    def set_online(self, email: str, count: int, *, suffix: str = ">>>online") -> None:
+        with self._lock:
+            self._counters[f"user>>>{email}{suffix}"] = int(count)
+
+    def counter(self, name: str) -> int | None:
+        with self._lock:
+            return self._counters.get(name)
+
+    def traffic(self, email: str) -> tuple[int, int]:
+        """Current (uplink, downlink) counters of `email`, 0 where none exist."""
+        with self._lock:
+            return tuple(self._counters.get(f"user>>>{email}>>>traffic>>>{d}", 0) for d in ("uplink", "downlink"))
+
+    def add_user(self, email: str, uuid: str, level: int = 0) -> None:
+        with self._lock:
+            self._users[email] = (uuid, level)
+
+    def users(self) -> dict[str, str]:
+        """{email: uuid} of the users in the inbound."""
+        with self._lock:
+            return {email: uuid for email, (uuid, _) in self._users.items()}
+
+    # -- gRPC handlers --------------------------------------------------
+
+    def _query_stats(self, request: bytes, context) -> bytes:
+        pattern, reset, patterns, regexp = "", False, [], False
+        for field, _, raw in iter_fields(request):
+            if field == 1:
+                pattern = raw.decode()
+            elif field == 2:
+                reset = bool(raw)
+            elif field == 3 and self.regexp:
+                patterns.append(raw.decode())
+            elif field == 4 and self.regexp:
+                regexp = bool(raw)
+        wanted = ([pattern] if pattern else []) + patterns
+        if regexp:
+            try:
+                compiled = [re.compile(p) for p in wanted]
+            except re.error as exc:
+                context.abort(grpc.StatusCode.UNKNOWN, f"error parsing regexp: {exc}")
+
+            def match(name: str) -> bool:
+                return any(c.search(name) for c in compiled)
+        else:
+            def match(name: str) -> bool:
+                return not wanted or any(p in name for p in wanted)
+
+        with self._lock:
+            hits = [(name, value) for name, value in self._counters.items() if match(name)]
+            if reset:
+                for name, _ in hits:
+                    self._counters[name] = 0
+        return b"".join(_encode_stat(name, value) for name, value in hits)
+
+    def _get_stats(self, request: bytes, context) -> bytes:
+        name = next((raw.decode() for field, _, raw in iter_fields(request) if field == 1), "")
+        with self._lock:
+            value = self._counters.get(name)
+        if value is None:
+            context.abort(grpc.StatusCode.UNKNOWN, f"{name} not found.")
+        return _encode_stat(name, value)
+
+    def _alter_inbound(self, request: bytes, context) -> bytes:
+        op_type, op = "", b""
+        for field, _, raw in iter_fields(request):
+            if field == 2:
+                op_type, op = decode_typed_message(raw)
+        with self._lock:
+            if op_type == ADD_USER_OPERATION_TYPE:
+                user = next((decode_user(raw) for field, _, raw in iter_fields(op) if field == 1), None)
+                if user is None or not user["email"]:
+                    context.abort(grpc.StatusCode.INVALID_ARGUMENT, "no user")
+                if user["email"] in self._users:
+                    context.abort(grpc.StatusCode.UNKNOWN, f"User {user['email']} already exists.")
+                self._users[user["email"]] = (user["uuid"], user["level"])
+            elif op_type == REMOVE_USER_OPERATION_TYPE:
+                email = next((raw.decode() for field, _, raw in iter_fields(op) if field == 1), "")
+                if self._users.pop(email, None) is None:
+                    context.abort(grpc.StatusCode.UNKNOWN, f"User {email} not found.")
+            else:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"unknown operation {op_type}")
+        return b""
+
+    def _get_inbound_users(self, request: bytes, context) -> bytes:
+        with self._lock:
+            users = list(self._users.items())
+        return b"".join(
+            _len_field(1, encode_user(
+                email=email,
+                level=level,
+                account=encode_typed_message(VLESS_ACCOUNT_TYPE, encode_vless_account(uuid)),
+            ))
+            for email, (uuid, level) in users
+        )
+
+    def start(self) -> int:
+        """Serve on a free 127.0.0.1 port; returns it."""
+        methods = {
+            STATS_SERVICE: {"QueryStats": self._query_stats, "GetStats": self._get_stats},
+            HANDLER_SERVICE: {"AlterInbound": self._alter_inbound, "GetInboundUsers": self._get_inbound_users},
+        }
+
+        def counted(method, fn):
+            def handler(request, context):
+                self.calls[method] += 1
+                return fn(request, context)
+            return grpc.unary_unary_rpc_method_handler(handler)
+
+        generic = [
+            grpc.method_handlers_generic_handler(
+                service, {name: counted(f"{service}/{name}", fn) for name, fn in handlers.items()}
+            )
+            for service, handlers in methods.items()
+        ]
+        self._server = grpc.server(ThreadPoolExecutor(max_workers=4), handlers=generic)
+        port = self._server.add_insecure_port("127.0.0.1:0")
+        self._server.start()
+        return port
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.stop(grace=None)
+            self._server = None
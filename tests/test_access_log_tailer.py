@@ -0,0 +1,105 @@
+import os
+import time
+
+import pytest
+
+from app.config import settings
+from app.services.access_log_tailer import AccessLogTailer
+
+STAMP = "2024/05/01 12:00:00"
+TS = time.mktime((2024, 5, 1, 12, 0, 0, 0, 0, -1))
+
+
+def _line(email: str, source: str = "1.2.3.4:51234", stamp: str = STAMP) -> str:
+    return f"{stamp}.123456 from {source} accepted tcp:example.com:443 [vless-in >> direct] email: {email}"
+
+
+def _wait_for(predicate, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "tailer did not catch up"
+        time.sleep(0.01)
+
+
+def test_feed_parses_every_line_format():
+    tailer = AccessLogTailer("unused")
+    lines = [
+        _line("user-1@lunet"),
+        # Older builds: no "from ", no fraction.
+        "2024/05/01 12:00:05 5.6.7.8:4000 accepted udp:8.8.8.8:53 [vless-in >> direct] email: user-1@lunet",
+        _line("user-2@lunet", "tcp:9.9.9.9:1000"),
+        _line("user-2@lunet", "[2001:db8::1]:443", stamp="2024/05/01 11:59:00"),
+        "2024/05/01 12:00:00 from 1.2.3.4:1 rejected  proxy/vless: invalid user",
+        "2024/05/01 12:00:00 from 1.2.3.4:1 accepted tcp:example.com:443 [vless-in >> direct]",
+        "garbage",
+    ]
+
+    assert tailer.feed(lines) == 4
+
+    presence = tailer.presence(["user-1@lunet", "user-2@lunet", "user-3@lunet"], now=TS + 30)
+    assert presence["user-1@lunet"] == {"last_seen": TS + 5, "online": True, "ips": 2}
+    # The older IPv6 line counts as an IP but does not move last_seen back.
+    assert presence["user-2@lunet"] == {"last_seen": TS, "online": True, "ips": 2}
+    assert presence["user-3@lunet"] == {"last_seen": None, "online": False, "ips": 0}
+
+
+def test_windows_and_prune():
+    tailer = AccessLogTailer("unused")
+    tailer.feed([_line("user-1@lunet"), _line("user-1@lunet", "5.6.7.8:1", stamp="2024/05/01 11:50:00")])
+    now = TS + settings.access_log_online_window_sec + 1
+
+    assert tailer.presence(["user-1@lunet"], now=now)["user-1@lunet"] == {"last_seen": TS, "online": False, "ips": 1}
+
+    tailer.prune(now=TS + max(settings.access_log_ip_window_sec, settings.access_log_online_window_sec) + 1)
+    assert tailer.presence(["user-1@lunet"])["user-1@lunet"]["last_seen"] is None
+
+
+@pytest.fixture
+def tail(tmp_path):
+    path = tmp_path / "access.log"
+    path.write_text("")
+    tailer = AccessLogTailer(str(path), poll_sec=0.01)
+    yield path, tailer
+    tailer.stop()
+
+
+def _seen(tailer: AccessLogTailer, email: str) -> bool:
+    return tailer.presence([email])[email]["last_seen"] is not None
+
+
+def test_follows_appends_rotation_and_truncation(tail):
+    path, tailer = tail
+    assert tailer.start()
+
+    with open(path, "a") as fh:
+        fh.write(_line("user-1@lunet") + "\n" + _line("user-2@lunet")[:40])
+    _wait_for(lambda: _seen(tailer, "user-1@lunet"))
+    # The unterminated line waits for the rest of it.
+    with open(path, "a") as fh:
+        fh.write(_line("user-2@lunet")[40:] + "\n")
+    _wait_for(lambda: _seen(tailer, "user-2@lunet"))
+
+    # logrotate-style move: the new file is read from its start.
+    os.rename(path, path.with_suffix(".1"))
+    path.write_text(_line("user-3@lunet") + "\n")
+    _wait_for(lambda: _seen(tailer, "user-3@lunet"))
+
+    # copytruncate: same inode, smaller size.
+    path.write_text(_line("user-4@lunet", "1.1.1.1:1") + "\n")
+    _wait_for(lambda: _seen(tailer, "user-4@lunet"))
+    assert tailer.lines_parsed == 4
+
+
+def test_restart_replays_only_the_backfill_tail(tail, monkeypatch):
+    path, tailer = tail
+    old = _line("user-1@lunet") + "\n"
+    recent = _line("user-2@lunet") + "\n"
+    path.write_text(old * 3 + recent)
+    monkeypatch.setattr(settings, "access_log_backfill_bytes", len(recent) + 10)
+
+    tailer.start()
+    _wait_for(lambda: _seen(tailer, "user-2@lunet"))
+
+    # The line cut by the backfill window is dropped rather than misparsed.
+    assert not _seen(tailer, "user-1@lunet")
+    assert tailer.lines_parsed == 1
@@ -0,0 +1,34 @@
+import importlib
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.config import settings
+
+# app.routers re-exports the router objects under the module names.
+bearer_api = importlib.import_module("app.routers.bearer_api")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    ranked = [{"user_id": uid, "total_bps": 100.0 - uid} for uid in range(1, 6)]
+    snap = SimpleNamespace(server_id=1, ts=0.0, top_talkers={"1m": ranked})
+    monkeypatch.setattr(bearer_api.traffic_collector, "snapshot", lambda: snap)
+    monkeypatch.setattr(settings, "top_talkers_max_k", 5)
+    app = FastAPI()
+    app.include_router(bearer_api.router)
+    return TestClient(app, headers={"Authorization": f"Bearer {settings.agent_token}"})
+
+
+def test_top_talkers_within_max_k(client):
+    body = client.get("/top_talkers", params={"k": 5, "window": "1m"}).json()
+    assert (body["k"], body["max_k"]) == (5, 5)
+    assert [u["user_id"] for u in body["users"]] == [1, 2, 3, 4, 5]
+
+
+def test_top_talkers_rejects_k_above_max_k(client):
+    resp = client.get("/top_talkers", params={"k": 6, "window": "1m"})
+    assert resp.status_code == 422
+    assert "XRAY_TOP_TALKERS_MAX_K" in resp.json()["detail"]
@@ -0,0 +1,114 @@
+import json
+
+import pytest
+
+from app.config import settings
+from app.models import Key, KeyStatus
+from app.services import key_listener as key_listener_module
+from app.services.key_listener import KeyChangeListener
+from app.services.resync_executor import ResyncExecutor
+from app.services.sync_service import SyncService
+from app.services.xray_service import XrayService
+
+
+@pytest.fixture
+def listener(xray, keys_db, monkeypatch):
+    api = xray()
+    service = XrayService("grpc", api.client)
+    listener = KeyChangeListener.__new__(KeyChangeListener)
+    listener.xray = service
+    listener.disabled = set()
+    listener.sync = SyncService(
+        xray=service,
+        executor=ResyncExecutor(service, workers=2, attempts=1),
+        disabled_user_ids=lambda: listener.disabled,
+    )
+    listener.fake = api.fake
+    listener.db = keys_db
+    monkeypatch.setattr(key_listener_module, "SessionLocal", lambda: keys_db)
+    return listener
+
+
+def _event(op: str, key: Key, **extra) -> str:
+    return json.dumps({
+        "op": op, "id": key.id, "user_id": key.user_id, "server_id": key.server_id,
+        "uuid": key.uuid, "status": key.status.value, **extra,
+    })
+
+
+def _save(db, *keys: Key) -> None:
+    db.add_all(keys)
+    db.commit()
+
+
+def test_rotation_replaces_the_uuid_in_xray(listener):
+    db = listener.db
+    old = Key(id=1, user_id=7, server_id=1, uuid="old-uuid", status=KeyStatus.active)
+    _save(db, old)
+    listener.handle_payloads([_event("INSERT", old)])
+    assert listener.fake.users() == {"user-7@lunet": "old-uuid"}
+
+    # Rotation: insert the new key, then revoke the old one; no uuid is ever UPDATEd.
+    new = Key(id=2, user_id=7, server_id=1, uuid="new-uuid", status=KeyStatus.active)
+    _save(db, new)
+    listener.handle_payloads([_event("INSERT", new)])
+    assert listener.fake.users() == {"user-7@lunet": "new-uuid"}
+
+    db.delete(old)
+    db.commit()
+    listener.handle_payloads([_event("DELETE", old)])
+    assert listener.fake.users() == {"user-7@lunet": "new-uuid"}
+
+
+def test_events_are_batched_per_user_and_filtered_by_server(listener):
+    db = listener.db
+    keys = [
+        Key(id=1, user_id=1, server_id=1, uuid="u-1", status=KeyStatus.active),
+        Key(id=2, user_id=2, server_id=1, uuid="u-2", status=KeyStatus.active),
+    ]
+    _save(db, *keys)
+    other = Key(id=3, user_id=3, server_id=2, uuid="u-3", status=KeyStatus.active)
+    payloads = [_event("INSERT", keys[0]), _event("UPDATE", keys[0]), _event("INSERT", keys[1]),
+                _event("INSERT", other), "not json"]
+
+    listener.handle_payloads(payloads)
+
+    assert listener.fake.users() == {"user-1@lunet": "u-1", "user-2@lunet": "u-2"}
+    # Duplicates collapse into one remove+add per user.
+    assert listener.fake.calls["xray.app.proxyman.command.HandlerService/AlterInbound"] == 4
+
+
+def test_deactivated_and_moved_keys_leave_xray(listener):
+    db = listener.db
+    key = Key(id=1, user_id=5, server_id=1, uuid="u-5", status=KeyStatus.active)
+    _save(db, key)
+    listener.fake.add_user("user-5@lunet", "u-5")
+
+    key.server_id = 2
+    db.commit()
+    listener.handle_payloads([_event("UPDATE", key, old_user_id=5, old_server_id=1, old_uuid="u-5")])
+
+    assert listener.fake.users() == {}
+
+
+def test_quota_disabled_users_are_not_added(listener):
+    db = listener.db
+    _save(db, Key(id=1, user_id=1, server_id=1, uuid="u-1", status=KeyStatus.active),
+          Key(id=2, user_id=2, server_id=1, uuid="u-2", status=KeyStatus.active))
+    listener.disabled = {2}
+
+    listener.apply_users(db, {1, 2})
+
+    assert listener.fake.users() == {"user-1@lunet": "u-1"}
+
+
+@pytest.mark.parametrize("mode, removed", [("push", False), ("reconcile", True)])
+def test_catch_up_removes_stale_users_only_in_reconcile_mode(listener, monkeypatch, mode, removed):
+    _save(listener.db, Key(id=1, user_id=1, server_id=1, uuid="u-1", status=KeyStatus.active))
+    listener.fake.add_user("user-9@lunet", "u-9")
+    monkeypatch.setattr(settings, "sync_mode", mode)
+
+    listener._catch_up()
+
+    expected = {"user-1@lunet": "u-1"} if removed else {"user-1@lunet": "u-1", "user-9@lunet": "u-9"}
+    assert listener.fake.users() == expected
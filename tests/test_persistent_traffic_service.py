@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+from app.services.persistent_traffic_service import PersistentTrafficService
+
+
+def _snapshot(uid: int, up: int, down: int = 0) -> dict:
+    return {"user_id": uid, "email": f"user-{uid}@lunet", "available": True, "current_uplink": up, "current_downlink": down}
+
+
+@pytest.fixture
+def store(sqlite_path):
+    return PersistentTrafficService()
+
+
+def test_reset_users_chunks_the_id_list(store):
+    store.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(uid, 10 * uid) for uid in range(1, 11)])
+    # Room for the two fixed parameters and three ids per statement.
+    store._connect().setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 5)
+
+    assert store.reset_users(None, server_id=1, user_ids=[1, 2, 3, 4, 5, 6, 7, 99]) == 7
+
+    totals = store.get_totals_bulk(None, server_id=1, user_ids=list(range(1, 11)))
+    assert [totals[uid]["uplink"] for uid in range(1, 11)] == [0] * 7 + [80, 90, 100]
+
+
+# apply_snapshots_bulk binds 8 parameters per row, add_deltas_bulk 6: limits around
+# multiples of those put the chunk boundary on, before and after a row.
+@pytest.mark.parametrize("limit", [8, 15, 16, 17, 32766])
+def test_upserts_return_every_row_across_chunk_boundaries(store, limit):
+    store._connect().setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+    uids = range(1, 6)
+
+    first = store.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(uid, 100 * uid, uid) for uid in uids])
+    assert first == {uid: {"uplink": 100 * uid, "downlink": uid, "total": 101 * uid} for uid in uids}
+
+    snapshots = [_snapshot(uid, 100 * uid + 10, uid) for uid in uids]
+    snapshots[1] = _snapshot(2, 5)  # below the last counter: Xray restarted
+    snapshots[2] = dict(_snapshot(3, 999), available=False)
+    snapshots.append(_snapshot(4, 450))  # duplicate id: the last snapshot wins
+    second = store.apply_snapshots_bulk(None, server_id=1, snapshots=snapshots)
+    assert {uid: t["uplink"] for uid, t in second.items()} == {1: 110, 2: 205, 3: 300, 4: 450, 5: 510}
+
+    deltas = [{"user_id": uid, "email": f"user-{uid}@lunet", "uplink": 1000} for uid in (*uids, 6)]
+    third = store.add_deltas_bulk(None, server_id=1, deltas=deltas)
+    # Rows still holding last_* subtract them once; the new row 6 takes the delta as is.
+    assert {uid: t["uplink"] for uid, t in third.items()} == {1: 1000, 2: 1200, 3: 1000, 4: 1000, 5: 1000, 6: 1000}
+    assert store.get_totals_bulk(None, server_id=1, user_ids=list(range(1, 7))) == third
@@ -0,0 +1,93 @@
+"""Postgres store and the SQLite -> Postgres migration; needs XRAY_TEST_PG_DSN (a scratch database)."""
+import importlib.util
+import sqlite3
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from app.services import pg_traffic_service
+from app.services.persistent_traffic_service import PersistentTrafficService
+from app.services.pg_traffic_service import PostgresTrafficService
+
+_SCRIPT = Path(__file__).resolve().parents[1] / "scripts" / "migrate_traffic_snapshot.py"
+
+
+def _snapshot(uid: int, up: int, down: int = 0) -> dict:
+    return {"user_id": uid, "email": f"user-{uid}@lunet", "available": True, "current_uplink": up, "current_downlink": down}
+
+
+@pytest.fixture
+def pg(pg_dsn):
+    engine = create_engine(pg_dsn, future=True)
+    yield PostgresTrafficService(engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def migrate():
+    spec = importlib.util.spec_from_file_location("migrate_traffic_snapshot", _SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.migrate
+
+
+def test_bulk_upserts_return_every_row_across_pages(pg, monkeypatch):
+    monkeypatch.setattr(pg_traffic_service, "_PAGE_SIZE", 2)
+    uids = range(1, 6)
+
+    first = pg.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(uid, 100 * uid, uid) for uid in uids])
+    assert first == {uid: {"uplink": 100 * uid, "downlink": uid, "total": 101 * uid} for uid in uids}
+
+    snapshots = [_snapshot(uid, 100 * uid + 10, uid) for uid in uids]
+    snapshots[1] = _snapshot(2, 5)  # below the last counter: Xray restarted
+    snapshots[2] = dict(_snapshot(3, 999), available=False)
+    snapshots.append(_snapshot(4, 450))  # duplicate id: the last snapshot wins
+    second = pg.apply_snapshots_bulk(None, server_id=1, snapshots=snapshots)
+    assert {uid: t["uplink"] for uid, t in second.items()} == {1: 110, 2: 205, 3: 300, 4: 450, 5: 510}
+
+    deltas = [{"user_id": uid, "email": f"user-{uid}@lunet", "uplink": 1000} for uid in (*uids, 6)]
+    third = pg.add_deltas_bulk(None, server_id=1, deltas=deltas)
+    assert {uid: t["uplink"] for uid, t in third.items()} == {1: 1000, 2: 1200, 3: 1000, 4: 1000, 5: 1000, 6: 1000}
+    assert pg.get_totals_bulk(None, server_id=1, user_ids=list(range(1, 7))) == third
+
+
+def test_migrate_copies_in_batches_and_can_be_repeated(pg, pg_dsn, migrate, sqlite_path):
+    local = PersistentTrafficService()
+    local.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(uid, 10 * uid) for uid in range(1, 6)])
+    local.apply_snapshots_bulk(None, server_id=2, snapshots=[_snapshot(1, 7)])
+    local.close()
+
+    report = migrate(str(sqlite_path), pg_dsn, batch=2, on_conflict="skip", server_id=None)
+    assert (report["rows_read"], report["rows_written"], report["batches"]) == (6, 6, 3)
+    assert {uid: t["uplink"] for uid, t in pg.get_totals_bulk(None, server_id=1, user_ids=[1, 5]).items()} == {1: 10, 5: 50}
+
+    local = PersistentTrafficService()
+    local.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(1, 15)])
+    local.close()
+    # Rows Postgres already has win by default; replace overwrites them.
+    assert migrate(str(sqlite_path), pg_dsn, batch=2, on_conflict="skip", server_id=None)["rows_written"] == 0
+    assert pg.get_totals(None, server_id=1, user_id=1)["uplink"] == 10
+    report = migrate(str(sqlite_path), pg_dsn, batch=100, on_conflict="replace", server_id=1)
+    assert (report["rows_read"], report["rows_written"], report["batches"]) == (5, 5, 1)
+    assert pg.get_totals(None, server_id=1, user_id=1)["uplink"] == 15
+
+
+def test_migrate_reads_files_without_the_newer_columns(pg, pg_dsn, migrate, tmp_path):
+    path = tmp_path / "old.sqlite3"
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE vpn_user_traffic_snapshot (server_id INTEGER, user_id INTEGER, email TEXT, "
+            "last_uplink INTEGER, last_downlink INTEGER, total_uplink INTEGER, total_downlink INTEGER, updated_at TEXT)"
+        )
+        conn.execute(
+            "INSERT INTO vpn_user_traffic_snapshot VALUES (1, 9, 'user-9@lunet', 1, 2, 30, 40, '2024-05-01T12:00:00+00:00')"
+        )
+
+    assert migrate(str(path), pg_dsn, batch=10, on_conflict="skip", server_id=None)["rows_written"] == 1
+    assert pg.get_totals(None, server_id=1, user_id=9) == {"uplink": 30, "downlink": 40, "total": 70}
+    with pg.engine.connect() as conn:
+        row = conn.execute(text(
+            "SELECT quota_bytes, reset_next_at FROM vpn_user_traffic_snapshot WHERE user_id = 9"
+        )).one()
+    assert tuple(row) == (None, None)
@@ -0,0 +1,73 @@
+import pytest
+
+from app.services.resync_executor import ResyncExecutor, SyncProgress
+from app.services.xray_service import XrayService
+
+
+class FlakyXray:
+    """Fails each email's calls with the queued errors, then succeeds; error matching is XrayService's own."""
+
+    error_detail = staticmethod(XrayService.error_detail)
+    is_already_exists_error = staticmethod(XrayService.is_already_exists_error)
+    is_not_found_error = staticmethod(XrayService.is_not_found_error)
+    is_transient_error = staticmethod(XrayService.is_transient_error)
+
+    def __init__(self, errors: dict[str, list[str]]):
+        self.errors = errors
+        self.calls: dict[str, int] = {}
+
+    def _call(self, email: str) -> None:
+        self.calls[email] = self.calls.get(email, 0) + 1
+        queued = self.errors.get(email)
+        if queued:
+            raise RuntimeError(queued.pop(0))
+
+    def add_user(self, *, email, level, uid, timeout=None):
+        self._call(email)
+
+    def remove_user(self, *, email, timeout=None):
+        self._call(email)
+
+
+def _executor(xray: FlakyXray, attempts: int = 3) -> ResyncExecutor:
+    return ResyncExecutor(xray, workers=2, attempts=attempts, backoff=0)
+
+
+def test_add_retries_transient_errors_only():
+    xray = FlakyXray({
+        "flaky": ["StatusCode.UNAVAILABLE: connection refused", "Deadline Exceeded"],
+        "dup": ["User dup already exists."],
+        "bad": ["StatusCode.INVALID_ARGUMENT: bad uuid"],
+    })
+    progress = SyncProgress()
+
+    results = _executor(xray).add_users(
+        [{"email": email, "uuid": "u"} for email in ("flaky", "dup", "bad", "fine")], progress=progress
+    )
+
+    assert [r["result"] for r in results] == ["ok", "already", "error", "ok"]
+    assert results[2]["error"] == "StatusCode.INVALID_ARGUMENT: bad uuid"
+    assert xray.calls == {"flaky": 3, "dup": 1, "bad": 1, "fine": 1}
+    assert (progress.ok, progress.already, progress.failed, progress.retries) == (2, 1, 1, 2)
+
+
+def test_remove_treats_not_found_as_missing():
+    xray = FlakyXray({"gone": ["User gone not found."]})
+
+    results = _executor(xray).remove_users(["gone", "there"])
+
+    assert [r["result"] for r in results] == ["missing", "ok"]
+    # "not found" only means done for removes.
+    (added,) = _executor(FlakyXray({"x": ["User x not found."]})).add_users([{"email": "x", "uuid": "u"}])
+    assert added["result"] == "error"
+
+
+@pytest.mark.parametrize("attempts", [1, 3])
+def test_transient_error_reported_after_the_last_attempt(attempts):
+    xray = FlakyXray({"down": ["StatusCode.UNAVAILABLE: failed to dial"] * 5})
+
+    (result,) = _executor(xray, attempts).add_users([{"email": "down", "uuid": "u"}])
+
+    assert result["result"] == "error"
+    assert result["error"] == "StatusCode.UNAVAILABLE: failed to dial"
+    assert xray.calls == {"down": attempts}
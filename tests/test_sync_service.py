@@ -0,0 +1,134 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.config import settings
+from app.models import Key, KeyStatus
+from app.services import sync_service
+from app.services.sync_service import SyncService
+
+
+class FakeExecutor:
+    call_timeout = 1.0
+
+    def __init__(self):
+        self.added: list[dict] = []
+        self.removed: list[str] = []
+
+    def add_users(self, users, *, progress=None, label="add"):
+        self.added += users
+        return [{"email": u["email"], "result": "ok"} for u in users]
+
+    def remove_users(self, emails, *, progress=None, label="remove"):
+        self.removed += emails
+        return [{"email": e, "result": "ok"} for e in emails]
+
+
+class FakeXray:
+    def __init__(self, live: dict[str, str]):
+        self.live = live
+
+    def list_inbound_users(self, timeout=None):
+        return dict(self.live)
+
+
+def _key(id_: int, user_id: int, uuid: str) -> Key:
+    return Key(id=id_, user_id=user_id, server_id=1, uuid=uuid, status=KeyStatus.active)
+
+
+@pytest.fixture
+def make_sync(monkeypatch):
+    monkeypatch.setattr(
+        sync_service, "xray_capabilities", SimpleNamespace(get=lambda: SimpleNamespace(inbound_users_listing=True))
+    )
+
+    def make(keys: list[Key], live: dict[str, str]) -> SyncService:
+        sync = SyncService(xray=FakeXray(live), executor=FakeExecutor())
+        monkeypatch.setattr(sync, "get_active_keys", lambda db: keys)
+        return sync
+
+    return make
+
+
+def test_reconcile_without_removals_only_adds(make_sync):
+    sync = make_sync(
+        [_key(1, 1, "u-1"), _key(2, 2, "u-2-new")],
+        {"user-2@lunet": "u-2-old", "user-9@lunet": "u-9", "static@example": "s"},
+    )
+    report = sync.reconcile(None, removals=False)
+
+    assert report["mode"] == "push"
+    assert report["stale"] == ["user-9@lunet"] and report["changed"] == ["user-2@lunet"]
+    assert sync.executor.removed == []
+    assert [u["email"] for u in sync.executor.added] == ["user-1@lunet"]
+
+
+def test_reconcile_with_removals_fixes_drift(make_sync):
+    sync = make_sync([_key(2, 2, "u-2-new")], {"user-2@lunet": "u-2-old", "user-9@lunet": "u-9"})
+    sync.reconcile(None)
+
+    assert sorted(sync.executor.removed) == ["user-2@lunet", "user-9@lunet"]
+    assert sync.executor.added == [{"email": "user-2@lunet", "uuid": "u-2-new", "level": 0}]
+
+
+def test_scheduler_respects_push_mode(make_sync, monkeypatch):
+    from app.services import reconcile_scheduler
+
+    sync = make_sync([], {"user-9@lunet": "u-9"})
+    scheduler = reconcile_scheduler.ReconcileScheduler.__new__(reconcile_scheduler.ReconcileScheduler)
+    scheduler.sync = sync
+    scheduler.last_success = None
+    scheduler.last_report = None
+    monkeypatch.setattr(reconcile_scheduler, "SessionLocal", lambda: SimpleNamespace(close=lambda: None))
+
+    monkeypatch.setattr(settings, "sync_mode", "push")
+    scheduler.run_once()
+    assert sync.executor.removed == []
+
+    monkeypatch.setattr(settings, "sync_mode", "reconcile")
+    scheduler.run_once()
+    assert sync.executor.removed == ["user-9@lunet"]
+
+
+def test_scheduler_keeps_readiness_degraded_while_adds_fail(make_sync, monkeypatch):
+    from app.services import reconcile_scheduler
+    from app.services.readiness import Readiness
+
+    sync = make_sync([_key(1, 1, "u-1"), _key(2, 2, "u-2")], {"user-1@lunet": "u-1"})
+    fail = True
+
+    def add_users(users, *, progress=None, label="add"):
+        return [{"email": u["email"], "result": "error" if fail else "ok"} for u in users]
+
+    monkeypatch.setattr(sync.executor, "add_users", add_users)
+    scheduler = reconcile_scheduler.ReconcileScheduler.__new__(reconcile_scheduler.ReconcileScheduler)
+    scheduler.sync = sync
+    scheduler.last_success = None
+    scheduler.last_report = None
+    state = Readiness()
+    monkeypatch.setattr(reconcile_scheduler, "readiness", state)
+    monkeypatch.setattr(reconcile_scheduler, "SessionLocal", lambda: SimpleNamespace(close=lambda: None))
+
+    scheduler.run_once()
+    snap = state.snapshot()
+    assert (snap["ready"], snap["state"], snap["synced"], snap["failed"]) == (False, "degraded", 1, 1)
+
+    fail = False
+    scheduler.run_once()
+    snap = state.snapshot()
+    assert (snap["ready"], snap["state"], snap["synced"], snap["failed"]) == (True, "ready", 2, 0)
+
+
+def test_active_keys_pick_newest_key_per_user(keys_db):
+    db = keys_db
+    # Inserted out of id order, so an unordered scan would not return the newest last.
+    db.add_all([_key(7, 1, "new"), _key(3, 1, "old"), _key(5, 2, "only"), _key(9, 1, "gone")])
+    db.flush()
+    db.get(Key, 9).status = KeyStatus.deleted
+    db.commit()
+
+    keys = SyncService(xray=FakeXray({}), executor=FakeExecutor()).get_active_keys(db)
+
+    assert sorted((k.user_id, k.uuid) for k in keys) == [(1, "new"), (2, "only")]
+    disabled = SyncService(xray=FakeXray({}), executor=FakeExecutor(), disabled_user_ids=lambda: {1})
+    assert [(k.user_id, k.uuid) for k in disabled.get_active_keys(db)] == [(2, "only")]
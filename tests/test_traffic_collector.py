@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fake_xray import QUERY_STATS
+
+from app.config import settings
+from app.models import Key, KeyStatus
+from app.services.persistent_traffic_service import PersistentTrafficService
+from app.services.traffic_collector import TrafficCollector
+
+
+@pytest.fixture
+def api(xray):
+    return xray()
+
+
+@pytest.fixture
+def collector(api, sqlite_path):
+    return TrafficCollector(traffic=api.traffic, persistent=PersistentTrafficService())
+
+
+def test_roll_over_resets_due_counters_in_one_call(api, collector):
+    emails = {uid: f"user-{uid}@lunet" for uid in (1, 3, 17, 30)}
+    for uid, email in emails.items():
+        api.fake.add_traffic(email, up=uid, down=uid)
+    now = datetime.now(timezone.utc)
+    anchor = now - timedelta(days=40)
+    due = [3, 17, 30]
+    collector.resets.set_schedules({uid: (anchor, 0, 30) for uid in due}, now=anchor + timedelta(days=1))
+    calls = api.fake.calls[QUERY_STATS]
+
+    collector._roll_over_periods({})
+
+    assert api.fake.calls[QUERY_STATS] - calls == 1
+    traffic = api.traffic.get_users_traffic(list(emails.values()))
+    assert [traffic[emails[uid]]["total"] for uid in (1, 3, 17, 30)] == [2, 0, 0, 0]
+    schedules = collector.persistent.fetch_reset_schedules(server_id=settings.sync_server_id, user_ids=due)
+    assert all(item["next_reset_at"] > now for item in schedules.values())
+
+
+
+def test_roll_over_credits_traffic_after_the_pass_read_to_the_new_period(api, collector):
+    api.fake.add_traffic("user-5@lunet", up=100, down=1000)
+    active = [Key(id=5, user_id=5, server_id=1, uuid="u-5", status=KeyStatus.active)]
+    _, persisted = collector._pull_and_accumulate(active)
+    assert persisted[5]["total"] == 1100
+    # Arrives after the pass read the counters, before the rollover resets them.
+    api.fake.add_traffic("user-5@lunet", up=7, down=30)
+    anchor = datetime.now(timezone.utc) - timedelta(days=40)
+    collector.resets.set_schedules({5: (anchor, 0, 30)}, now=anchor + timedelta(days=1))
+
+    collector._roll_over_periods(persisted)
+
+    assert persisted[5] == {"uplink": 7, "downlink": 30, "total": 37}
+    assert collector.persistent.get_totals_bulk(None, server_id=settings.sync_server_id, user_ids=[5]) == {5: persisted[5]}
+    assert api.fake.traffic("user-5@lunet") == (0, 0)
+    # The next pass starts from the zeroed counters and adds nothing twice.
+    api.fake.add_traffic("user-5@lunet", up=1, down=1)
+    _, persisted = collector._pull_and_accumulate(active)
+    assert persisted[5]["total"] == 39
+
+@pytest.mark.parametrize("regexp", [True, False], ids=["regexp", "no-regexp"])
+def test_reset_mode_credits_users_outside_the_active_keys(xray, sqlite_path, monkeypatch, regexp):
+    api = xray(regexp=regexp)
+    collector = TrafficCollector(traffic=api.traffic, persistent=PersistentTrafficService())
+    monkeypatch.setattr(settings, "traffic_accounting_mode", "reset")
+    api.fake.add_traffic("user-1@lunet", up=10, down=100)
+    # Its key was deactivated after the pass read the active keys.
+    api.fake.add_traffic("user-2@lunet", up=20, down=200)
+    api.fake.add_traffic("static@example", up=5, down=5)
+    active = [Key(id=1, user_id=1, server_id=1, uuid="u-1", status=KeyStatus.active)]
+
+    user_traffic, persisted = collector._pull_and_accumulate(active)
+
+    assert persisted == {1: {"uplink": 10, "downlink": 100, "total": 110}}
+    totals = collector.persistent.get_totals_bulk(None, server_id=settings.sync_server_id, user_ids=[1, 2])
+    assert totals[2] == {"uplink": 20, "downlink": 200, "total": 220}
+    assert "static@example" not in user_traffic
+    # Only a build that can match managed emails leaves other users' counters alone.
+    assert api.traffic.get_users_traffic(["static@example"])["static@example"]["total"] == (10 if regexp else 0)
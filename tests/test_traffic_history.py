@@ -0,0 +1,90 @@
+import pytest
+
+from app.config import settings
+from app.services.persistent_traffic_service import PersistentTrafficService
+from app.services.traffic_history_service import TrafficHistoryService
+
+DAY = 86400
+HOUR = 3600
+T0 = 19676 * DAY  # a UTC midnight
+
+
+@pytest.fixture
+def history(sqlite_path):
+    history = TrafficHistoryService(PersistentTrafficService())
+    history.prime([1], {})
+    return history
+
+
+def _record(history: TrafficHistoryService, ts: float, uplink: int) -> None:
+    """Record user 1's uplink total as of `ts`."""
+    history.record(server_id=1, ts=ts, totals={1: {"uplink": uplink, "downlink": 0}})
+
+
+def _uplink(history: TrafficHistoryService, start: int, end: int, step: int) -> tuple[str, list[int]]:
+    result = history.query(server_id=1, user_id=1, start=start, end=end, step=step)
+    return result["resolution"], [p["uplink"] for p in result["points"]]
+
+
+def _count(history: TrafficHistoryService, resolution: str) -> int:
+    with history.store.read() as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM vpn_user_traffic_history_{resolution}").fetchone()[0]
+
+
+def test_record_adds_growth_and_survives_total_resets(history):
+    _record(history, T0 + 10, 100)
+    _record(history, T0 + 50, 150)
+    # Totals dropped (period reset): what is there now accrued after it.
+    _record(history, T0 + 70, 30)
+    # Users without a baseline are only primed.
+    history.record(server_id=1, ts=T0 + 80, totals={1: {"uplink": 30, "downlink": 0}, 2: {"uplink": 999, "downlink": 0}})
+
+    assert _uplink(history, T0, T0 + 180, 60) == ("1m", [150, 30, 0])
+
+
+def test_rollup_advances_watermarks_over_closed_buckets_only(history):
+    _record(history, T0 + 30, 10)
+    _record(history, T0 + HOUR + 90, 30)
+
+    # Hour 0 is closed, hour 1 is not: only the first reaches 1h, no day is complete yet.
+    assert history.rollup(now=T0 + HOUR + 120) == {"1h": 1}
+    assert history.rollup(now=T0 + HOUR + 150) == {}
+
+    _record(history, T0 + DAY + 60, 70)
+    assert history.rollup(now=T0 + DAY + 120) == {"1h": 1, "1d": 1}
+    with history.store.read() as conn:
+        marks = dict(conn.execute("SELECT resolution, complete_until FROM vpn_user_traffic_history_watermark"))
+    assert marks == {"1h": T0 + DAY, "1d": T0 + DAY}
+    assert _uplink(history, T0, T0 + DAY, DAY) == ("1d", [30])
+
+
+def test_query_reads_tails_from_finer_resolutions(history):
+    _record(history, T0 + 30, 10)
+    _record(history, T0 + DAY + 30, 30)
+    _record(history, T0 + DAY + 2 * HOUR + 30, 70)
+    # Day 0 is in 1d, day 1's first hour in 1h, its current hour only in 1m.
+    history.rollup(now=T0 + DAY + 2 * HOUR + 60)
+
+    assert _uplink(history, T0, T0 + 2 * DAY, DAY) == ("1d", [10, 60])
+    assert _uplink(history, T0 + DAY, T0 + DAY + 3 * HOUR, HOUR) == ("1h", [20, 0, 40])
+    # A range starting mid-step is aligned down to the step.
+    assert _uplink(history, T0 + 5 * HOUR, T0 + DAY + 3 * HOUR, DAY) == ("1d", [10, 60])
+    with pytest.raises(ValueError):
+        history.query(server_id=1, user_id=1, start=T0, end=T0 + DAY, step=90)
+
+
+def test_prune_keeps_rows_the_next_resolution_has_not_absorbed(history, monkeypatch):
+    monkeypatch.setattr(settings, "traffic_history_retention_1m_days", 0)
+    monkeypatch.setattr(settings, "traffic_history_retention_1h_days", 1)
+    _record(history, T0 + 30, 10)
+    _record(history, T0 + HOUR + 30, 30)
+    history.rollup(now=T0 + HOUR + 60)
+
+    # 1m rows of hour 0 are rolled up and go; hour 1 is still only in 1m and stays.
+    assert history.prune(now=T0 + 10 * DAY) == {"1m": 1, "1h": 0, "1d": 0}
+    assert _count(history, "1m") == 1
+    assert _uplink(history, T0, T0 + 2 * HOUR, HOUR) == ("1h", [10, 20])
+
+    history.rollup(now=T0 + 2 * DAY)
+    assert history.prune(now=T0 + 3 * DAY) == {"1m": 1, "1h": 2, "1d": 0}
+    assert _uplink(history, T0, T0 + DAY, DAY) == ("1d", [30])
@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.config import settings
+from app.models import Key, KeyStatus
+from app.services import traffic_maintenance
+from app.services.persistent_traffic_service import PersistentTrafficService
+from app.services.traffic_collector import TrafficCollector
+from app.services.traffic_maintenance import TrafficStoreMaintenance
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def maintenance(sqlite_path, keys_db, monkeypatch):
+    monkeypatch.setattr(traffic_maintenance, "SessionLocal", lambda: keys_db)
+    maintenance = TrafficStoreMaintenance(TrafficCollector(persistent=PersistentTrafficService()))
+    yield maintenance
+    maintenance.collector.persistent.close()
+
+
+def _rows(store: PersistentTrafficService, updated: dict[int, datetime]) -> None:
+    store.write_rows([
+        (1, uid, f"user-{uid}@lunet", 5, 5, 100, 100, at.isoformat()) for uid, at in updated.items()
+    ])
+
+
+def _user_ids(store: PersistentTrafficService) -> list[int]:
+    return sorted(store.get_totals_bulk(None, server_id=1, user_ids=list(range(1, 10))))
+
+
+def test_prune_drops_idle_users_without_an_active_key(maintenance, keys_db, monkeypatch):
+    monkeypatch.setattr(settings, "traffic_prune_grace_days", 30)
+    store = maintenance.collector.persistent
+    old = NOW - timedelta(days=31)
+    # 1 has an active key, 3 moved recently, 4 holds a quota, 5 a reset schedule; 2 and 6 are stale.
+    _rows(store, {1: old, 2: old, 3: NOW - timedelta(days=29), 4: old, 5: old, 6: old})
+    store.set_quotas(server_id=1, quotas={4: 10**9})
+    maintenance.collector.resets.set_schedules({5: (NOW, 1, 0)}, now=NOW)
+    _rows(store, {5: old})
+    keys_db.add_all([
+        Key(id=1, user_id=1, server_id=1, uuid="u-1", status=KeyStatus.active),
+        Key(id=2, user_id=6, server_id=2, uuid="u-6", status=KeyStatus.active),
+    ])
+    keys_db.commit()
+
+    assert sorted(maintenance.prune(now=NOW)) == [2, 6]
+    assert _user_ids(store) == [1, 3, 4, 5]
+
+
+def test_prune_skips_when_disabled_or_no_key_is_active(maintenance, monkeypatch):
+    store = maintenance.collector.persistent
+    _rows(store, {2: NOW - timedelta(days=400)})
+
+    # No active key at all looks like a wrong server id, not an empty node.
+    assert maintenance.prune(now=NOW) == []
+    monkeypatch.setattr(settings, "traffic_prune_grace_days", 0)
+    assert maintenance.prune(now=NOW) == []
+    assert _user_ids(store) == [2]
+
+
+def test_prune_periods_keeps_the_retention_window(maintenance, monkeypatch):
+    resets = maintenance.collector.resets
+    anchor = NOW - timedelta(days=100)
+    resets.set_schedules({7: (anchor, 0, 30)}, now=anchor)
+    for days in (31, 61, 91):
+        assert len(resets.roll_over(now=anchor + timedelta(days=days))) == 1
+
+    monkeypatch.setattr(settings, "traffic_period_retention_days", 0)
+    assert maintenance.prune_periods(now=NOW) == 0
+    monkeypatch.setattr(settings, "traffic_period_retention_days", 45)
+    # Periods ended at day 30, 60 and 90; the cutoff is day 55.
+    assert maintenance.prune_periods(now=NOW) == 1
+    ends = [p["period_end"] for p in resets.get(7)["periods"]]
+    assert ends == [anchor + timedelta(days=90), anchor + timedelta(days=60)]
+
+
+def test_compact_releases_free_pages_and_truncates_the_wal(maintenance):
+    store = maintenance.collector.persistent
+    _rows(store, {uid: NOW for uid in range(1, 5001)})
+    store.reset_users(None, server_id=1)
+    with store.write() as conn:
+        conn.execute("DELETE FROM vpn_user_traffic_snapshot")
+    before = store.storage_stats()
+    assert before["wal_bytes"] > 0
+
+    report = maintenance.compact()
+
+    assert report["freelist_count"] == 0
+    assert report["wal_bytes"] == 0
+    assert report["page_count"] < before["page_count"]
+    # Already incremental: a second run has nothing left to release.
+    assert maintenance.compact()["vacuumed_pages"] == 0
+
+
+def test_run_once_reports_every_step(maintenance, keys_db):
+    keys_db.add(Key(id=1, user_id=1, server_id=1, uuid="u-1", status=KeyStatus.active))
+    keys_db.commit()
+    _rows(maintenance.collector.persistent, {1: NOW, 2: NOW - timedelta(days=400)})
+
+    maintenance.run_once()
+
+    report = maintenance.last_report
+    assert (report["pruned"], report["pruned_periods"]) == (1, 0)
+    assert {"file_bytes", "wal_bytes", "page_count", "freelist_count", "vacuumed_pages"} <= set(report)
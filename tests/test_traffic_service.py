@@ -0,0 +1,30 @@
+import pytest
+
+from fake_xray import QUERY_STATS
+
+TARGETS = ["user-10@lunet", "user-11@lunet", "user-20@lunet"]
+# Share prefixes with the targets, so a loose pattern would hit them too.
+OTHERS = ["user-1@lunet", "user-2@lunet", "user-100@lunet"]
+
+
+@pytest.mark.parametrize("regexp", [True, False], ids=["regexp", "no-regexp"])
+def test_reset_users_traffic_touches_only_targets(xray, regexp):
+    api = xray(regexp=regexp)
+    for n, email in enumerate(TARGETS + OTHERS, start=1):
+        api.fake.add_traffic(email, up=n, down=10 * n)
+    assert api.capabilities.get().query_stats_regexp is regexp
+    calls = api.fake.calls[QUERY_STATS]
+
+    result = api.traffic.reset_users_traffic(TARGETS)
+
+    # One regexp call; otherwise a listing call plus one call per target.
+    assert api.fake.calls[QUERY_STATS] - calls == (1 if regexp else 1 + len(TARGETS))
+    assert result["available"]
+    assert (result["reset_uplink"], result["reset_downlink"]) == (1 + 2 + 3, 10 + 20 + 30)
+    assert api.traffic.get_users_traffic(TARGETS + OTHERS) == {
+        **{email: {"available": True, "uplink": 0, "downlink": 0, "total": 0} for email in TARGETS},
+        **{
+            email: {"available": True, "uplink": n, "downlink": 10 * n, "total": 11 * n}
+            for n, email in enumerate(OTHERS, start=len(TARGETS) + 1)
+        },
+    }
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.services.persistent_traffic_service import PersistentTrafficService
+from app.services.traffic_write_buffer import WriteBehindTrafficStore
+
+
+def _snapshot(uid: int, up, down=0) -> dict:
+    return {"user_id": uid, "email": f"user-{uid}@lunet", "available": True, "current_uplink": up, "current_downlink": down}
+
+
+@pytest.fixture
+def store(sqlite_path):
+    store = WriteBehindTrafficStore(PersistentTrafficService())
+    yield store
+    store.close()
+
+
+def test_failed_mutation_releases_journal_lock(store):
+    store.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(1, 100)])
+    with pytest.raises(ValueError):
+        store.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(2, 50), _snapshot(3, "x")])
+
+    assert not store._journal_lock.locked()
+    assert not store._buf_lock.locked()
+    # Later mutations and flushes still go through.
+    assert store.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(1, 150)])[1]["uplink"] == 150
+    assert store.flush() >= 1
+    assert store.backend.get_totals(None, server_id=1, user_id=1)["uplink"] == 150
+
+
+def test_rows_changed_before_the_error_are_journaled(store, sqlite_path):
+    with pytest.raises(ValueError):
+        store.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(2, 50), _snapshot(3, "x")])
+
+    journal = sqlite_path.with_name(sqlite_path.name + ".journal")
+    assert b"user-2@lunet" in journal.read_bytes()
+    assert store.flush() == 1
+    assert store.backend.get_totals(None, server_id=1, user_id=2)["uplink"] == 50
+
+
+@pytest.mark.parametrize("write_behind", [True, False], ids=["write-behind", "sqlite"])
+def test_prune_users_keeps_quota_and_schedule_rows(sqlite_path, write_behind):
+    backend = PersistentTrafficService()
+    store = WriteBehindTrafficStore(backend) if write_behind else backend
+    try:
+        store.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(uid, 10) for uid in (1, 2, 3, 4, 5)])
+        store.flush()
+        store.set_quotas(server_id=1, quotas={2: 500, 3: 700})
+        store.set_quota_disabled(server_id=1, user_ids=[3], disabled=True)
+        due = datetime.now(timezone.utc) + timedelta(days=1)
+        store.set_reset_schedules(server_id=1, schedules={4: {
+            "anchor_at": due, "every_months": 1, "every_days": 0, "period_started_at": due, "next_reset_at": due,
+        }})
+
+        pruned = store.prune_users(
+            None, server_id=1, keep_user_ids={1}, updated_before=datetime.now(timezone.utc) + timedelta(seconds=1)
+        )
+
+        assert pruned == [5]
+        assert store.fetch_quotas(server_id=1) == {2: (500, False), 3: (700, True)}
+        assert set(store.fetch_reset_schedules(server_id=1)) == {4}
+        assert {row[0] for row in backend.fetch_rows(server_id=1)} == {1, 2, 3, 4}
+        if write_behind:
+            assert {uid for _, uid in store._cache} == {1, 2, 3, 4}
+    finally:
+        store.close()
+
+
+def test_load_fills_the_cache_under_the_buffer_lock(store):
+    store.backend.apply_snapshots_bulk(None, server_id=1, snapshots=[_snapshot(uid, 10) for uid in (1, 2, 3)])
+    fetched_unlocked = []
+    fetch_rows = store.backend.fetch_rows
+
+    def fetch(**kwargs):
+        fetched_unlocked.append(not store._buf_lock.locked())
+        return fetch_rows(**kwargs)
+
+    class GuardedCache(dict):
+        # reset_users / prune_users iterate the cache under _buf_lock; inserting without it
+        # can break their iteration with "dictionary changed size during iteration".
+        def setdefault(self, key, default=None):
+            assert store._buf_lock.locked()
+            return super().setdefault(key, default)
+
+    store.backend.fetch_rows = fetch
+    store._cache = GuardedCache(store._cache)
+
+    assert store.get_totals_bulk(None, server_id=1, user_ids=[1, 2, 3])[2]["uplink"] == 10
+    assert store.reset_users(None, server_id=1) == 3
+    # The backend read itself does not block writers.
+    assert fetched_unlocked and all(fetched_unlocked)
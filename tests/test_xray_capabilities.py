@@ -0,0 +1,42 @@
+from fake_xray import QUERY_STATS
+
+from app.services.xray_capabilities import XrayCapabilityRegistry
+
+
+def test_probe_of_an_empty_xray(xray):
+    # A fresh Xray has no counters at all when the agent starts.
+    caps = xray().capabilities.get()
+
+    assert caps.probed and caps.query_stats_via == "grpc"
+    assert caps.query_stats_regexp is True
+    assert caps.online_stat_suffix is None
+    assert caps.inbound_users_listing is True
+
+
+def test_probe_of_a_build_without_regexp(xray):
+    assert xray(regexp=False).capabilities.get().query_stats_regexp is False
+
+
+def test_online_counters_found_after_the_probe(xray):
+    api = xray()
+    caps = XrayCapabilityRegistry("grpc", api.client, online_retry_sec=0)
+    assert caps.probe().online_stat_suffix is None
+
+    api.fake.set_online("user-1@lunet", 1)
+    assert caps.get().online_stat_suffix == ">>>online"
+
+    # Once found, get() stops asking.
+    calls = api.fake.calls[QUERY_STATS]
+    caps.get()
+    assert api.fake.calls[QUERY_STATS] == calls
+
+
+def test_online_recheck_is_rate_limited(xray):
+    api = xray()
+    caps = XrayCapabilityRegistry("grpc", api.client, online_retry_sec=3600)
+    caps.probe()
+    api.fake.set_online("user-1@lunet", 1)
+    calls = api.fake.calls[QUERY_STATS]
+
+    assert caps.get().online_stat_suffix is None
+    assert api.fake.calls[QUERY_STATS] == calls